@@ -3,4 +3,9 @@
 newmodelname=$1
 imagename="$(tr [A-Z] [a-z] <<< "$newmodelname")"
 dir=$(pwd)
-sed "s/modelname/$newmodelname/g" ${dir}/dockerfiles/Dockerfile-slim.template > ${dir}/dockerfiles/Dockerfile.${imagename}-slim
+if [ "$2" == "from-full" ]; then
+    # Copy the conda environment out of kipoi/kipoi-docker:$imagename
+    sed -e "s/modelname/$newmodelname/g" -e "s/imagename/$imagename/g" ${dir}/dockerfiles/Dockerfile-slim-from-full.template > ${dir}/dockerfiles/Dockerfile.${imagename}-slim
+else
+    sed "s/modelname/$newmodelname/g" ${dir}/dockerfiles/Dockerfile-slim.template > ${dir}/dockerfiles/Dockerfile.${imagename}-slim
+fi
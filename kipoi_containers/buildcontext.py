@@ -0,0 +1,181 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import tarfile
+import tempfile
+from typing import List, Optional, Union
+
+from kipoi_containers.helper import logger
+
+PathType = Union[str, Path]
+
+CONTEXT_DOCKERFILE = "Dockerfile"
+DEFAULT_CONTEXT_CACHE_FOLDER = (
+    Path.home() / ".cache" / "kipoi-containers" / "build-contexts"
+)
+
+
+def split_dockerfile_instructions(dockerfile_content: str) -> List[str]:
+    """
+    Splits the content of a dockerfile into a list of instructions. Line
+    continuations are joined, comments and empty lines are dropped. The
+    position of an instruction in this list corresponds to
+    Step <position + 1> in the docker build output.
+    """
+    instructions = []
+    current = ""
+    for line in dockerfile_content.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        if stripped.endswith("\\"):
+            current += f"{stripped[:-1].strip()} "
+            continue
+        instructions.append(f"{current}{stripped}")
+        current = ""
+    if current.strip():
+        instructions.append(current.strip())
+    return instructions
+
+
+def get_context_sources(dockerfile_content: str) -> List[str]:
+    """Returns the source paths of all ADD and COPY instructions of a
+    dockerfile which refer to the build context, i.e. neither to another
+    build stage nor to an url"""
+    sources = []
+    for instruction in split_dockerfile_instructions(dockerfile_content):
+        keyword, _, arguments = instruction.partition(" ")
+        if keyword.upper() not in ["ADD", "COPY"]:
+            continue
+        flags = []
+        arguments = arguments.strip()
+        while arguments.startswith("--"):
+            flag, _, arguments = arguments.partition(" ")
+            flags.append(flag)
+            arguments = arguments.strip()
+        if any(flag.startswith("--from") for flag in flags):
+            continue
+        if arguments.startswith("["):
+            tokens = json.loads(arguments)
+        else:
+            tokens = arguments.split()
+        for source in tokens[:-1]:
+            if "://" not in source and source not in sources:
+                sources.append(source)
+    return sources
+
+
+def get_context_files(
+    dockerfile_content: str, context_root: PathType
+) -> List[Path]:
+    """
+    Returns the sorted paths, relative to <context_root>, of all files
+    a dockerfile refers to. Wildcards and directories are expanded.
+
+    Raises
+    ------
+    ValueError
+        If a source of an ADD or COPY instruction does not exist
+    """
+    context_root = Path(context_root).resolve()
+    context_files = set()
+    for source in get_context_sources(dockerfile_content):
+        source = source.lstrip("/")
+        matches = [
+            path.resolve()
+            for path in (
+                context_root.glob(source)
+                if any(c in source for c in "*?[")
+                else [context_root / source]
+            )
+            if path.exists()
+        ]
+        if not matches:
+            raise ValueError(f"{source} does not exist in {context_root}")
+        for match in matches:
+            if not match.is_relative_to(context_root):
+                raise ValueError(f"{source} is outside of {context_root}")
+            if match.is_dir():
+                context_files.update(
+                    p.relative_to(context_root)
+                    for p in match.rglob("*")
+                    if p.is_file()
+                )
+            else:
+                context_files.add(match.relative_to(context_root))
+    return sorted(context_files)
+
+
+def add_to_tar(
+    tar: tarfile.TarFile, name: str, content: bytes, executable: bool
+) -> None:
+    """Adds a file to a tar archive with normalized metadata so that the
+    archive only depends on names and content of the files"""
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(content)
+    tarinfo.mode = 0o755 if executable else 0o644
+    tarinfo.mtime = 0
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    tar.addfile(tarinfo, io.BytesIO(content))
+
+
+def create_build_context(
+    dockerfile_content: str,
+    context_root: PathType,
+    cache_folder: Optional[PathType] = None,
+) -> Path:
+    """
+    Packs a dockerfile and the files it refers to in <context_root> into a
+    deterministic gzipped tarball and returns its path. The tarball is
+    cached in <cache_folder> under the checksum of its content, so that
+    it is created only once for identical inputs. If cache_folder is not
+    specified, DOCKER_BUILD_CONTEXT_FOLDER environment variable or
+    ~/.cache/kipoi-containers/build-contexts is used.
+    """
+    if cache_folder is None:
+        cache_folder = os.environ.get(
+            "DOCKER_BUILD_CONTEXT_FOLDER", DEFAULT_CONTEXT_CACHE_FOLDER
+        )
+    cache_folder = Path(cache_folder)
+    context_root = Path(context_root)
+    context_files = get_context_files(dockerfile_content, context_root)
+    entries = [
+        (CONTEXT_DOCKERFILE, dockerfile_content.encode("utf-8"), False)
+    ] + [
+        (
+            path.as_posix(),
+            (context_root / path).read_bytes(),
+            os.access(context_root / path, os.X_OK),
+        )
+        for path in context_files
+    ]
+    checksum = hashlib.sha256()
+    for name, content, executable in entries:
+        checksum.update(f"{name}:{len(content)}:{executable}:".encode("utf-8"))
+        checksum.update(content)
+    context_path = cache_folder / f"{checksum.hexdigest()}.tar.gz"
+    if context_path.exists():
+        return context_path
+    cache_folder.mkdir(parents=True, exist_ok=True)
+    # Builds of the same context from several threads or processes each
+    # write their own file, and the last one to finish replaces the others
+    with tempfile.NamedTemporaryFile(
+        dir=cache_folder, prefix=f"{context_path.name}.", delete=False
+    ) as file_handle:
+        tmp_path = Path(file_handle.name)
+        with gzip.GzipFile(
+            filename="", fileobj=file_handle, mode="wb", mtime=0
+        ) as gzip_file:
+            with tarfile.open(fileobj=gzip_file, mode="w") as tar:
+                for name, content, executable in entries:
+                    add_to_tar(tar, name, content, executable)
+    tmp_path.replace(context_path)
+    logger.info(
+        f"Created build context {context_path} with {len(entries)} files "
+        f"({context_path.stat().st_size / 1024:.1f} kB)"
+    )
+    return context_path
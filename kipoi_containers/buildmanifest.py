@@ -0,0 +1,173 @@
+import hashlib
+import os
+from pathlib import Path
+import threading
+from typing import List, Optional, Tuple, Union, TYPE_CHECKING
+
+import docker
+
+from kipoi_containers.dockerhelper import (
+    get_base_images,
+    get_conda_env_name_from_dockerfile,
+    get_lockfile_paths,
+)
+from kipoi_containers.containersession import get_session
+from kipoi_containers.helper import logger, populate_json, write_json
+
+if TYPE_CHECKING:
+    from github.Repository import Repository
+
+PathType = Union[str, Path]
+
+BUILD_MANIFEST_JSON = Path.cwd() / "container-info" / "build-manifest.json"
+KIPOI_ENVIRONMENT_FILE = Path.cwd() / "dockerfiles" / "environment.kipoi.yml"
+ENVFILES_FOLDER = Path.cwd() / "envfiles"
+# Files in kipoi model repo which do not have any effect on an image
+IGNORED_MODEL_FILE_SUFFIXES = [".md", ".rst", ".png", ".jpg", ".svg"]
+
+
+def get_model_group(model: str) -> str:
+    """Returns the model group a model belongs to. Models under MMSplice and
+    APARENT are split into separate model groups."""
+    model_components = model.split("/")
+    if model_components[0] in ["MMSplice", "APARENT"] and (
+        len(model_components) > 1
+    ):
+        return "/".join(model_components[:2])
+    return model_components[0]
+
+
+def get_model_group_tree(
+    kipoi_model_repo: "Repository", model_group: str, commit: str
+) -> List[Tuple[str, str]]:
+    """
+    Returns a sorted list of path and git blob sha of every file under
+    <model_group> in kipoi model repo at <commit>, leaving out
+    documentation and images. Since git blob shas are content addressed,
+    this changes if and only if the content of a relevant file changes.
+
+    Raises
+    ------
+    ValueError
+        If <model_group> does not exist in kipoi model repo at <commit>
+    """
+    parent = str(Path(model_group).parent)
+    contents = kipoi_model_repo.get_contents(
+        "" if parent == "." else parent, ref=commit
+    )
+    tree_sha = None
+    for content_file in contents:
+        if content_file.path == model_group and content_file.type == "dir":
+            tree_sha = content_file.sha
+    if tree_sha is None:
+        raise ValueError(f"{model_group} does not exist at {commit}")
+    tree = kipoi_model_repo.get_git_tree(tree_sha, recursive=True)
+    return sorted(
+        (f"{model_group}/{element.path}", element.sha)
+        for element in tree.tree
+        if element.type == "blob"
+        and Path(element.path).suffix.lower()
+        not in IGNORED_MODEL_FILE_SUFFIXES
+    )
+
+
+def get_base_image_digest(name_of_docker_image: str) -> Optional[str]:
+    """Returns the digest of a published docker image or None if it
+    can not be found"""
+    client = get_session().client
+    try:
+        return client.images.get_registry_data(name_of_docker_image).id
+    except docker.errors.APIError:
+        logger.info(f"Digest of {name_of_docker_image} is not available")
+        return None
+
+
+def compute_fingerprint(
+    dockerfile_path: PathType,
+    models: List[str],
+    kipoi_model_repo: "Repository",
+    commit: str,
+) -> Optional[str]:
+    """
+    Returns a sha256 checksum of everything that determines a docker image -
+    the dockerfile, dockerfiles/environment.kipoi.yml, envfiles/*.yml, the
+    lockfiles of the conda environment of the image, the files of the
+    model groups of <models> in kipoi model repo at <commit>
+    and the digests of the base images. None is returned if the digest of
+    a base image is not available.
+    """
+    checksum = hashlib.sha256()
+    input_files = [
+        Path(dockerfile_path),
+        KIPOI_ENVIRONMENT_FILE,
+    ] + sorted(ENVFILES_FOLDER.glob("*.yml"))
+    env_name = get_conda_env_name_from_dockerfile(
+        Path(dockerfile_path).read_text()
+    )
+    if env_name is not None:
+        input_files.extend(
+            p for p in get_lockfile_paths(env_name) if p.exists()
+        )
+    for input_file in input_files:
+        checksum.update(input_file.name.encode("utf-8"))
+        checksum.update(input_file.read_bytes())
+    for model_group in sorted({get_model_group(m) for m in models}):
+        for path, sha in get_model_group_tree(
+            kipoi_model_repo, model_group, commit
+        ):
+            checksum.update(f"{path}:{sha}".encode("utf-8"))
+    for base_image in get_base_images(dockerfile_path):
+        digest = get_base_image_digest(base_image)
+        if digest is None:
+            return None
+        checksum.update(f"{base_image}@{digest}".encode("utf-8"))
+    return checksum.hexdigest()
+
+
+class BuildManifest:
+    """This class keeps track of the fingerprints of the last published
+    docker images in a json file. It is safe to use from multiple threads,
+    for example by the updaters of a full and a slim image pushed at the
+    same time."""
+
+    def __init__(self, manifest_json: PathType = BUILD_MANIFEST_JSON) -> None:
+        """This function loads the manifest from <manifest_json> if it
+        exists"""
+        self.manifest_json = manifest_json
+        if Path(manifest_json).exists():
+            self.manifest = populate_json(manifest_json)
+        else:
+            self.manifest = {}
+        self._lock = threading.Lock()
+
+    def is_up_to_date(
+        self, name_of_docker_image: str, fingerprint: Optional[str]
+    ) -> bool:
+        """Returns True if the last published version of the docker image
+        has been built from the inputs with <fingerprint>"""
+        with self._lock:
+            entry = self.manifest.get(name_of_docker_image, {})
+        return (
+            fingerprint is not None and entry.get("fingerprint") == fingerprint
+        )
+
+    def record(
+        self,
+        name_of_docker_image: str,
+        fingerprint: Optional[str],
+        commit: str,
+    ) -> None:
+        """Records the fingerprint of a newly published docker image and
+        writes the manifest to the json file. The file is replaced at once,
+        so that it is never left half written."""
+        with self._lock:
+            if fingerprint is None:
+                self.manifest.pop(name_of_docker_image, None)
+            else:
+                self.manifest[name_of_docker_image] = {
+                    "fingerprint": fingerprint,
+                    "kipoi_model_repo_commit": commit,
+                }
+            tmp_json = Path(f"{self.manifest_json}.{os.getpid()}")
+            write_json(dict(sorted(self.manifest.items())), tmp_json)
+            tmp_json.replace(self.manifest_json)
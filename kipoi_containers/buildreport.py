@@ -0,0 +1,199 @@
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+import json
+from pathlib import Path
+import re
+import time
+from typing import Callable, Dict, List, Optional, Union
+
+import click
+
+from kipoi_containers.helper import logger
+
+PathType = Union[str, Path]
+
+LEGACY_STEP = re.compile(r"^Step (\d+)/\d+ : (.*)$")
+LEGACY_LAYER = re.compile(r"^ ---> ([0-9a-f]{12,64})$")
+BUILDKIT_STEP = re.compile(r"^#(\d+) \[(?!internal)[^\]]*?(\d+)/\d+\] (.*)$")
+BUILDKIT_DONE = re.compile(r"^#(\d+) DONE (\d+(?:\.\d+)?)s$")
+BUILDKIT_CACHED = re.compile(r"^#(\d+) CACHED$")
+
+
+@dataclass
+class BuildStep:
+    """Wall time in seconds, size of the resulting layer in bytes and
+    whether the layer has been taken from the cache for a single
+    dockerfile instruction"""
+
+    step: int
+    instruction: str
+    duration: float = 0.0
+    cached: bool = False
+    layer_size: Optional[int] = None
+
+
+@dataclass
+class BuildReport:
+    """Timing of a docker build broken down by dockerfile instruction"""
+
+    name_of_docker_image: str
+    dockerfile_path: str
+    started: str = field(
+        default_factory=lambda: datetime.now().isoformat(timespec="seconds")
+    )
+    duration: float = 0.0
+    steps: List[BuildStep] = field(default_factory=list)
+
+    def write(self, report_folder: PathType) -> Path:
+        """Writes the report as
+        <report_folder>/<tag>-<start time>.json and returns the path"""
+        report_folder = Path(report_folder)
+        report_folder.mkdir(parents=True, exist_ok=True)
+        tag = self.name_of_docker_image.split(":")[-1]
+        report_path = (
+            report_folder / f"{tag}-{self.started.replace(':', '')}.json"
+        )
+        with open(report_path, "w") as file_handle:
+            json.dump(asdict(self), file_handle, indent=4)
+        return report_path
+
+
+class LegacyBuildRecorder:
+    """This class turns the decoded output stream of the docker api build
+    endpoint into a BuildReport while the build is running. The layer
+    size of a step is the difference between the sizes of the images
+    produced by this and the previous step."""
+
+    def __init__(
+        self, report: BuildReport, get_image_size: Callable[[str], int]
+    ) -> None:
+        self.report = report
+        self.get_image_size = get_image_size
+        self.current_step = None
+        self.step_started = None
+        self.previous_size = 0
+        self.build_started = time.monotonic()
+
+    def finish_step(self, image_id: Optional[str]) -> None:
+        """Completes the current step with the image it produced"""
+        if self.current_step is None:
+            return
+        self.current_step.duration = round(
+            time.monotonic() - self.step_started, 3
+        )
+        if image_id is not None:
+            size = self.get_image_size(image_id)
+            self.current_step.layer_size = max(size - self.previous_size, 0)
+            self.previous_size = size
+        self.report.steps.append(self.current_step)
+        logger.info(
+            f"Step {self.current_step.step} took {self.current_step.duration}s"
+            f"{' (cached)' if self.current_step.cached else ''}"
+        )
+        self.current_step = None
+
+    def process_line(self, line: str) -> None:
+        """Updates the report with a single line of build output"""
+        step_match = LEGACY_STEP.match(line)
+        if step_match:
+            self.finish_step(None)
+            self.current_step = BuildStep(
+                step=int(step_match.group(1)),
+                instruction=step_match.group(2),
+            )
+            self.step_started = time.monotonic()
+            if self.current_step.instruction.upper().startswith("FROM "):
+                self.previous_size = 0
+            return
+        if self.current_step is None:
+            return
+        if line.strip() == "---> Using cache":
+            self.current_step.cached = True
+            return
+        layer_match = LEGACY_LAYER.match(line)
+        if layer_match:
+            self.finish_step(layer_match.group(1))
+
+    def process_chunk(self, chunk: Dict) -> None:
+        """Logs and records a chunk of the decoded build output stream"""
+        for line in chunk.get("stream", "").splitlines():
+            if line.strip():
+                logger.info(line)
+            self.process_line(line)
+
+    def close(self) -> BuildReport:
+        """Completes the report after the build has finished"""
+        self.finish_step(None)
+        self.report.duration = round(time.monotonic() - self.build_started, 3)
+        return self.report
+
+
+class BuildKitProgressRecorder:
+    """This class turns the plain progress output of docker buildx build into
+    a BuildReport. BuildKit does not report layer sizes."""
+
+    def __init__(self, report: BuildReport) -> None:
+        self.report = report
+        self.steps = {}
+        self.build_started = time.monotonic()
+
+    def process_line(self, line: str) -> None:
+        """Updates the report with a single line of build output"""
+        line = line.rstrip()
+        step_match = BUILDKIT_STEP.match(line)
+        if step_match:
+            self.steps[step_match.group(1)] = BuildStep(
+                step=int(step_match.group(2)),
+                instruction=step_match.group(3),
+            )
+            return
+        cached_match = BUILDKIT_CACHED.match(line)
+        if cached_match and cached_match.group(1) in self.steps:
+            self.steps[cached_match.group(1)].cached = True
+            return
+        done_match = BUILDKIT_DONE.match(line)
+        if done_match and done_match.group(1) in self.steps:
+            self.steps[done_match.group(1)].duration = float(
+                done_match.group(2)
+            )
+
+    def close(self) -> BuildReport:
+        """Completes the report after the build has finished"""
+        self.report.steps = list(self.steps.values())
+        self.report.duration = round(time.monotonic() - self.build_started, 3)
+        return self.report
+
+
+def summarize_build_reports(
+    report_folder: PathType, top: int = 10
+) -> List[Dict]:
+    """Returns the <top> slowest steps across all build reports in
+    <report_folder> together with the image they belong to"""
+    steps = []
+    for report_path in sorted(Path(report_folder).glob("*.json")):
+        with open(report_path, "r") as file_handle:
+            report = json.load(file_handle)
+        for step in report["steps"]:
+            steps.append(
+                {"name_of_docker_image": report["name_of_docker_image"]} | step
+            )
+    return sorted(steps, key=lambda s: s["duration"], reverse=True)[:top]
+
+
+@click.command()
+@click.argument("report_folder", required=True, type=click.Path(exists=True))
+@click.option("--top", default=10, show_default=True, type=int)
+def run_summary(report_folder: str, top: int) -> None:
+    """Print the slowest dockerfile instructions across all build
+    reports in REPORT_FOLDER"""
+    for step in summarize_build_reports(report_folder, top):
+        click.echo(
+            f"{step['duration']:>10.1f}s "
+            f"{'cached' if step['cached'] else 'built ':<7}"
+            f"{step['name_of_docker_image']} step {step['step']}: "
+            f"{step['instruction'][:80]}"
+        )
+
+
+if __name__ == "__main__":
+    run_summary()
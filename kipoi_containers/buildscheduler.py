@@ -0,0 +1,332 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+import os
+from pathlib import Path
+import shutil
+from typing import Callable, Dict, List, Optional, Union
+
+import click
+
+from kipoi_containers.dockerhelper import (
+    build_docker_image,
+    get_base_images,
+    test_docker_image,
+    push_docker_image,
+)
+from kipoi_containers.helper import (
+    logger,
+    one_model_per_modelgroup,
+    populate_json,
+)
+from kipoi_containers.updateoradd import DOCKER_TO_MODEL_JSON
+
+DOCKERFILE_FOLDER = Path.cwd() / "dockerfiles"
+IMAGE_REPOSITORY = "kipoi/kipoi-docker"
+
+PathType = Union[str, Path]
+
+
+@dataclass(frozen=True)
+class BuildResources:
+    """Number of cpus, memory in GB and disk space in GB which are
+    either available to or required by docker builds"""
+
+    cpus: float
+    memory: float
+    disk: float
+
+    def fits(self, required: "BuildResources") -> bool:
+        """Returns True if <required> fits into this budget"""
+        return (
+            required.cpus <= self.cpus
+            and required.memory <= self.memory
+            and required.disk <= self.disk
+        )
+
+    def __add__(self, other: "BuildResources") -> "BuildResources":
+        return BuildResources(
+            self.cpus + other.cpus,
+            self.memory + other.memory,
+            self.disk + other.disk,
+        )
+
+    def __sub__(self, other: "BuildResources") -> "BuildResources":
+        return BuildResources(
+            self.cpus - other.cpus,
+            self.memory - other.memory,
+            self.disk - other.disk,
+        )
+
+
+DEFAULT_BUILD_REQUIREMENT = BuildResources(cpus=2, memory=4, disk=15)
+
+
+@dataclass
+class BuildJob:
+    """A docker image to be built, tested and pushed"""
+
+    name_of_docker_image: str
+    dockerfile_path: Path
+    dependencies: List[str] = field(default_factory=list)
+    models_to_test: List[str] = field(default_factory=list)
+    push: bool = False
+    requirement: BuildResources = DEFAULT_BUILD_REQUIREMENT
+
+
+def get_build_graph(
+    dockerfile_folder: PathType = DOCKERFILE_FOLDER,
+) -> Dict[str, List[str]]:
+    """Returns a dict mapping every image that can be built with
+    <dockerfile_folder>/Dockerfile.<tag> to the images built in this
+    repository it is based upon"""
+    dockerfiles = {
+        f"{IMAGE_REPOSITORY}:{path.name.replace('Dockerfile.', '', 1)}": path
+        for path in sorted(Path(dockerfile_folder).glob("Dockerfile.*"))
+        if path.suffix != ".template"
+    }
+    return {
+        image: [
+            base_image
+            for base_image in get_base_images(dockerfile_path)
+            if base_image in dockerfiles
+        ]
+        for image, dockerfile_path in dockerfiles.items()
+    }
+
+
+def get_models_to_test(
+    name_of_docker_image: str, docker_to_model_dict: Dict
+) -> List[str]:
+    """Returns the models a docker image is tested with. Shared images are
+    tested with one model per model group"""
+    models = docker_to_model_dict.get(
+        name_of_docker_image.replace("-slim", ""), []
+    )
+    if "shared" in name_of_docker_image:
+        return one_model_per_modelgroup(models)
+    return models
+
+
+class BuildScheduler:
+    """This class builds, tests and pushes docker images concurrently while
+    respecting the dependencies between them and a resource budget. Each
+    image is built at most once per run."""
+
+    def __init__(
+        self,
+        budget: BuildResources,
+        dockerfile_folder: PathType = DOCKERFILE_FOLDER,
+        requirements: Optional[Dict[str, BuildResources]] = None,
+        build: Callable = build_docker_image,
+        test: Callable = test_docker_image,
+        push: Callable = push_docker_image,
+    ) -> None:
+        """
+        This function instantiates BuildScheduler with the resources available
+        to all builds combined, the folder containing the dockerfiles and the
+        resources each image requires to be built. The build, test and push
+        hooks default to the ones in dockerhelper.
+        """
+        self.budget = budget
+        self.dockerfile_folder = Path(dockerfile_folder)
+        self.build_graph = get_build_graph(self.dockerfile_folder)
+        self.requirements = requirements if requirements else {}
+        self.build = build
+        self.test = test
+        self.push = push
+
+    def get_build_jobs(
+        self,
+        images: List[str],
+        models_to_test: Dict[str, List[str]],
+        push: bool,
+    ) -> Dict[str, BuildJob]:
+        """
+        Returns the build jobs for <images> and every image they depend on.
+        Dependencies that have not been asked for are built only.
+
+        Raises
+        ------
+        ValueError
+            If there is no dockerfile for an image or the dependencies
+            are cyclic
+        """
+        jobs = {}
+        to_visit = list(images)
+        while to_visit:
+            image = to_visit.pop()
+            if image in jobs:
+                continue
+            if image not in self.build_graph:
+                raise ValueError(f"There is no dockerfile for {image}")
+            requested = image in images
+            jobs[image] = BuildJob(
+                name_of_docker_image=image,
+                dockerfile_path=self.dockerfile_folder
+                / f"Dockerfile.{image.split(':')[1]}",
+                dependencies=self.build_graph[image],
+                models_to_test=(
+                    models_to_test.get(image, []) if requested else []
+                ),
+                push=push and requested,
+                requirement=self.requirements.get(
+                    image, DEFAULT_BUILD_REQUIREMENT
+                ),
+            )
+            to_visit.extend(self.build_graph[image])
+        self.check_acyclic(jobs)
+        return jobs
+
+    @staticmethod
+    def check_acyclic(jobs: Dict[str, BuildJob]) -> None:
+        """Raises ValueError if the dependencies between jobs are cyclic"""
+        resolved = set()
+        remaining = dict(jobs)
+        while remaining:
+            ready = [
+                image
+                for image, job in remaining.items()
+                if all(d in resolved for d in job.dependencies)
+            ]
+            if not ready:
+                raise ValueError(
+                    f"Cyclic dependencies between {sorted(remaining)}"
+                )
+            for image in ready:
+                resolved.add(image)
+                remaining.pop(image)
+
+    def run_job(self, job: BuildJob) -> None:
+        """Builds a docker image, tests it with all its models and pushes it
+        if required"""
+        logger.info(
+            f"Building {job.name_of_docker_image} with {job.dockerfile_path}"
+        )
+        self.build(
+            dockerfile_path=job.dockerfile_path,
+            name_of_docker_image=job.name_of_docker_image,
+        )
+        for model in job.models_to_test:
+            self.test(image_name=job.name_of_docker_image, model_name=model)
+        if job.push:
+            self.push(tag=job.name_of_docker_image.split(":")[1])
+
+    def run(
+        self,
+        images: List[str],
+        models_to_test: Optional[Dict[str, List[str]]] = None,
+        push: bool = False,
+    ) -> Dict[str, str]:
+        """
+        Builds, tests and optionally pushes <images>. A job starts as soon as
+        all the images it depends on have been built and enough resources are
+        free. A job which alone exceeds the budget runs when no other job is
+        running. Returns a dict mapping each image to "success", "failed"
+        or "skipped" if an image it depends on could not be built.
+        """
+        jobs = self.get_build_jobs(
+            images, models_to_test if models_to_test else {}, push
+        )
+        status = {}
+        available = self.budget
+        running = {}
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            while len(status) < len(jobs):
+                for image, job in sorted(jobs.items()):
+                    if image in status or image in running.values():
+                        continue
+                    if any(
+                        status.get(d) in ["failed", "skipped"]
+                        for d in job.dependencies
+                    ):
+                        logger.error(
+                            f"Skipping {image} since its base image could not be built"
+                        )
+                        status[image] = "skipped"
+                        continue
+                    if not all(
+                        status.get(d) == "success" for d in job.dependencies
+                    ):
+                        continue
+                    if available.fits(job.requirement) or not running:
+                        available = available - job.requirement
+                        running[executor.submit(self.run_job, job)] = image
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    image = running.pop(future)
+                    available = available + jobs[image].requirement
+                    if future.exception() is not None:
+                        logger.error(
+                            f"{image} could not be built, tested or pushed: {future.exception()}"
+                        )
+                        status[image] = "failed"
+                    else:
+                        status[image] = "success"
+        return status
+
+
+@click.command()
+@click.argument("images", nargs=-1, type=str)
+@click.option(
+    "--max-cpus",
+    type=float,
+    default=os.cpu_count(),
+    show_default=True,
+    help="Number of cpus available to all builds combined",
+)
+@click.option(
+    "--max-memory",
+    type=float,
+    default=os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1e9,
+    show_default=True,
+    help="Memory in GB available to all builds combined",
+)
+@click.option(
+    "--max-disk",
+    type=float,
+    default=shutil.disk_usage(Path.cwd()).free / 1e9,
+    show_default=True,
+    help="Disk space in GB available to all builds combined",
+)
+@click.option("--test/--no-test", default=True, show_default=True)
+@click.option("--push/--no-push", default=False, show_default=True)
+def run_build(
+    images: List[str],
+    max_cpus: float,
+    max_memory: float,
+    max_disk: float,
+    test: bool,
+    push: bool,
+) -> None:
+    """Build, test and optionally push the given docker images, or all
+    images if none is given, as concurrently as the dependencies between
+    them and the resource budget allow. For example -
+    build_images kipoi/kipoi-docker:deepmel kipoi/kipoi-docker:deepmel-slim
+    """
+    scheduler = BuildScheduler(
+        budget=BuildResources(cpus=max_cpus, memory=max_memory, disk=max_disk)
+    )
+    if not images:
+        images = [
+            image
+            for image in scheduler.build_graph
+            if "kipoi-base-env" not in image
+        ]
+    models_to_test = {}
+    if test:
+        docker_to_model_dict = populate_json(DOCKER_TO_MODEL_JSON)
+        models_to_test = {
+            image: get_models_to_test(image, docker_to_model_dict)
+            for image in images
+        }
+    status = scheduler.run(list(images), models_to_test, push=push)
+    for image, image_status in sorted(status.items()):
+        click.echo(f"{image}: {image_status}")
+    if any(s != "success" for s in status.values()):
+        raise click.ClickException("Not all images could be built")
+
+
+if __name__ == "__main__":
+    run_build()
@@ -0,0 +1,229 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Union
+
+import docker
+
+from kipoi_containers.containersession import ContainerSession
+from kipoi_containers.dockerhelper import (
+    classify_failure,
+    test_docker_image_cancellable,
+)
+from kipoi_containers.helper import logger, populate_json
+
+PathType = Union[str, Path]
+
+# In the order they are preferred in if nothing else sets them apart
+SHARED_SLIM_IMAGES = [
+    "kipoi/kipoi-docker:sharedpy3keras2tf1-slim",
+    "kipoi/kipoi-docker:sharedpy3keras2tf2-slim",
+    "kipoi/kipoi-docker:sharedpy3keras1.2-slim",
+]
+IMAGE_SIZE_HISTORY_JSON = (
+    Path.cwd() / "container-info" / "image-size-history.json"
+)
+RANK_BY_SIZE = "size"
+RANK_BY_DURATION = "duration"
+
+
+@dataclass
+class ProbeResult:
+    """Outcome of testing a new model group with an existing image. error
+    is set if the image could not be tested at all, for example because it
+    is missing or the docker api has failed, which says nothing about its
+    compatibility."""
+
+    name_of_docker_image: str
+    passed: bool
+    duration: float
+    cancelled: bool = False
+    error: Optional[str] = None
+
+
+def get_image_sizes(
+    images: List[str],
+    image_size_history_json: PathType = IMAGE_SIZE_HISTORY_JSON,
+) -> Dict[str, int]:
+    """Returns a dict mapping those of <images> which have been measured by
+    image_analytics to their latest compressed size, or uncompressed size
+    if the compressed one is unknown"""
+    if not Path(image_size_history_json).exists():
+        return {}
+    history = populate_json(image_size_history_json)
+    sizes = {}
+    for image in images:
+        if history.get(image):
+            latest = history[image][-1]
+            sizes[image] = latest["compressed_size"] or latest["size"]
+    return sizes
+
+
+def rank_images(
+    images: List[str],
+    rank_by: str = RANK_BY_SIZE,
+    image_sizes: Optional[Dict[str, int]] = None,
+) -> List[str]:
+    """
+    Returns <images> with the preferred one first. Ranked by size, the
+    smallest measured image comes first and unmeasured images follow in
+    their given order. Ranked by duration, the given order is kept as the
+    winner is simply the first image to pass.
+
+    Raises:
+        ValueError: If <rank_by> is neither size nor duration
+    """
+    if rank_by == RANK_BY_DURATION:
+        return list(images)
+    if rank_by != RANK_BY_SIZE:
+        raise ValueError(
+            f"Cannot rank images by {rank_by}. Choose {RANK_BY_SIZE} or "
+            f"{RANK_BY_DURATION}"
+        )
+    if image_sizes is None:
+        image_sizes = get_image_sizes(images)
+    return sorted(
+        images,
+        key=lambda image: (
+            image not in image_sizes,
+            image_sizes.get(image, 0),
+        ),
+    )
+
+
+def probe_image(
+    name_of_docker_image: str,
+    models: List[str],
+    session: Optional[ContainerSession] = None,
+    cancelled: Optional[threading.Event] = None,
+) -> ProbeResult:
+    """Tests <models> one after another with <name_of_docker_image> until
+    one of them passes, which makes the model group compatible with the
+    image. Testing stops as soon as <cancelled> is set or the image can not
+    be tested at all."""
+    cancelled = cancelled if cancelled else threading.Event()
+    start = time.monotonic()
+    passed = False
+    error = None
+    for model in models:
+        if cancelled.is_set():
+            break
+        try:
+            test_docker_image_cancellable(
+                image_name=name_of_docker_image,
+                model_name=model,
+                session=session,
+                cancelled=cancelled,
+            )
+        except docker.errors.ContainerError:
+            continue
+        except docker.errors.APIError as e:
+            error = classify_failure(e)
+            logger.error(f"Could not probe {name_of_docker_image}: {e}")
+            break
+        passed = True
+        break
+    return ProbeResult(
+        name_of_docker_image,
+        passed,
+        round(time.monotonic() - start, 3),
+        cancelled=cancelled.is_set() and not passed and error is None,
+        error=error,
+    )
+
+
+def find_compatible_image(
+    models: List[str],
+    images: List[str] = SHARED_SLIM_IMAGES,
+    session: Optional[ContainerSession] = None,
+    rank_by: Optional[str] = None,
+    known_results: Optional[Dict[str, ProbeResult]] = None,
+    on_result: Optional[Callable[[ProbeResult], None]] = None,
+) -> Optional[str]:
+    """
+    Probes all <images> concurrently with <models> of a new model group and
+    returns the best ranked compatible image or None if there is none. The
+    ranking is by smallest image or by fastest probe, as given by <rank_by>
+    or DOCKER_COMPATIBILITY_RANKING environment variable, and defaults to
+    size. An image wins once it has passed and every image ranked before
+    it has failed. The probes of the other images are then cancelled, so
+    that the answer takes as long as the winning probe. Images with
+    <known_results>, for example from an earlier sync, are not probed
+    again. <on_result> is called with the result of every probe.
+
+    Raises:
+        ValueError: If <rank_by> is neither size nor duration
+    """
+    if rank_by is None:
+        rank_by = os.environ.get("DOCKER_COMPATIBILITY_RANKING", RANK_BY_SIZE)
+    ranked_images = rank_images(images, rank_by)
+    results = {
+        image: result
+        for image, result in (known_results or {}).items()
+        if image in ranked_images
+    }
+    known_images = set(results)
+
+    def get_winner() -> Optional[str]:
+        if rank_by == RANK_BY_DURATION:
+            passed = [r for r in results.values() if r.passed]
+            if not passed:
+                return None
+            return min(passed, key=lambda r: r.duration).name_of_docker_image
+        for image in ranked_images:
+            if image not in results:
+                return None
+            if results[image].passed:
+                return image
+        return None
+
+    winner = get_winner()
+    images_to_probe = (
+        [image for image in ranked_images if image not in results]
+        if winner is None
+        else []
+    )
+    cancel_events = {image: threading.Event() for image in images_to_probe}
+    with ThreadPoolExecutor(
+        max_workers=max(1, len(images_to_probe))
+    ) as executor:
+        running = {
+            executor.submit(
+                probe_image, image, models, session, cancel_events[image]
+            ): image
+            for image in images_to_probe
+        }
+        while running and winner is None:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+            winner = get_winner()
+        for event in cancel_events.values():
+            event.set()
+        for future, image in running.items():
+            results[image] = future.result()
+    for image in ranked_images:
+        if image not in results:
+            continue
+        result = results[image]
+        if image in known_images:
+            outcome = "passed" if result.passed else "failed"
+            logger.info(f"{image} has {outcome} before. Not probing it again")
+            continue
+        if on_result is not None:
+            on_result(result)
+        if result.error is not None:
+            outcome = f"errored ({result.error})"
+        elif result.cancelled:
+            outcome = "cancelled"
+        else:
+            outcome = "passed" if result.passed else "failed"
+        logger.info(
+            f"Probe of {image} has {outcome} after {result.duration:.0f}s"
+        )
+    if winner is not None:
+        logger.info(f"{winner} is compatible with {models}")
+    return winner
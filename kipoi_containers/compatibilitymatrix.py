@@ -0,0 +1,120 @@
+import hashlib
+import os
+from pathlib import Path
+import threading
+from typing import Optional, Union, TYPE_CHECKING
+
+from kipoi_containers.buildmanifest import get_model_group_tree
+from kipoi_containers.compatibility import ProbeResult
+from kipoi_containers.helper import populate_json, write_json
+
+if TYPE_CHECKING:
+    from github.Repository import Repository
+
+PathType = Union[str, Path]
+
+COMPATIBILITY_MATRIX_JSON = (
+    Path.cwd() / "container-info" / "compatibility-matrix.json"
+)
+
+
+def get_model_group_fingerprint(
+    kipoi_model_repo: "Repository", model_group: str, commit: str
+) -> str:
+    """
+    Returns a sha256 checksum of the files of <model_group> in kipoi model
+    repo at <commit>, which changes if and only if one of them changes.
+
+    Raises
+    ------
+    ValueError
+        If <model_group> does not exist in kipoi model repo at <commit>
+    """
+    checksum = hashlib.sha256()
+    for path, sha in get_model_group_tree(
+        kipoi_model_repo, model_group, commit
+    ):
+        checksum.update(f"{path}:{sha}".encode("utf-8"))
+    return checksum.hexdigest()
+
+
+class CompatibilityMatrix:
+    """This class keeps the outcome of every compatibility probe of a model
+    group with a shared image in a json file, together with the digest of
+    the image and the fingerprint of the files of the model group it has
+    been measured with. A recorded outcome stays valid until either of
+    them changes, so that a probe is not repeated after a failed sync. It
+    is safe to use from multiple threads."""
+
+    def __init__(self, matrix_json: Optional[PathType] = None) -> None:
+        """This function loads the matrix from <matrix_json>, which
+        defaults to DOCKER_COMPATIBILITY_MATRIX environment variable or
+        container-info/compatibility-matrix.json, if it exists"""
+        if matrix_json is None:
+            matrix_json = os.environ.get(
+                "DOCKER_COMPATIBILITY_MATRIX", COMPATIBILITY_MATRIX_JSON
+            )
+        self.matrix_json = matrix_json
+        if Path(matrix_json).exists():
+            self.matrix = populate_json(matrix_json)
+        else:
+            self.matrix = {}
+        self._lock = threading.Lock()
+
+    def lookup(
+        self,
+        model_group: str,
+        name_of_docker_image: str,
+        image_digest: Optional[str],
+        model_group_fingerprint: Optional[str],
+    ) -> Optional[ProbeResult]:
+        """Returns the recorded outcome of probing <model_group> with
+        <name_of_docker_image> or None if there is none for this digest of
+        the image and this fingerprint of the model group"""
+        if image_digest is None or model_group_fingerprint is None:
+            return None
+        with self._lock:
+            entry = self.matrix.get(model_group, {}).get(name_of_docker_image)
+        if (
+            entry is None
+            or entry["image_digest"] != image_digest
+            or entry["model_group_fingerprint"] != model_group_fingerprint
+        ):
+            return None
+        return ProbeResult(
+            name_of_docker_image, entry["passed"], entry["duration"]
+        )
+
+    def record(
+        self,
+        model_group: str,
+        result: ProbeResult,
+        image_digest: Optional[str],
+        model_group_fingerprint: Optional[str],
+        commit: str,
+    ) -> None:
+        """Records the outcome of a probe, unless it has been cancelled, has
+        not been able to test the image or the digest of the image is
+        unknown, and writes the matrix to the json file"""
+        if (
+            result.cancelled
+            or result.error is not None
+            or image_digest is None
+            or model_group_fingerprint is None
+        ):
+            return
+        with self._lock:
+            self.matrix.setdefault(model_group, {})[
+                result.name_of_docker_image
+            ] = {
+                "passed": result.passed,
+                "duration": result.duration,
+                "image_digest": image_digest,
+                "model_group_fingerprint": model_group_fingerprint,
+                "kipoi_model_repo_commit": commit,
+            }
+            self.matrix[model_group] = dict(
+                sorted(self.matrix[model_group].items())
+            )
+            Path(self.matrix_json).parent.mkdir(parents=True, exist_ok=True)
+            write_json(dict(sorted(self.matrix.items())), self.matrix_json)
@@ -0,0 +1,114 @@
+from pathlib import Path
+import shlex
+from typing import List, Union
+
+import click
+
+from kipoi_containers.containersession import get_session
+from kipoi_containers.helper import logger, populate_json
+from kipoi_containers.updateoradd import DOCKER_TO_MODEL_JSON
+
+PathType = Union[str, Path]
+
+PREFETCH_IMAGE = "kipoi/kipoi-docker:kipoi-base-env"
+ENVFILES_FOLDER = Path.cwd() / "envfiles"
+# Copies every downloaded package into the subdir of the channel it
+# belongs to, as recorded in info/index.json of the extracted package
+ORGANIZE_PACKAGES = """
+import glob, json, os, shutil
+for index_json in glob.glob("/channel/.pkgs/*/info/index.json"):
+    package = os.path.dirname(os.path.dirname(index_json))
+    with open(index_json) as file_handle:
+        subdir = os.path.join("/channel", json.load(file_handle)["subdir"])
+    os.makedirs(subdir, exist_ok=True)
+    for extension in [".conda", ".tar.bz2"]:
+        if os.path.exists(package + extension):
+            shutil.copy(package + extension, subdir)
+"""
+
+
+def get_prefetch_script(models: List[str], envfiles: List[str]) -> str:
+    """Returns the shell script which downloads the conda packages of
+    <models> and of the conda environment files <envfiles>, relative to
+    envfiles folder, and turns them into a conda channel in /channel"""
+    commands = ["set -e", "export CONDA_PKGS_DIRS=/channel/.pkgs"]
+    for model in models:
+        commands.append(
+            f"conda run -n kipoi-env kipoi env create {shlex.quote(model)} "
+            "--source=kipoi"
+        )
+    for envfile in envfiles:
+        commands.append(
+            f"conda env create -p /tmp/prefetch-env "
+            f"-f /envfiles/{shlex.quote(envfile)} && rm -rf /tmp/prefetch-env"
+        )
+    commands.extend(
+        [
+            f"python -c {shlex.quote(ORGANIZE_PACKAGES)}",
+            "conda install -n base -y -c conda-forge conda-index",
+            "python -m conda_index /channel",
+        ]
+    )
+    return "\n".join(commands)
+
+
+def prefetch_conda_channel(
+    channel_folder: PathType,
+    models: List[str],
+    envfiles_folder: PathType = ENVFILES_FOLDER,
+) -> None:
+    """
+    This function creates the conda environments of <models> and of all
+    conda environment files in <envfiles_folder> inside a container of
+    kipoi/kipoi-docker:kipoi-base-env and indexes every package they need
+    as a local conda channel in <channel_folder>. The packages downloaded
+    by previous runs are kept in <channel_folder>/.pkgs and are not
+    downloaded again.
+
+    Raises:
+        docker.errors.ContainerError: If a conda environment can not be
+            created or the channel can not be indexed
+        docker.errors.APIError: If there is an issue connecting to the docker api
+    """
+    channel_folder = Path(channel_folder).resolve()
+    channel_folder.mkdir(parents=True, exist_ok=True)
+    envfiles_folder = Path(envfiles_folder).resolve()
+    envfiles = sorted(p.name for p in envfiles_folder.glob("*.yml"))
+    logger.info(
+        f"Prefetching conda packages of {len(models)} models and "
+        f"{len(envfiles)} environment files into {channel_folder}"
+    )
+    client = get_session().client
+    container_log = client.containers.run(
+        image=PREFETCH_IMAGE,
+        command=["/bin/bash", "-c", get_prefetch_script(models, envfiles)],
+        volumes={
+            str(channel_folder): {"bind": "/channel", "mode": "rw"},
+            str(envfiles_folder): {"bind": "/envfiles", "mode": "ro"},
+        },
+        remove=True,
+    )
+    logger.info(container_log.decode("utf-8"))
+
+
+@click.command()
+@click.argument("channel_folder", required=True, type=click.Path())
+@click.argument("models", nargs=-1, type=str)
+def run_prefetch(channel_folder: str, models: List[str]) -> None:
+    """Download the conda packages of the given models, or of one model
+    per docker image if none is given, and of the shared environments in
+    envfiles into a local conda channel in CHANNEL_FOLDER. Builds with
+    DOCKER_BUILD_CONDA_CHANNEL=CHANNEL_FOLDER resolve against it first."""
+    if not models:
+        models = [
+            image_models[0]
+            for image, image_models in populate_json(
+                DOCKER_TO_MODEL_JSON
+            ).items()
+            if "shared" not in image and image_models
+        ]
+    prefetch_conda_channel(channel_folder, list(models))
+
+
+if __name__ == "__main__":
+    run_prefetch()
@@ -0,0 +1,110 @@
+import threading
+from typing import Dict, Optional
+import uuid
+
+import docker
+
+from kipoi_containers.helper import logger
+
+DEFAULT_MAX_POOL_SIZE = 32
+RUN_LABEL = "org.kipoi.containers.run"
+
+
+class ContainerSession:
+    """This class owns a single docker client, whose connection pool and
+    negotiated api version are shared by all docker operations, and
+    caches image inspections. Every container it creates for testing
+    carries a label with the id of this session, so that its resources
+    can be cleaned up without touching anything else on the docker host.
+    It is safe to use from multiple threads."""
+
+    def __init__(self, max_pool_size: int = DEFAULT_MAX_POOL_SIZE) -> None:
+        """
+        This function instantiates ContainerSession with the maximum number
+        of connections to the docker daemon kept open, which should be at
+        least the number of threads using this session. The client is
+        created on first use.
+        """
+        self.max_pool_size = max_pool_size
+        self.run_id = uuid.uuid4().hex[:12]
+        self._client = None
+        self._lock = threading.Lock()
+        self._image_inspections = {}
+
+    @property
+    def client(self) -> docker.DockerClient:
+        """The docker client of this session"""
+        with self._lock:
+            if self._client is None:
+                self._client = docker.from_env(
+                    version="auto", max_pool_size=self.max_pool_size
+                )
+                logger.debug(
+                    "Connected to docker api version "
+                    f"{self._client.api.api_version}"
+                )
+            return self._client
+
+    @property
+    def connected(self) -> bool:
+        """Whether the client of this session has been created"""
+        return self._client is not None
+
+    @property
+    def labels(self) -> Dict[str, str]:
+        """The labels of the containers created by this session"""
+        return {RUN_LABEL: self.run_id}
+
+    @property
+    def label_filter(self) -> str:
+        """The docker filter selecting resources labelled by this session"""
+        return f"{RUN_LABEL}={self.run_id}"
+
+    def inspect_image(self, name_of_docker_image: str) -> Dict:
+        """
+        Returns the inspection of a local docker image, which is cached
+        until the image is invalidated.
+
+        Raises:
+            docker.errors.ImageNotFound: If the image is not available locally
+            docker.errors.APIError: If there is an issue connecting to the docker api
+        """
+        with self._lock:
+            if name_of_docker_image in self._image_inspections:
+                return self._image_inspections[name_of_docker_image]
+        inspection = self.client.api.inspect_image(name_of_docker_image)
+        with self._lock:
+            self._image_inspections[name_of_docker_image] = inspection
+        return inspection
+
+    def invalidate(self, name_of_docker_image: Optional[str] = None) -> None:
+        """Drops the cached inspection of an image, for example after it has
+        been rebuilt or pulled, or of all images if none is given"""
+        with self._lock:
+            if name_of_docker_image is None:
+                self._image_inspections.clear()
+            else:
+                self._image_inspections.pop(name_of_docker_image, None)
+
+    def close(self) -> None:
+        """Closes the connections of the client and drops all cached
+        inspections. The session can be used again afterwards."""
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+            self._image_inspections.clear()
+
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def get_session() -> ContainerSession:
+    """Returns the session shared by all docker operations which are not
+    given a session explicitly"""
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = ContainerSession()
+        return _default_session
@@ -1,20 +1,44 @@
 import csv
 import json
+import os
 from pathlib import Path
 import subprocess
-from typing import Dict, List, TYPE_CHECKING
+from typing import Callable, Dict, List, Optional, Union, TYPE_CHECKING
 
 import pandas as pd
 from ruamel.yaml.scalarstring import DoubleQuotedScalarString
 
+from kipoi_containers.buildmanifest import get_base_image_digest
+from kipoi_containers.containersession import ContainerSession, get_session
+from kipoi_containers.compatibility import (
+    SHARED_SLIM_IMAGES,
+    find_compatible_image,
+)
+from kipoi_containers.compatibilitymatrix import (
+    CompatibilityMatrix,
+    get_model_group_fingerprint,
+)
 from kipoi_containers.dockerhelper import (
     build_docker_image,
+    build_slim_docker_image_from_full,
     cleanup,
-    test_docker_image,
-    test_docker_image_without_exception,
+    export_lockfile,
+    get_conda_env_name_from_dockerfile,
+    get_dependency_hash_path,
     push_docker_image,
 )
+from kipoi_containers.envresolver import (
+    get_dependency_fingerprint,
+    get_model_group_dependencies,
+    rule_out_conflicting_images,
+)
 from kipoi_containers.helper import populate_yaml, write_yaml
+from kipoi_containers.pipeline import (
+    Stage,
+    raise_for_failed_stages,
+    run_stages,
+)
+from kipoi_containers.testrunner import get_resource_budget, run_model_tests
 
 if TYPE_CHECKING:
     from github.Repository import Repository
@@ -26,17 +50,47 @@ class DockerAdder:
         model_group: str,
         kipoi_model_repo: "Repository",
         kipoi_container_repo: "Repository",
+        build_cache_folder: Optional[Union[str, Path]] = None,
+        slim_from_full: Optional[bool] = None,
+        session: Optional[ContainerSession] = None,
+        model_repo_commit: Optional[str] = None,
+        compatibility_matrix: Optional[CompatibilityMatrix] = None,
     ) -> None:
         """
         This function instantiates DockerAdder class with model group to
-        add, kipoi model repo and this repository
+        add, kipoi model repo at <model_repo_commit>, which defaults to the
+        head of its default branch, and this repository. The images are built
+        with BuildKit using a layer cache in build_cache_folder, or in
+        DOCKER_BUILD_CACHE_FOLDER environment variable, if specified.
+        If slim_from_full or DOCKER_BUILD_SLIM_FROM_FULL environment
+        variable is set, the slim image is built by copying the conda
+        environment out of the full image instead of creating it again.
+        All docker operations go through <session>, or the shared session
+        if none is given. Outcomes of compatibility probes are looked up in
+        and recorded to <compatibility_matrix>, or the one in
+        container-info/compatibility-matrix.json if none is given.
         """
+        if build_cache_folder is None:
+            build_cache_folder = os.environ.get("DOCKER_BUILD_CACHE_FOLDER")
+        self.build_cache_folder = build_cache_folder
+        if slim_from_full is None:
+            slim_from_full = os.environ.get(
+                "DOCKER_BUILD_SLIM_FROM_FULL", ""
+            ).lower() in ["1", "true", "yes"]
+        self.slim_from_full = slim_from_full
+        self.session = session if session else get_session()
         self.kipoi_model_repo = kipoi_model_repo
         self.kipoi_container_repo = kipoi_container_repo
         self.model_group = model_group
         self.image_name = f"kipoi/kipoi-docker:{self.model_group.lower()}"
         self.slim_image = f"{self.image_name}-slim"
         self.list_of_models = []
+        self.model_repo_commit = model_repo_commit
+        self.compatibility_matrix = (
+            compatibility_matrix
+            if compatibility_matrix is not None
+            else CompatibilityMatrix()
+        )
 
     def update_content(
         self,
@@ -122,33 +176,191 @@ class DockerAdder:
         with existng shared images -
         "kipoi/kipoi-docker:sharedpy3keras2tf1-slim",
         "kipoi/kipoi-docker:sharedpy3keras2tf2-slim"
-        and "kipoi/kipoi-docker:sharedpy3keras1.2-slim". If it is found
-        to be compatible, it updates class variable image_name
-        to the compatible image name and returns True. It will
-        return False otherwise.
+        and "kipoi/kipoi-docker:sharedpy3keras1.2-slim". Images whose
+        environment in envfiles/ conflicts with the dependencies in the
+        model.yaml and dataloader.yaml files of the model group are ruled
+        out without running a container. The remaining images are
+        probed concurrently and, if several are compatible, the smallest
+        one is chosen unless DOCKER_COMPATIBILITY_RANKING is set to
+        duration. Images whose outcome has been recorded in the
+        compatibility matrix for their current digest and the current files
+        of the model group are not probed again. If it is found to be
+        compatible, it updates class variable image_name to the compatible
+        image name and returns True. It will return False otherwise.
         """
-        for slim_image in [
-            "kipoi/kipoi-docker:sharedpy3keras2tf1-slim",
-            "kipoi/kipoi-docker:sharedpy3keras2tf2-slim",
-            "kipoi/kipoi-docker:sharedpy3keras1.2-slim",
-        ]:
-            if self.list_of_models:
-                for model_name in self.list_of_models:
-                    # Run the newly created container
-                    if test_docker_image_without_exception(
-                        image_name=slim_image, model_name=model_name
-                    ):
-                        self.slim_image = slim_image
-                        self.image_name = slim_image.replace("-slim", "")
-                        return True
-            else:
-                if test_docker_image_without_exception(
-                    image_name=slim_image, model_name=self.model_group
-                ):
-                    self.slim_image = slim_image
-                    self.image_name = slim_image.replace("-slim", "")
-                    return True
-        return False
+        if self.model_repo_commit is None:
+            self.model_repo_commit = self.kipoi_model_repo.get_branch(
+                self.kipoi_model_repo.default_branch
+            ).commit.sha
+        candidates = rule_out_conflicting_images(
+            get_model_group_dependencies(
+                self.kipoi_model_repo,
+                self.model_group,
+                self.model_repo_commit,
+            ),
+            SHARED_SLIM_IMAGES,
+        )
+        if not candidates:
+            return False
+        fingerprint = get_model_group_fingerprint(
+            self.kipoi_model_repo, self.model_group, self.model_repo_commit
+        )
+        digests = {image: get_base_image_digest(image) for image in candidates}
+        known_results = {}
+        for image in candidates:
+            result = self.compatibility_matrix.lookup(
+                self.model_group, image, digests[image], fingerprint
+            )
+            if result is not None:
+                known_results[image] = result
+        slim_image = find_compatible_image(
+            self.list_of_models if self.list_of_models else [self.model_group],
+            images=candidates,
+            session=self.session,
+            known_results=known_results,
+            on_result=lambda result: self.compatibility_matrix.record(
+                self.model_group,
+                result,
+                digests[result.name_of_docker_image],
+                fingerprint,
+                self.model_repo_commit,
+            ),
+        )
+        if slim_image is None:
+            return False
+        self.slim_image = slim_image
+        self.image_name = slim_image.replace("-slim", "")
+        return True
+
+    def build_image(
+        self, dockerfile_path: Union[str, Path], name_of_docker_image: str
+    ) -> None:
+        """
+        Builds a docker image from scratch or, if a build cache folder
+        has been specified, with BuildKit using the layer cache in
+        <build_cache_folder>/<tag>
+        """
+        if self.build_cache_folder:
+            build_docker_image(
+                dockerfile_path=dockerfile_path,
+                name_of_docker_image=name_of_docker_image,
+                nocache=False,
+                cache_dir=Path(self.build_cache_folder)
+                / name_of_docker_image.split(":")[1],
+                session=self.session,
+            )
+        else:
+            build_docker_image(
+                dockerfile_path=dockerfile_path,
+                name_of_docker_image=name_of_docker_image,
+                session=self.session,
+            )
+
+    def lock_environment(self, dockerfile_path: Union[str, Path]) -> None:
+        """Exports the lockfile of the conda environment of the full image
+        for future rebuilds, together with the checksum of the dependencies
+        of the model group it has been solved for, if the commit of kipoi
+        model repo is known"""
+        env_name = get_conda_env_name_from_dockerfile(
+            Path(dockerfile_path).read_text()
+        )
+        if not env_name:
+            return
+        export_lockfile(self.image_name, env_name, session=self.session)
+        if self.model_repo_commit is not None:
+            dependency_fingerprint = get_dependency_fingerprint(
+                self.kipoi_model_repo,
+                [self.model_group],
+                self.model_repo_commit,
+            )
+            get_dependency_hash_path(env_name).write_text(
+                f"{dependency_fingerprint}\n"
+            )
+
+    def get_stages(
+        self,
+        dockerfile_path: Union[str, Path],
+        models: List[str],
+        on_slim_image_published: Optional[Callable[[], None]] = None,
+    ) -> List[Stage]:
+        """Returns the stages of building, testing and pushing the full
+        and the slim image of the model group. A slim image derived from
+        the full image has the identical environment, so it is tested with
+        one model only. The slim image is pushed and published only once
+        the full image has passed too, so that nothing is published for a
+        model group which is not added. The tests of both images share one memory budget and number of
+        workers."""
+        budget = get_resource_budget()
+        full_tag = self.image_name.split(":")[1]
+        slim_tag = self.slim_image.split(":")[1]
+        if self.slim_from_full:
+            build_slim = Stage(
+                f"build {slim_tag}",
+                lambda: build_slim_docker_image_from_full(
+                    name_of_full_image=self.image_name,
+                    name_of_slim_image=self.slim_image,
+                    session=self.session,
+                ),
+                [f"build {full_tag}"],
+            )
+        else:
+            build_slim = Stage(
+                f"build {slim_tag}",
+                lambda: self.build_image(
+                    f"{dockerfile_path}-slim", self.slim_image
+                ),
+            )
+        stages = [
+            Stage(
+                f"build {full_tag}",
+                lambda: self.build_image(dockerfile_path, self.image_name),
+            ),
+            build_slim,
+            Stage(
+                f"test {full_tag}",
+                lambda: run_model_tests(
+                    self.image_name,
+                    models,
+                    session=self.session,
+                    budget=budget,
+                ),
+                [f"build {full_tag}"],
+            ),
+            Stage(
+                f"test {slim_tag}",
+                lambda: run_model_tests(
+                    self.slim_image,
+                    models[:1] if self.slim_from_full else models,
+                    session=self.session,
+                    budget=budget,
+                ),
+                [f"build {slim_tag}"],
+            ),
+            Stage(
+                f"lock {full_tag}",
+                lambda: self.lock_environment(dockerfile_path),
+                [f"test {full_tag}"],
+            ),
+            Stage(
+                f"push {full_tag}",
+                lambda: push_docker_image(tag=full_tag, session=self.session),
+                [f"test {full_tag}"],
+            ),
+            Stage(
+                f"push {slim_tag}",
+                lambda: push_docker_image(tag=slim_tag, session=self.session),
+                [f"test {slim_tag}", f"test {full_tag}"],
+            ),
+        ]
+        if on_slim_image_published is not None:
+            stages.append(
+                Stage(
+                    f"publish {slim_tag}",
+                    on_slim_image_published,
+                    [f"push {slim_tag}"],
+                )
+            )
+        return stages
 
     def add(
         self,
@@ -156,6 +368,7 @@ class DockerAdder:
         docker_to_model_dict: Dict,
         workflow_test_data: Dict,
         workflow_release_data: Dict,
+        on_slim_image_published: Optional[Callable[[], None]] = None,
     ) -> None:
         """
         This function adds a newly added model group to this repo. The steps are -
@@ -167,9 +380,19 @@ class DockerAdder:
         2. Create the appropriate dockerfile using a generator
         3. Build the image
         4. Test the image with all models from this newly added model group
-        5. Push the image and cleanup
+           concurrently
+        5. Lock the conda environment, push the image and cleanup
         6. Update model group to docker image dict and docker image to model name dict
         7. Update github workflow files with this newly added model group
+        Steps 3-5 of the full and the slim image are pipelined - the slim
+        image is built while the full image is tested and each image is
+        pushed as soon as it has passed its tests. <on_slim_image_published>,
+        for example the conversion into a singularity image, is called as
+        soon as the slim image has been pushed, or after step 7 if an
+        existing image is reused.
+
+        Raises:
+            ValueError: If any build, test or push has failed
         """
         self.list_of_models = self.get_list_of_models_from_repo()
         if self.is_compatible_with_existing_image():
@@ -179,6 +402,8 @@ class DockerAdder:
                 workflow_test_data,
                 workflow_release_data,
             )
+            if on_slim_image_published is not None:
+                on_slim_image_published()
         else:
             dockerfile_generator_path = "dockerfiles/dockerfile-generator.sh"
             slim_dockerfile_generator_path = (
@@ -197,45 +422,25 @@ class DockerAdder:
                     "bash",
                     slim_dockerfile_generator_path,
                     f"{self.model_group}",
-                ],
+                ]
+                + (["from-full"] if self.slim_from_full else []),
             )
 
-            # Build docker images
             dockerfile_path = (
                 f"dockerfiles/Dockerfile.{self.model_group.lower()}"
             )
-            slim_dockerfile_path = f"{dockerfile_path}-slim"
-            build_docker_image(
-                dockerfile_path=dockerfile_path,
-                name_of_docker_image=self.image_name,
-            )
-            build_docker_image(
-                dockerfile_path=slim_dockerfile_path,
-                name_of_docker_image=self.slim_image,
+            models = (
+                self.list_of_models
+                if self.list_of_models
+                else [self.model_group]
             )
-            # Test the newly created container
-            if self.list_of_models:
-                for model_name in self.list_of_models:
-                    # Run the newly created container
-                    test_docker_image(
-                        image_name=self.image_name, model_name=model_name
-                    )
-                    test_docker_image(
-                        image_name=self.slim_image, model_name=model_name
-                    )
-            else:
-                test_docker_image(
-                    image_name=self.image_name, model_name=self.model_group
-                )
-                test_docker_image(
-                    image_name=self.slim_image, model_name=self.model_group
+            status = run_stages(
+                self.get_stages(
+                    dockerfile_path, models, on_slim_image_published
                 )
-
-            # Push the container
-            push_docker_image(tag=self.image_name.split(":")[1])
-            push_docker_image(tag=self.slim_image.split(":")[1])
-
-            cleanup(images=True)
+            )
+            raise_for_failed_stages(status)
+            cleanup(images=True, session=self.session)
 
             self.update_content(
                 model_group_to_docker_dict,
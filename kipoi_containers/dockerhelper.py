@@ -1,115 +1,1023 @@
-from io import BytesIO
+import json
 import os
 from pathlib import Path
-from typing import Union, Dict
+import re
+import shutil
+from subprocess import Popen, PIPE, STDOUT
+import threading
+import time
+from typing import Union, Dict, List, Optional, Tuple
 import docker
+import requests
 
-from kipoi_containers.helper import logger
+from kipoi_containers.buildcontext import (
+    create_build_context,
+    split_dockerfile_instructions,
+)
+from kipoi_containers.buildreport import (
+    BuildReport,
+    BuildKitProgressRecorder,
+    LegacyBuildRecorder,
+)
+from kipoi_containers.containersession import ContainerSession, get_session
+from kipoi_containers.downloadcache import (
+    add_docker_volumes,
+    using_kipoi_folders,
+)
+from kipoi_containers.testtelemetry import (
+    StatsSampler,
+    new_telemetry,
+    record_telemetry,
+)
+from kipoi_containers.helper import (
+    get_batch_test_command,
+    logger,
+    parse_test_results,
+    raise_for_failed_models,
+)
 
+PathType = Union[str, Path]
+CACHE_BUST_ARG = "KIPOI_CACHE_BUST"
+LOCKFILE_FOLDER = Path.cwd() / "dockerfiles" / "lockfiles"
+LOCKED_ENV_FOLDER = "/app/lockfiles"
+ENV_CREATE = re.compile(r"\b(kipoi|conda) env create\b")
+SLIM_FROM_FULL_DOCKERFILE = (
+    Path.cwd() / "dockerfiles" / "Dockerfile-slim-from-full.template"
+)
+CONDA_PKGS_CACHE_MOUNT = (
+    "--mount=type=cache,id=kipoi-conda-pkgs,target=/opt/conda/pkgs,"
+    "sharing=locked"
+)
+CONDA_CHANNEL_CONTEXT = "kipoi-conda-channel"
+CONDA_CHANNEL_TARGET = "/opt/kipoi-conda-channel"
+CONDA_CLEAN = re.compile(
+    r"\s*&&\s*conda clean -[a-z]+|conda clean -[a-z]+\s*&&\s*"
+)
 
-def cleanup(images: bool = False) -> None:
+
+def cleanup(
+    images: bool = False, session: Optional[ContainerSession] = None
+) -> None:
     """
-    Cleans up unused docker containers, volumes and networks.
-    If images is true cleanup the images as well.
+    Cleans up the docker containers, volumes and networks labelled with
+    the run of <session>, which includes test containers left behind by
+    interrupted tests. Resources of other runs or other workloads on the
+    same docker host are not touched. If images is true cleanup the
+    dangling images as well.
     """
-    client = docker.from_env()
-    client.containers.prune()
-    client.networks.prune()
-    client.volumes.prune()
+    session = session if session else get_session()
+    client = session.client
+    filters = {"label": session.label_filter}
+    for container in client.containers.list(all=True, filters=filters):
+        container.remove(force=True, v=True)
+    client.networks.prune(filters=filters)
+    client.volumes.prune(filters=filters)
     if images:
         client.images.prune(filters={"dangling": True})
+        session.invalidate()
+
+
+def get_base_images(dockerfile_path: PathType) -> List[str]:
+    """Returns the images in FROM instructions of a dockerfile,
+    ignoring references to earlier build stages. Build arguments declared
+    before the first FROM are replaced with their default values."""
+    base_images = []
+    stages = []
+    global_args = {}
+    with open(dockerfile_path, "r") as dockerfile:
+        instructions = split_dockerfile_instructions(dockerfile.read())
+    for instruction in instructions:
+        tokens = instruction.split()
+        if tokens[0].upper() == "ARG" and not stages and not base_images:
+            name, _, default = " ".join(tokens[1:]).partition("=")
+            global_args[name] = default.strip("\"'")
+            continue
+        if tokens[0].upper() != "FROM":
+            continue
+        tokens = [t for t in tokens[1:] if not t.startswith("--")]
+        if not tokens:
+            continue
+        for name, default in global_args.items():
+            tokens[0] = re.sub(
+                rf"\$\{{{name}\}}|\${name}\b",
+                lambda _: default,
+                tokens[0],
+            )
+        if tokens[0] not in stages and tokens[0] not in base_images:
+            base_images.append(tokens[0])
+        if len(tokens) >= 3 and tokens[1].upper() == "AS":
+            stages.append(tokens[2])
+    return base_images
+
+
+def insert_cache_bust(dockerfile_content: str, step: int) -> str:
+    """
+    Returns the dockerfile content with an instruction inserted right
+    before step <step> (1-based) which changes whenever the build argument
+    KIPOI_CACHE_BUST changes. Every instruction from this step onwards is
+    thus rebuilt. If <step> is a FROM instruction, the whole stage is rebuilt.
+
+    Raises:
+        ValueError: If <step> does not exist in the dockerfile
+    """
+    instructions = split_dockerfile_instructions(dockerfile_content)
+    if step < 1 or step > len(instructions):
+        raise ValueError(
+            f"Step {step} does not exist. There are {len(instructions)} steps"
+        )
+    cache_bust = [
+        f"ARG {CACHE_BUST_ARG}=0",
+        f'RUN echo "${CACHE_BUST_ARG}" > /dev/null',
+    ]
+    if instructions[step - 1].upper().startswith("FROM "):
+        position = step
+    else:
+        position = step - 1
+    if position == 0:
+        raise ValueError("The cache can not be busted before the first FROM")
+    return "\n".join(
+        instructions[:position] + cache_bust + instructions[position:]
+    )
+
+
+def get_conda_env_name_from_dockerfile(
+    dockerfile_content: str,
+) -> Optional[str]:
+    """Returns the name of the conda environment a dockerfile activates
+    with ENV PATH or None if there is none"""
+    for instruction in split_dockerfile_instructions(dockerfile_content):
+        match = re.match(
+            r"ENV\s+PATH[\s=]+/opt/conda/envs/([^/:]+)/bin",
+            instruction,
+            re.IGNORECASE,
+        )
+        if match:
+            return match.group(1)
+    return None
+
+
+def get_lockfile_paths(
+    env_name: str, lockfile_folder: PathType = LOCKFILE_FOLDER
+) -> Tuple[Path, Path]:
+    """Returns the paths of the explicit conda spec and of the pip
+    requirements which pin the conda environment <env_name>"""
+    lockfile_folder = Path(lockfile_folder)
+    return (
+        lockfile_folder / f"{env_name}.explicit.txt",
+        lockfile_folder / f"{env_name}.pip.txt",
+    )
+
+
+def get_dependency_hash_path(
+    env_name: str, lockfile_folder: PathType = LOCKFILE_FOLDER
+) -> Path:
+    """Returns the path of the checksum of the dependencies of the model
+    groups the conda environment <env_name> has been locked for"""
+    return Path(lockfile_folder) / f"{env_name}.dependencies.sha256"
+
+
+def apply_lockfile(
+    dockerfile_content: str, lockfile_folder: PathType = LOCKFILE_FOLDER
+) -> str:
+    """
+    Returns the dockerfile content with the solving kipoi env create or
+    conda env create command replaced by an installation from the
+    lockfiles of the conda environment the dockerfile activates, if
+    <lockfile_folder> contains them. The lockfiles are copied into the
+    image right before. <lockfile_folder> has to be inside the current
+    working directory, which is the build context.
+    """
+    env_name = get_conda_env_name_from_dockerfile(dockerfile_content)
+    if env_name is None:
+        return dockerfile_content
+    explicit_lockfile, pip_lockfile = get_lockfile_paths(
+        env_name, lockfile_folder
+    )
+    if not explicit_lockfile.exists() or not pip_lockfile.exists():
+        return dockerfile_content
+    context_folder = (
+        Path(lockfile_folder).resolve().relative_to(Path.cwd()).as_posix()
+    )
+    locked_install = (
+        f"conda create -y -p /opt/conda/envs/{env_name} "
+        f"--file {LOCKED_ENV_FOLDER}/{explicit_lockfile.name} && "
+        f"/opt/conda/envs/{env_name}/bin/pip install --no-deps "
+        f"-r {LOCKED_ENV_FOLDER}/{pip_lockfile.name}"
+    )
+    instructions = []
+    for instruction in split_dockerfile_instructions(dockerfile_content):
+        keyword, _, command = instruction.partition(" ")
+        if keyword.upper() == "RUN" and ENV_CREATE.search(command):
+            instructions.append(
+                f"COPY {context_folder}/{explicit_lockfile.name} "
+                f"{context_folder}/{pip_lockfile.name} {LOCKED_ENV_FOLDER}/"
+            )
+            command = " && ".join(
+                locked_install if ENV_CREATE.search(part) else part.strip()
+                for part in command.split("&&")
+            )
+            instruction = f"{keyword} {command}"
+        instructions.append(instruction)
+    logger.info(f"Installing {env_name} from {explicit_lockfile}")
+    return "\n".join(instructions)
+
+
+def add_conda_cache_mounts(
+    dockerfile_content: str,
+    conda_channel: bool = False,
+    conda_offline: bool = False,
+) -> str:
+    """
+    Returns the dockerfile content with the conda package cache
+    /opt/conda/pkgs mounted as a BuildKit cache into every RUN instruction
+    which uses conda or kipoi, so that packages are downloaded only once
+    across all builds. conda clean is dropped from these instructions
+    since it would empty the shared cache. If conda_channel is True, the
+    local channel passed as build context kipoi-conda-channel is mounted
+    as well and conda resolves against it first. If conda_offline is
+    True, conda does not access the network at all.
+    """
+    mounts = [CONDA_PKGS_CACHE_MOUNT]
+    exports = []
+    if conda_channel:
+        mounts.append(
+            f"--mount=type=bind,from={CONDA_CHANNEL_CONTEXT},"
+            f"target={CONDA_CHANNEL_TARGET}"
+        )
+        exports.append(
+            f"CONDA_CHANNELS=file://{CONDA_CHANNEL_TARGET},defaults"
+        )
+    if conda_offline:
+        exports.append("CONDA_OFFLINE=true")
+    instructions = []
+    for instruction in split_dockerfile_instructions(dockerfile_content):
+        keyword, _, command = instruction.partition(" ")
+        if (
+            keyword.upper() == "RUN"
+            and not command.startswith("[")
+            and re.search(r"\bconda\s|\bkipoi\s+env\b", command)
+        ):
+            command = CONDA_CLEAN.sub("", command)
+            if exports:
+                command = f"export {' '.join(exports)} && {command}"
+            instruction = f"{keyword} {' '.join(mounts)} {command}"
+        instructions.append(instruction)
+    return "\n".join(instructions)
+
+
+def pull_cache_sources(
+    cache_from: List[str], session: Optional[ContainerSession] = None
+) -> List[str]:
+    """
+    Pulls the images in <cache_from> so that the docker daemon can use
+    them as a cache source and returns the images that could be pulled.
+    Images that can not be pulled, for example because they have never
+    been published, are skipped.
+    """
+    session = session if session else get_session()
+    available_images = []
+    for image in cache_from:
+        session.invalidate(image)
+        try:
+            session.client.images.pull(image)
+        except docker.errors.APIError:
+            logger.info(f"{image} can not be used as a cache source")
+            continue
+        available_images.append(image)
+    return available_images
+
+
+def build_docker_image_with_buildkit(
+    build_context: PathType,
+    name_of_docker_image: str,
+    cache_dir: PathType,
+    cache_from: List[str],
+    nocache: bool,
+    buildargs: Dict,
+    report: Optional[BuildReport] = None,
+    conda_channel: Optional[PathType] = None,
+) -> None:
+    """
+    This function builds a docker image with BuildKit using docker buildx.
+    The layer cache is imported from and exported to <cache_dir> and the
+    images in <cache_from> are used as additional registry cache sources.
+    The exported cache replaces the content of <cache_dir> only after a
+    successful build. The builder selected with docker buildx use must
+    support cache export, for example one created with
+    docker buildx create --driver docker-container --use
+    <build_context> is a gzipped tarball containing the dockerfile, which
+    is sent to docker buildx on stdin. The build output is logged as it
+    happens and the timing of each step is recorded in <report>, if given.
+    The local conda channel <conda_channel>, if given, is passed as build
+    context kipoi-conda-channel.
+
+    Raises:
+      ValueError: If the docker image cannot be built
+    """
+    cache_dir = Path(cache_dir)
+    new_cache_dir = Path(f"{cache_dir}-new")
+    build_cmd = [
+        "docker",
+        "buildx",
+        "build",
+        "--load",
+        "--progress=plain",
+        "--tag",
+        name_of_docker_image,
+        "--cache-to",
+        f"type=local,dest={new_cache_dir},mode=max",
+        "--cache-to",
+        "type=inline",
+    ]
+    if (cache_dir / "index.json").exists():
+        build_cmd.extend(["--cache-from", f"type=local,src={cache_dir}"])
+    for image in cache_from:
+        build_cmd.extend(["--cache-from", f"type=registry,ref={image}"])
+    if nocache:
+        build_cmd.append("--no-cache")
+    for key, value in buildargs.items():
+        build_cmd.extend(["--build-arg", f"{key}={value}"])
+    if conda_channel is not None:
+        build_cmd.extend(
+            [
+                "--build-context",
+                f"{CONDA_CHANNEL_CONTEXT}={Path(conda_channel).resolve()}",
+            ]
+        )
+    build_cmd.append("-")
+    logger.info(f"Building {name_of_docker_image} - {' '.join(build_cmd)}")
+    recorder = BuildKitProgressRecorder(report) if report else None
+    with open(build_context, "rb") as context:
+        process = Popen(build_cmd, stdin=context, stdout=PIPE, stderr=STDOUT)
+        for raw_line in process.stdout:
+            line = raw_line.decode("utf-8", errors="replace")
+            logger.info(line.rstrip())
+            if recorder:
+                recorder.process_line(line)
+        process.wait()
+    if recorder:
+        recorder.close()
+    if process.returncode != 0:
+        if new_cache_dir.exists():
+            shutil.rmtree(new_cache_dir)
+        raise ValueError(
+            f"Docker image {name_of_docker_image} can not be built"
+        )
+    if cache_dir.exists():
+        shutil.rmtree(cache_dir)
+    new_cache_dir.rename(cache_dir)
 
 
 def build_docker_image(
-    dockerfile_path: Union[str, Path], name_of_docker_image: str
+    dockerfile_path: PathType,
+    name_of_docker_image: str,
+    nocache: bool = True,
+    cache_from: Optional[List[str]] = None,
+    cache_dir: Optional[PathType] = None,
+    bust_cache_from_step: Optional[int] = None,
+    report_folder: Optional[PathType] = None,
+    conda_channel: Optional[PathType] = None,
+    conda_offline: Optional[bool] = None,
+    buildargs: Optional[Dict] = None,
+    use_lockfile: bool = True,
+    session: Optional[ContainerSession] = None,
 ) -> None:
     """
-    This function builds a docker image from scratch using dockerfile_path
+    This function builds a docker image using dockerfile_path. By default,
+    the image is built from scratch. If nocache is False, the layers
+    of previous builds and of the images in cache_from are reused.
+    If cache_dir is specified, the image is built with BuildKit and the
+    layer cache is kept in cache_dir. In this case, the conda package cache
+    is shared across all builds as well. conda_channel or
+    DOCKER_BUILD_CONDA_CHANNEL environment variable is a local conda
+    channel, filled by prefetch_conda_channel, which BuildKit builds
+    resolve against first. If conda_offline or DOCKER_BUILD_CONDA_OFFLINE
+    environment variable is set, these builds do not download conda
+    packages at all. buildargs are passed to the dockerfile as build
+    arguments. If dockerfiles/lockfiles pins the conda environment of
+    the image and use_lockfile is True, the environment is installed from
+    these lockfiles instead of being solved. bust_cache_from_step forces a
+    rebuild of all instructions starting from this (1-based) step, for
+    example to fetch fresh conda packages. Only the dockerfile and the
+    files its ADD and COPY instructions refer to are sent to the docker
+    daemon as a cached, reproducible build context (see buildcontext).
+    The build output is streamed to the log. If report_folder or
+    DOCKER_BUILD_REPORT_FOLDER environment variable is specified, wall
+    time, layer size and cache usage of every step is written there
+    as json. All docker api calls go through <session>, or the shared
+    session if none is given.
 
     Raises:
       docker.errors.BuildError: If the docker image cannot be build
       docker.errors.APIError: If there is an issue connecting to the docker api
+      ValueError: If the docker image cannot be built with BuildKit or a
+        file the dockerfile refers to does not exist
     """
-    client = docker.from_env()
+    session = session if session else get_session()
     with open(dockerfile_path, "r") as dockerfile:
-        dockerfile_obj = BytesIO(dockerfile.read().encode("utf-8"))
+        dockerfile_content = dockerfile.read()
+    buildargs = dict(buildargs) if buildargs else {}
+    if bust_cache_from_step is not None:
+        dockerfile_content = insert_cache_bust(
+            dockerfile_content, bust_cache_from_step
+        )
+        buildargs[CACHE_BUST_ARG] = str(time.time_ns())
+    if use_lockfile:
+        dockerfile_content = apply_lockfile(dockerfile_content)
+    cache_from = cache_from if cache_from else []
+    if report_folder is None:
+        report_folder = os.environ.get("DOCKER_BUILD_REPORT_FOLDER")
+    report = BuildReport(
+        name_of_docker_image=name_of_docker_image,
+        dockerfile_path=str(dockerfile_path),
+    )
+    if cache_dir is not None:
+        if conda_channel is None:
+            conda_channel = os.environ.get("DOCKER_BUILD_CONDA_CHANNEL")
+        if conda_offline is None:
+            conda_offline = os.environ.get(
+                "DOCKER_BUILD_CONDA_OFFLINE", ""
+            ).lower() in ["1", "true", "yes"]
+        dockerfile_content = add_conda_cache_mounts(
+            dockerfile_content,
+            conda_channel=conda_channel is not None,
+            conda_offline=conda_offline,
+        )
+    build_context = create_build_context(dockerfile_content, Path.cwd())
+    if cache_dir is not None:
+        build_docker_image_with_buildkit(
+            build_context=build_context,
+            name_of_docker_image=name_of_docker_image,
+            cache_dir=cache_dir,
+            cache_from=cache_from,
+            nocache=nocache,
+            buildargs=buildargs,
+            report=report,
+            conda_channel=conda_channel,
+        )
+    else:
+        if cache_from and not nocache:
+            cache_from = pull_cache_sources(cache_from, session)
+        client = session.client
+        recorder = LegacyBuildRecorder(
+            report,
+            get_image_size=lambda image_id: session.inspect_image(image_id)[
+                "Size"
+            ],
+        )
+        build_log = []
+        image_id = None
+        with open(build_context, "rb") as context:
+            try:
+                for chunk in client.api.build(
+                    fileobj=context,
+                    custom_context=True,
+                    encoding="gzip",
+                    tag=name_of_docker_image,
+                    nocache=nocache,
+                    cache_from=cache_from if cache_from else None,
+                    buildargs=buildargs,
+                    decode=True,
+                ):
+                    build_log.append(chunk)
+                    if "error" in chunk:
+                        raise docker.errors.BuildError(
+                            chunk["error"], iter(build_log)
+                        )
+                    recorder.process_chunk(chunk)
+                    if "aux" in chunk and "ID" in chunk["aux"]:
+                        image_id = chunk["aux"]["ID"]
+                    elif "Successfully built " in chunk.get("stream", ""):
+                        image_id = chunk["stream"].split()[-1]
+            except docker.errors.BuildError as e:
+                raise (e)
+            except docker.errors.APIError as e:
+                raise (e)
+        recorder.close()
+        if image_id is None:
+            raise docker.errors.BuildError("Unknown", iter(build_log))
+    session.invalidate(name_of_docker_image)
+    if report_folder:
+        report_path = report.write(report_folder)
+        logger.info(f"Build report of {name_of_docker_image} is {report_path}")
+
+
+def get_conda_env_name(
+    name_of_docker_image: str, session: Optional[ContainerSession] = None
+) -> str:
+    """
+    Returns the name of the conda environment which is activated in a
+    docker image through its PATH. The image is pulled if it is not
+    available locally.
+
+    Raises:
+        ValueError: If PATH of the image does not contain a conda environment
+    """
+    session = session if session else get_session()
     try:
-        client.images.build(
-            fileobj=dockerfile_obj, tag=name_of_docker_image, nocache=True
+        inspection = session.inspect_image(name_of_docker_image)
+    except docker.errors.ImageNotFound:
+        session.client.images.pull(name_of_docker_image)
+        inspection = session.inspect_image(name_of_docker_image)
+    for env in inspection["Config"].get("Env") or []:
+        if env.startswith("PATH="):
+            match = re.search(r"/opt/conda/envs/([^/:]+)/bin", env)
+            if match:
+                return match.group(1)
+    raise ValueError(
+        f"{name_of_docker_image} does not activate a conda environment"
+    )
+
+
+def build_slim_docker_image_from_full(
+    name_of_full_image: str,
+    name_of_slim_image: str,
+    report_folder: Optional[PathType] = None,
+    session: Optional[ContainerSession] = None,
+) -> None:
+    """
+    This function builds <name_of_slim_image> by copying the conda
+    environment of <name_of_full_image> into debian:bullseye-slim with
+    dockerfiles/Dockerfile-slim-from-full.template, instead of solving and
+    installing the environment once more. The full image, which is
+    usually the one that has just been built, is used as it is available
+    to the docker daemon. The environments of both images are thus
+    identical.
+
+    Raises:
+      docker.errors.BuildError: If the docker image cannot be build
+      docker.errors.APIError: If there is an issue connecting to the docker api
+      ValueError: If the full image does not activate a conda environment
+    """
+    build_docker_image(
+        dockerfile_path=SLIM_FROM_FULL_DOCKERFILE,
+        name_of_docker_image=name_of_slim_image,
+        report_folder=report_folder,
+        buildargs={
+            "FULL_IMAGE": name_of_full_image,
+            "ENV_NAME": get_conda_env_name(name_of_full_image, session),
+        },
+        session=session,
+    )
+
+
+def get_pip_requirements(conda_list: List) -> List[str]:
+    """Returns the pinned requirements of the packages in the json output
+    of conda list which have been installed with pip"""
+    return sorted(
+        f"{package['name']}=={package['version']}"
+        for package in conda_list
+        if package.get("channel") == "pypi"
+    )
+
+
+def export_lockfile(
+    name_of_docker_image: str,
+    env_name: str,
+    lockfile_folder: PathType = LOCKFILE_FOLDER,
+    session: Optional[ContainerSession] = None,
+) -> Tuple[Path, Path]:
+    """
+    This function exports the url pinned explicit spec of the conda
+    environment <env_name> in a docker image together with the pip
+    requirements of this environment into <lockfile_folder> and returns
+    their paths. The image has to contain conda, which is the case for
+    all full images, but not for the -slim ones.
+
+    Raises:
+        docker.errors.ContainerError: If conda can not list the environment
+        docker.errors.APIError: If there is an issue connecting to the docker api
+    """
+    client = (session if session else get_session()).client
+    conda_list_cmd = [
+        "/opt/conda/bin/conda",
+        "list",
+        "-p",
+        f"/opt/conda/envs/{env_name}",
+    ]
+    explicit_spec = client.containers.run(
+        image=name_of_docker_image,
+        command=conda_list_cmd + ["--explicit", "--md5"],
+        remove=True,
+    ).decode("utf-8")
+    conda_list = json.loads(
+        client.containers.run(
+            image=name_of_docker_image,
+            command=conda_list_cmd + ["--json"],
+            remove=True,
         )
-    except docker.errors.BuildError as e:
-        raise (e)
-    except docker.errors.APIError as e:
-        raise (e)
+    )
+    explicit_lockfile, pip_lockfile = get_lockfile_paths(
+        env_name, lockfile_folder
+    )
+    explicit_lockfile.parent.mkdir(parents=True, exist_ok=True)
+    explicit_lockfile.write_text(explicit_spec)
+    pip_lockfile.write_text(
+        "".join(f"{r}\n" for r in get_pip_requirements(conda_list))
+    )
+    logger.info(
+        f"Locked {env_name} of {name_of_docker_image} in {explicit_lockfile} "
+        f"and {pip_lockfile}"
+    )
+    return explicit_lockfile, pip_lockfile
+
+
+FAILURE_TIMEOUT = "timeout"
+FAILURE_OOM_KILLED = "oom-killed"
+FAILURE_EXIT = "non-zero-exit"
+FAILURE_IMAGE_MISSING = "image-missing"
+FAILURE_CANCELLED = "cancelled"
+# Seconds after which the test of a model without its own timeout is killed
+DEFAULT_TEST_TIMEOUT = 3600
 
 
-def test_docker_image(image_name: str, model_name: str) -> None:
+class ModelTestError(docker.errors.ContainerError):
+    """Raised if a model has not passed its test inside a container. reason
+    is one of FAILURE_TIMEOUT, FAILURE_CANCELLED, FAILURE_OOM_KILLED and
+    FAILURE_EXIT."""
+
+    def __init__(
+        self, container, exit_status, command, image, stderr, reason: str
+    ) -> None:
+        super().__init__(container, exit_status, command, image, stderr)
+        self.reason = reason
+
+    def __str__(self) -> str:
+        return f"{self.reason}: {super().__str__()}"
+
+
+def classify_failure(error: Exception) -> str:
+    """Returns why a model test has failed with <error>"""
+    if isinstance(error, ModelTestError):
+        return error.reason
+    if isinstance(error, docker.errors.ImageNotFound):
+        return FAILURE_IMAGE_MISSING
+    if isinstance(error, docker.errors.ContainerError):
+        return FAILURE_EXIT
+    return type(error).__name__
+
+
+def get_test_limits(run_kwargs: Dict) -> Dict:
+    """Returns <run_kwargs> with the memory limit in GB of
+    DOCKER_TEST_MEMORY_LIMIT environment variable added, if it is
+    specified and no memory limit has been given"""
+    memory_limit = os.environ.get("DOCKER_TEST_MEMORY_LIMIT")
+    if memory_limit and "mem_limit" not in run_kwargs:
+        return run_kwargs | {
+            "mem_limit": f"{int(float(memory_limit) * 1024)}m"
+        }
+    return run_kwargs
+
+
+def get_test_timeout(timeout: Optional[float] = None) -> float:
+    """Returns <timeout> or, if it is not given, the timeout in seconds of
+    DOCKER_TEST_TIMEOUT environment variable, which defaults to an hour"""
+    if timeout is None:
+        return float(
+            os.environ.get("DOCKER_TEST_TIMEOUT", DEFAULT_TEST_TIMEOUT)
+        )
+    return timeout
+
+
+def get_test_command(model_name: str) -> str:
+    """Returns the command which tests <model_name> inside a container"""
+    if model_name == "Basenji":
+        return f"kipoi test {model_name} --source=kipoi --batch_size=2"
+    return f"kipoi test {model_name} --source=kipoi"
+
+
+def test_docker_image_with_models(
+    image_name: str,
+    models: List[str],
+    session: Optional[ContainerSession] = None,
+    timeout: Optional[float] = None,
+    **run_kwargs,
+) -> Dict[str, Dict]:
+    """
+    Runs a container for a given docker image which tests all <models>
+    one after another in a single python interpreter with the test driver
+    and returns the result of each model. The container is killed once it
+    has run for <timeout> seconds and is removed afterwards. If the
+    container has timed out or has been killed for running out of memory
+    and DOCKER_TEST_TELEMETRY_FOLDER environment variable is specified,
+    the failure is appended to test-telemetry.jsonl in this folder.
+
+    Raises:
+        ValueError: If any of the models has not passed its test
+        docker.errors.ImageNotFound: if <image_name> cannot be found
+        ModelTestError: If the container has timed out or has been killed
+            for running out of memory
+        docker.errors.APIError: If there is an issue connecting to the docker api
+    """
+    session = session if session else get_session()
+    command = get_batch_test_command(models)
+    telemetry_folder = os.environ.get("DOCKER_TEST_TELEMETRY_FOLDER")
+    telemetry = new_telemetry(image_name, ",".join(models))
+    start = time.monotonic()
+    with using_kipoi_folders(models) as mounts:
+        container = session.client.containers.run(
+            image=image_name,
+            command=command,
+            detach=True,
+            labels=session.labels,
+            **add_docker_volumes(run_kwargs, mounts),
+        )
+        sampler = None
+        if telemetry_folder:
+            sampler = StatsSampler(container, telemetry)
+            sampler.start()
+        timed_out = False
+        try:
+            try:
+                exit_code = container.wait(timeout=timeout)["StatusCode"]
+            except (
+                requests.exceptions.ReadTimeout,
+                requests.exceptions.ConnectionError,
+            ):
+                timed_out = True
+                logger.error(
+                    f"The tests of {image_name} have not finished within "
+                    f"{timeout}s"
+                )
+                try:
+                    container.kill()
+                except docker.errors.APIError:
+                    pass
+                exit_code = container.wait()["StatusCode"]
+            output = container.logs(stdout=True, stderr=False).decode("utf-8")
+            stderr = None
+            oom_killed = False
+            if exit_code != 0:
+                stderr = container.logs(stdout=False, stderr=True)
+                container.reload()
+                oom_killed = container.attrs["State"].get("OOMKilled", False)
+        finally:
+            container.remove(force=True)
+    logger.info(output)
+    telemetry.duration = round(time.monotonic() - start, 3)
+    telemetry.exit_code = exit_code
+    if timed_out:
+        telemetry.failure = FAILURE_TIMEOUT
+    elif oom_killed:
+        telemetry.failure = FAILURE_OOM_KILLED
+    if sampler is not None:
+        telemetry = sampler.stop()
+        # Peak memory and duration are only kept per model, which a batch
+        # of models cannot tell apart
+        if telemetry.failure is not None:
+            record_telemetry(telemetry, telemetry_folder)
+    if telemetry.failure is not None:
+        raise ModelTestError(
+            container,
+            exit_code,
+            command,
+            image_name,
+            stderr,
+            telemetry.failure,
+        )
+    results = parse_test_results(output, models)
+    if exit_code != 0:
+        logger.error(f"The test driver exited with {exit_code}")
+    raise_for_failed_models(results, image_name)
+    return results
+
+
+def test_docker_image(
+    image_name: str,
+    model_name: Union[str, List[str]],
+    session: Optional[ContainerSession] = None,
+    timeout: Optional[float] = None,
+    **run_kwargs,
+) -> Optional[Dict[str, Dict]]:
     """
     Runs a container for a given docker image and run
     kipoi test <model_name> --source=kipoi inside
-    the container, followed by a cleanup
+    the container, which is labelled with the run of <session> and
+    removed afterwards. The output of the test is streamed to the log
+    while it runs. If DOCKER_TEST_TELEMETRY_FOLDER environment variable
+    is specified, the docker stats of the container are sampled and the
+    duration, exit code, peak memory and cpu usage, block I/O and network
+    traffic of the test are appended to test-telemetry.jsonl in this
+    folder. The container is killed once it has run for <timeout>
+    seconds, or for DOCKER_TEST_TIMEOUT or an hour if no timeout is given.
+    run_kwargs, for example mem_limit or nano_cpus, are passed on to
+    docker run. Unless
+    mem_limit is given, the memory of the container is limited to
+    DOCKER_TEST_MEMORY_LIMIT GB, if specified. If
+    <model_name> is a list of models, for example all models of an image
+    in docker-to-model.json, they are tested in a single container and
+    python interpreter and the result of each model is returned. The
+    checkout of kipoi model repo in KIPOI_MODELS_CHECKOUT and the download
+    cache in KIPOI_DOWNLOAD_CACHE, if specified, are mounted into the
+    container.
 
     Raises:
+        ValueError: If any of a list of models has not passed its test
         docker.errors.ImageNotFound: if <image_name> cannot be found
-        docker.errors.ContainerError: If errors are raised during execution of the container
+        ModelTestError: If the test has timed out, has been killed for
+            running out of memory or has exited with a non zero status
         docker.errors.APIError: If there is an issue connecting to the docker api
     """
-    if model_name == "Basenji":
-        test_cmd = f"kipoi test {model_name} --source=kipoi --batch_size=2"
-    else:
-        test_cmd = f"kipoi test {model_name} --source=kipoi"
-    client = docker.from_env()
+    run_kwargs = get_test_limits(run_kwargs)
+    if isinstance(model_name, list):
+        return test_docker_image_with_models(
+            image_name,
+            model_name,
+            session=session,
+            timeout=get_test_timeout(timeout),
+            **run_kwargs,
+        )
+    with using_kipoi_folders([model_name]) as mounts:
+        run_test_container(
+            image_name,
+            model_name,
+            session,
+            get_test_timeout(timeout),
+            **add_docker_volumes(run_kwargs, mounts),
+        )
+
+
+def run_test_container(
+    image_name: str,
+    model_name: str,
+    session: Optional[ContainerSession] = None,
+    timeout: Optional[float] = None,
+    cancelled: Optional[threading.Event] = None,
+    **run_kwargs,
+) -> None:
+    """
+    Runs kipoi test <model_name> --source=kipoi in a container of
+    <image_name> as described in test_docker_image. The container is
+    killed as soon as <cancelled> is set, if given.
+
+    Raises:
+        docker.errors.ImageNotFound: if <image_name> cannot be found
+        ModelTestError: If the test has timed out, has been cancelled, has
+            been killed for running out of memory or has exited with a non
+            zero status
+        docker.errors.APIError: If there is an issue connecting to the docker api
+    """
+    session = session if session else get_session()
+    client = session.client
+    test_cmd = get_test_command(model_name)
+    telemetry_folder = os.environ.get("DOCKER_TEST_TELEMETRY_FOLDER")
+    telemetry = new_telemetry(image_name, model_name)
+    start = time.monotonic()
     try:
-        container_log = client.containers.run(
+        container = client.containers.run(
             image=image_name,
             command=test_cmd,
+            detach=True,
+            labels=session.labels,
+            **run_kwargs,
         )
     except docker.errors.ImageNotFound:
-        raise (f"Image {image_name} is not found")
-    except docker.errors.ContainerError as e:
-        raise (e)
-    except docker.errors.APIError as e:
-        raise (e)
-    cleanup()
-    logger.info(container_log.decode("utf-8"))
+        logger.error(f"Image {image_name} is not found")
+        raise
+    sampler = None
+    if telemetry_folder:
+        sampler = StatsSampler(container, telemetry)
+        sampler.start()
+    timed_out = threading.Event()
 
+    def kill_on_timeout() -> None:
+        timed_out.set()
+        logger.error(f"{model_name} has not finished within {timeout}s")
+        try:
+            container.kill()
+        except docker.errors.APIError:
+            pass
 
-def test_docker_image_without_exception(
-    image_name: str, model_name: str
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill_on_timeout)
+        timer.daemon = True
+        timer.start()
+    finished = threading.Event()
+
+    def kill_on_cancel() -> None:
+        while not finished.wait(1):
+            if cancelled.is_set():
+                logger.info(f"Cancelling the test of {model_name}")
+                try:
+                    container.kill()
+                except docker.errors.APIError:
+                    pass
+                return
+
+    if cancelled is not None:
+        threading.Thread(target=kill_on_cancel, daemon=True).start()
+    try:
+        for line in container.logs(stream=True, follow=True):
+            logger.info(
+                f"{model_name}: "
+                f"{line.decode('utf-8', errors='replace').rstrip()}"
+            )
+        exit_code = container.wait()["StatusCode"]
+        if timer is not None:
+            timer.cancel()
+        stderr = None
+        oom_killed = False
+        if exit_code != 0:
+            stderr = container.logs(stdout=False, stderr=True)
+            container.reload()
+            oom_killed = container.attrs["State"].get("OOMKilled", False)
+    finally:
+        finished.set()
+        if timer is not None:
+            timer.cancel()
+        # The container is removed here rather than by the daemon so that
+        # the stderr of a failed test ends up in the ModelTestError
+        container.remove(force=True)
+    telemetry.duration = round(time.monotonic() - start, 3)
+    telemetry.exit_code = exit_code
+    if exit_code != 0:
+        if timed_out.is_set():
+            telemetry.failure = FAILURE_TIMEOUT
+        elif cancelled is not None and cancelled.is_set():
+            telemetry.failure = FAILURE_CANCELLED
+        elif oom_killed:
+            telemetry.failure = FAILURE_OOM_KILLED
+        else:
+            telemetry.failure = FAILURE_EXIT
+    if sampler is not None:
+        record_telemetry(sampler.stop(), telemetry_folder)
+    if exit_code != 0:
+        raise ModelTestError(
+            container,
+            exit_code,
+            test_cmd,
+            image_name,
+            stderr,
+            telemetry.failure,
+        )
+
+
+def test_docker_image_cancellable(
+    image_name: str,
+    model_name: str,
+    session: Optional[ContainerSession] = None,
+    cancelled: Optional[threading.Event] = None,
 ) -> None:
     """
     Runs a container for a given docker image and run
     kipoi test <model_name> --source=kipoi inside
-    the container, followed by a cleanup, without raising an exception
+    the container, which is labelled with the run of <session> and
+    removed afterwards. The container is killed as soon as <cancelled>
+    is set, if given, and after DOCKER_TEST_TIMEOUT seconds or an hour.
+
+    Raises:
+        docker.errors.ImageNotFound: if <image_name> cannot be found
+        ModelTestError: If the test has timed out, has been cancelled, has
+            been killed for running out of memory or has exited with a non
+            zero status
+        docker.errors.APIError: If there is an issue connecting to the docker api
+    """
+    with using_kipoi_folders([model_name]) as mounts:
+        run_test_container(
+            image_name,
+            model_name,
+            session,
+            get_test_timeout(),
+            cancelled,
+            **add_docker_volumes(get_test_limits({}), mounts),
+        )
+
+
+def test_docker_image_without_exception(
+    image_name: str,
+    model_name: str,
+    session: Optional[ContainerSession] = None,
+    cancelled: Optional[threading.Event] = None,
+) -> bool:
+    """
+    Tests a docker image with <model_name> like
+    test_docker_image_cancellable without raising an exception. It returns
+    True if the test has passed.
     """
-    client = docker.from_env()
     try:
-        container_log = client.containers.run(
-            image=image_name,
-            command=f"kipoi test {model_name} --source=kipoi",
+        test_docker_image_cancellable(
+            image_name, model_name, session, cancelled
         )
     except docker.errors.ImageNotFound:
-        cleanup()
         return False
     except docker.errors.ContainerError:
-        cleanup()
         return False
     except docker.errors.APIError:
-        cleanup()
         return False
-    cleanup()
-    logger.info(container_log.decode("utf-8"))
     return True
 
 
-def push_docker_image(tag: str) -> None:
+def push_docker_image(
+    tag: str, session: Optional[ContainerSession] = None
+) -> None:
     """
     This function pushes kipoi/kipoi-docker:<tag> to dockerhub
 
     Raises:
       docker.errors.APIError: If there is an issue connecting to the docker api
     """
-    client = docker.from_env()
+    client = (session if session else get_session()).client
     auth_config = {
         "username": os.environ["DOCKER_USERNAME"],
         "password": os.environ["DOCKER_PASSWORD"],
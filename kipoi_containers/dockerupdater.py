@@ -1,45 +1,143 @@
+import os
 from pathlib import Path
 import pytest
-from typing import List
+from typing import Callable, List, Optional, Union, TYPE_CHECKING
 
+from kipoi_containers.buildmanifest import BuildManifest, compute_fingerprint
+from kipoi_containers.containersession import ContainerSession, get_session
 from kipoi_containers.dockerhelper import (
     build_docker_image,
+    build_slim_docker_image_from_full,
     cleanup,
+    export_lockfile,
+    get_conda_env_name_from_dockerfile,
+    get_dependency_hash_path,
     push_docker_image,
-    test_docker_image,
 )
+from kipoi_containers.envresolver import get_dependency_fingerprint
 
 from kipoi_containers.helper import logger
+from kipoi_containers.pipeline import (
+    Stage,
+    raise_for_failed_stages,
+    run_stages,
+)
+from kipoi_containers.testcache import ModelTestCache
+from kipoi_containers.testrunner import (
+    ResourceBudget,
+    get_resource_budget,
+    run_model_tests,
+)
+
+if TYPE_CHECKING:
+    from github.Repository import Repository
 
 
 class DockerUpdater:
-    def __init__(self, model_group: str, name_of_docker_image: str) -> None:
+    def __init__(
+        self,
+        model_group: str,
+        name_of_docker_image: str,
+        build_cache_folder: Optional[Union[str, Path]] = None,
+        bust_cache_from_step: Optional[int] = None,
+        kipoi_model_repo: Optional["Repository"] = None,
+        model_repo_commit: Optional[str] = None,
+        build_manifest: Optional[BuildManifest] = None,
+        slim_from_full: Optional[bool] = None,
+        session: Optional[ContainerSession] = None,
+        test_cache: Optional[ModelTestCache] = None,
+    ) -> None:
         """
         This function instantiates the DockerUpdater class with model group and
-        a docker image to update
+        a docker image to update. If a build cache folder is neither specified
+        here nor with DOCKER_BUILD_CACHE_FOLDER environment variable, the
+        image is built from scratch. Otherwise, it is built with BuildKit
+        reusing the layers cached in this folder and the layers of the
+        published image. bust_cache_from_step forces a rebuild from this
+        dockerfile step onwards. If kipoi model repo, the commit it has
+        been synced to and a build manifest are given, the image is only
+        updated if anything it is built from has changed since it has last
+        been published. If slim_from_full or DOCKER_BUILD_SLIM_FROM_FULL
+        environment variable is set, a -slim image is built by copying the
+        conda environment out of the corresponding full image and tested
+        with the first model only. All docker operations go through
+        <session>, or the shared session if none is given. If a test cache
+        is given, models which have passed with the same image before are
+        not tested again.
         """
         self.model_group = model_group
         self.name_of_docker_image = name_of_docker_image
+        if build_cache_folder is None:
+            build_cache_folder = os.environ.get("DOCKER_BUILD_CACHE_FOLDER")
+        self.build_cache_folder = build_cache_folder
+        self.bust_cache_from_step = bust_cache_from_step
+        self.kipoi_model_repo = kipoi_model_repo
+        self.model_repo_commit = model_repo_commit
+        self.build_manifest = build_manifest
+        if slim_from_full is None:
+            slim_from_full = os.environ.get(
+                "DOCKER_BUILD_SLIM_FROM_FULL", ""
+            ).lower() in ["1", "true", "yes"]
+        self.slim_from_full = slim_from_full
+        self.session = session if session else get_session()
+        self.test_cache = test_cache
+
+    def get_fingerprint(
+        self, dockerfile_path: Path, models_to_test: List
+    ) -> Optional[str]:
+        """Returns the fingerprint of the inputs of the docker image or None
+        if it can not be computed. A slim image built from the full image
+        has the fingerprint of the full image, as it is built from the
+        same inputs rather than from its own dockerfile."""
+        if "slim" in self.name_of_docker_image and self.slim_from_full:
+            dockerfile_path = Path(str(dockerfile_path).removesuffix("-slim"))
+        if (
+            self.kipoi_model_repo is None
+            or self.model_repo_commit is None
+            or self.build_manifest is None
+        ):
+            return None
+        return compute_fingerprint(
+            dockerfile_path=dockerfile_path,
+            models=models_to_test,
+            kipoi_model_repo=self.kipoi_model_repo,
+            commit=self.model_repo_commit,
+        )
+
+    def get_dependency_fingerprint(self, models: List) -> Optional[str]:
+        """Returns the checksum of the dependencies of the model groups of
+        <models> or None if it can not be computed"""
+        if self.kipoi_model_repo is None or self.model_repo_commit is None:
+            return None
+        return get_dependency_fingerprint(
+            self.kipoi_model_repo, models, self.model_repo_commit
+        )
+
+    def is_lockfile_current(
+        self, dockerfile_path: Path, dependency_fingerprint: Optional[str]
+    ) -> bool:
+        """Returns False if the conda environment of the image has been
+        locked for other dependencies of its model groups than the ones
+        with <dependency_fingerprint>, so that it has to be solved anew.
+        Lockfiles without a recorded checksum are not current either."""
+        env_name = get_conda_env_name_from_dockerfile(
+            dockerfile_path.read_text()
+        )
+        if dependency_fingerprint is None or env_name is None:
+            return True
+        hash_path = get_dependency_hash_path(env_name)
+        return (
+            hash_path.exists()
+            and hash_path.read_text().strip() == dependency_fingerprint
+        )
 
-    def update(self, models_to_test: List) -> None:
+    def get_dockerfile_path(self) -> Path:
         """
-        This functions rebuilds the given docker image for the given modelgroup and
-        tests all models specified by <models_to_test> with this new image. If all
-        tests pass the new image is pushed to dockerhub followed by a cleanup.
-        The steps are -
-        1. Rebuild the image
-        2. Rerun the tests for this image specified to <models_to_test>
-        3. Push the docker image
-        4. Cleanup
+        Returns the dockerfile of the docker image of the model group.
 
-        Raises
-        ------
-        ValueError
-            If the dockerfile path for the given model group does not exist
+        Raises:
+            ValueError: If the dockerfile does not exist
         """
-        logger.info(
-            f"Updating {self.model_group} and {self.name_of_docker_image}"
-        )
         if self.model_group in [
             "MMSplice/mtsplice",
             "APARENT/veff",
@@ -62,21 +160,242 @@ class DockerUpdater:
         dockerfile_path = Path.cwd() / "dockerfiles" / dockerfile_name
         if "slim" in self.name_of_docker_image:
             dockerfile_path = Path(f"{dockerfile_path}-slim")
-        if dockerfile_path.exists():
-            logger.info(
-                f"Building {self.name_of_docker_image} with {dockerfile_path}"
+        if not dockerfile_path.exists():
+            raise ValueError(
+                f"{self.model_group} needs to be containerized first"
             )
+        return dockerfile_path
+
+    def build(self, dockerfile_path: Path, use_lockfile: bool = True) -> None:
+        """Rebuilds the docker image, from the full image if it is a slim
+        image and slim_from_full is set. The conda environment is installed
+        from its lockfiles if use_lockfile is True and solved anew
+        otherwise."""
+        logger.info(
+            f"Building {self.name_of_docker_image} with {dockerfile_path}"
+        )
+        if "slim" in self.name_of_docker_image and self.slim_from_full:
+            build_slim_docker_image_from_full(
+                name_of_full_image=self.name_of_docker_image.replace(
+                    "-slim", ""
+                ),
+                name_of_slim_image=self.name_of_docker_image,
+                session=self.session,
+            )
+        elif self.build_cache_folder:
             build_docker_image(
                 dockerfile_path=dockerfile_path,
                 name_of_docker_image=self.name_of_docker_image,
+                nocache=False,
+                cache_from=[self.name_of_docker_image],
+                cache_dir=Path(self.build_cache_folder)
+                / self.name_of_docker_image.split(":")[1],
+                bust_cache_from_step=self.bust_cache_from_step,
+                use_lockfile=use_lockfile,
+                session=self.session,
             )
-            for model in models_to_test:
-                test_docker_image(
-                    image_name=self.name_of_docker_image, model_name=model
-                )
-            push_docker_image(tag=self.name_of_docker_image.split(":")[1])
-            cleanup(images=True)
         else:
-            raise ValueError(
-                f"{self.model_group} needs to be containerized first"
+            build_docker_image(
+                dockerfile_path=dockerfile_path,
+                name_of_docker_image=self.name_of_docker_image,
+                bust_cache_from_step=self.bust_cache_from_step,
+                use_lockfile=use_lockfile,
+                session=self.session,
+            )
+
+    def publish(
+        self,
+        dockerfile_path: Path,
+        models: List,
+        dependency_fingerprint: Optional[str] = None,
+    ) -> None:
+        """Locks the conda environment of a full image in
+        dockerfiles/lockfiles together with the <dependency_fingerprint>
+        of its model groups, if known, pushes the docker image and records
+        its fingerprint. The fingerprint covers the model groups of
+        <models> and is computed once the image has been locked, since the
+        lockfiles are among its inputs."""
+        env_name = get_conda_env_name_from_dockerfile(
+            dockerfile_path.read_text()
+        )
+        if "slim" not in self.name_of_docker_image and env_name:
+            export_lockfile(
+                self.name_of_docker_image, env_name, session=self.session
+            )
+            if dependency_fingerprint is not None:
+                get_dependency_hash_path(env_name).write_text(
+                    f"{dependency_fingerprint}\n"
+                )
+        push_docker_image(
+            tag=self.name_of_docker_image.split(":")[1],
+            session=self.session,
+        )
+        if self.build_manifest is not None:
+            self.build_manifest.record(
+                self.name_of_docker_image,
+                self.get_fingerprint(dockerfile_path, models),
+                self.model_repo_commit,
+            )
+
+    def get_stages(
+        self,
+        models_to_test: List,
+        all_models: Optional[List] = None,
+        budget: Optional[ResourceBudget] = None,
+    ) -> List[Stage]:
+        """
+        Returns the stages build, test and push of updating the docker
+        image, which are empty if the fingerprint of the image inputs
+        matches the one of the last published image. The fingerprint
+        covers the model groups of <all_models> of the image, which
+        default to <models_to_test>. The conda environment is solved anew
+        if the dependencies of these model groups have changed since it
+        has been locked. The tests share <budget> with the tests of the
+        other stages of the same pipeline, if given.
+
+        Raises:
+            ValueError: If the dockerfile path for the given model group
+                does not exist
+        """
+        dockerfile_path = self.get_dockerfile_path()
+        if all_models is None:
+            all_models = models_to_test
+        fingerprint = self.get_fingerprint(dockerfile_path, all_models)
+        if (
+            self.bust_cache_from_step is None
+            and self.build_manifest is not None
+            and self.build_manifest.is_up_to_date(
+                self.name_of_docker_image, fingerprint
+            )
+        ):
+            logger.info(
+                f"{self.name_of_docker_image} is up to date. Skipping the update"
             )
+            return []
+        if "slim" in self.name_of_docker_image and self.slim_from_full:
+            # The environment is the one of the full image, which has
+            # been tested with all models already
+            models_to_test = models_to_test[:1]
+        dependency_fingerprint = self.get_dependency_fingerprint(all_models)
+        # A dependency changed in kipoi model repo is only picked up by
+        # solving the environment anew
+        use_lockfile = self.is_lockfile_current(
+            dockerfile_path, dependency_fingerprint
+        )
+        if not use_lockfile:
+            logger.info(
+                f"The dependencies of {self.name_of_docker_image} have "
+                "changed since it has been locked. Solving its environment "
+                "anew"
+            )
+        tag = self.name_of_docker_image.split(":")[1]
+        return [
+            Stage(
+                f"build {tag}",
+                lambda: self.build(dockerfile_path, use_lockfile),
+            ),
+            Stage(
+                f"test {tag}",
+                lambda: run_model_tests(
+                    self.name_of_docker_image,
+                    models_to_test,
+                    session=self.session,
+                    cache=self.test_cache,
+                    budget=budget,
+                ),
+                [f"build {tag}"],
+            ),
+            Stage(
+                f"push {tag}",
+                lambda: self.publish(
+                    dockerfile_path, all_models, dependency_fingerprint
+                ),
+                [f"test {tag}"],
+            ),
+        ]
+
+    def update(
+        self, models_to_test: List, all_models: Optional[List] = None
+    ) -> bool:
+        """
+        This functions rebuilds the given docker image for the given modelgroup and
+        tests all models specified by <models_to_test> with this new image. If all
+        tests pass the new image is pushed to dockerhub followed by a cleanup.
+        The fingerprint covers the model groups of <all_models> of the image,
+        which default to <models_to_test>.
+        The steps are -
+        1. Skip the update if the fingerprint of the image inputs matches
+           the one of the last published image
+        2. Rebuild the image
+        3. Rerun the tests for this image specified to <models_to_test>
+           concurrently
+        4. Lock the conda environment of a full image in dockerfiles/lockfiles
+        5. Push the docker image and record its fingerprint
+        6. Cleanup
+        It returns True if the image has been updated and False if it
+        has been skipped.
+
+        Raises
+        ------
+        ValueError
+            If the dockerfile path for the given model group does not exist
+            or any of the tests has failed
+        """
+        logger.info(
+            f"Updating {self.model_group} and {self.name_of_docker_image}"
+        )
+        stages = self.get_stages(models_to_test, all_models)
+        if not stages:
+            return False
+        raise_for_failed_stages(run_stages(stages))
+        cleanup(images=True, session=self.session)
+        return True
+
+
+def update_full_and_slim(
+    full_updater: DockerUpdater,
+    slim_updater: DockerUpdater,
+    models_to_test: List,
+    all_models: Optional[List] = None,
+    on_slim_image_published: Optional[Callable[[], None]] = None,
+) -> bool:
+    """
+    Updates a full docker image and its slim image like DockerUpdater.update
+    with one pipeline - the slim image is built while the full image is
+    tested, the full image is pushed as soon as it has passed, the slim
+    image once both images have passed and <on_slim_image_published>, for
+    example the update of the singularity image, is called as soon as the
+    slim image has been pushed. A slim image derived from the full image is
+    built after and pushed only once the full image has been pushed. The tests of both images share one memory
+    budget and number of workers. Images are cleaned up once at the end.
+    It returns True if the slim image has been updated.
+
+    Raises:
+        ValueError: If a dockerfile does not exist or any stage has failed
+    """
+    budget = get_resource_budget()
+    full_stages = full_updater.get_stages(models_to_test, all_models, budget)
+    slim_stages = slim_updater.get_stages(models_to_test, all_models, budget)
+    if not full_stages and not slim_stages:
+        return False
+    if full_stages and slim_stages:
+        # Nothing is published unless both images have passed, since a
+        # failed update does not record the published images anywhere
+        slim_stages[-1].dependencies.append(full_stages[1].name)
+    if full_stages and slim_stages and slim_updater.slim_from_full:
+        slim_stages[0].dependencies.append(full_stages[0].name)
+        # The slim image shares the fingerprint of the full image, which
+        # covers the lockfiles written when the full image is pushed
+        slim_stages[-1].dependencies.append(full_stages[-1].name)
+    stages = full_stages + slim_stages
+    if slim_stages and on_slim_image_published is not None:
+        stages.append(
+            Stage(
+                f"publish {slim_stages[-1].name.split(' ', 1)[1]}",
+                on_slim_image_published,
+                [slim_stages[-1].name],
+            )
+        )
+    raise_for_failed_stages(run_stages(stages))
+    cleanup(images=True, session=full_updater.session)
+    return bool(slim_stages)
@@ -0,0 +1,258 @@
+from contextlib import contextmanager, ExitStack
+import fcntl
+import os
+from pathlib import Path
+import shutil
+import threading
+from typing import Dict, Iterator, List, Optional, Union
+
+from kipoi_containers.helper import logger
+from kipoi_containers.modelcheckout import get_model_checkout
+
+PathType = Union[str, Path]
+
+DEFAULT_CACHE_SIZE = 50
+
+
+def get_folder_size(folder: PathType) -> int:
+    """Returns the total size in bytes of the files in <folder>"""
+    size = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def get_download_folders(group_folder: PathType) -> List[Path]:
+    """Returns the outermost folders named downloaded in <group_folder>"""
+    group_folder = Path(group_folder)
+    if not group_folder.is_dir():
+        return []
+    return [
+        folder
+        for folder in sorted(group_folder.rglob("downloaded"))
+        if folder.is_dir()
+        and "downloaded" not in folder.relative_to(group_folder).parts[:-1]
+    ]
+
+
+class KipoiDownloadCache:
+    """This class manages a host folder which holds the kipoi model source
+    with the weights and example files downloaded by kipoi test. It is
+    mounted into every test container, so that a file is downloaded only
+    once. Tests hold a shared lock on the cache and an exclusive lock on
+    their model, so that the first clone, concurrent downloads of the same
+    files and eviction do not interfere. The least recently tested model
+    groups are evicted once the cache outgrows its size budget. The locks
+    are file locks and work across threads, processes and containers."""
+
+    def __init__(
+        self, cache_folder: PathType, size_budget: Optional[float] = None
+    ) -> None:
+        """
+        This function instantiates KipoiDownloadCache with the host folder
+        to keep the downloads in and its size budget in GB, which defaults
+        to KIPOI_DOWNLOAD_CACHE_SIZE environment variable or 50 GB.
+        """
+        self.cache_folder = Path(cache_folder).resolve()
+        self.source_folder = self.cache_folder / "models"
+        self.lock_folder = self.cache_folder / "locks"
+        self.access_folder = self.cache_folder / "access"
+        for folder in [
+            self.source_folder,
+            self.lock_folder,
+            self.access_folder,
+        ]:
+            folder.mkdir(parents=True, exist_ok=True)
+        if size_budget is None:
+            size_budget = float(
+                os.environ.get("KIPOI_DOWNLOAD_CACHE_SIZE", DEFAULT_CACHE_SIZE)
+            )
+        self.size_budget = size_budget
+        self._evicting = threading.Lock()
+
+    def is_populated(self) -> bool:
+        """Returns True if kipoi has cloned its model source into the
+        cache"""
+        return (self.source_folder / ".git").exists()
+
+    @contextmanager
+    def _flock(self, path: Path, operation: int) -> Iterator:
+        with open(path, "a") as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield lock_file
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def use(self, models: List[str], cloning: bool = True) -> Iterator[None]:
+        """
+        Holds the locks a test of <models> needs while the cache is mounted
+        into its container and marks their model groups as used. Until
+        kipoi has cloned the model source into the cache, tests run one at
+        a time, unless <cloning> is False because the model source is
+        mounted from a checkout instead.
+        """
+        with ExitStack() as stack:
+            stack.enter_context(
+                self._flock(self.cache_folder / "cache.lock", fcntl.LOCK_SH)
+            )
+            if cloning and not self.is_populated():
+                populate_lock = stack.enter_context(
+                    self._flock(
+                        self.cache_folder / "populate.lock", fcntl.LOCK_EX
+                    )
+                )
+                if self.is_populated():
+                    fcntl.flock(populate_lock, fcntl.LOCK_UN)
+            # Sorted so that tests of overlapping models do not deadlock
+            for model in sorted(set(models)):
+                stack.enter_context(
+                    self._flock(
+                        self.lock_folder / f"{model.replace('/', '--')}.lock",
+                        fcntl.LOCK_EX,
+                    )
+                )
+            for model in models:
+                (self.access_folder / model.split("/")[0]).touch()
+            yield
+        self.evict()
+
+    def evict(self) -> None:
+        """Deletes the downloads of the least recently tested model groups
+        until the cache fits into its size budget again, unless a test is
+        using the cache right now"""
+        if not self._evicting.acquire(blocking=False):
+            return
+        try:
+            with open(self.cache_folder / "cache.lock", "a") as cache_lock:
+                try:
+                    fcntl.flock(cache_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                try:
+                    self._evict()
+                finally:
+                    fcntl.flock(cache_lock, fcntl.LOCK_UN)
+        finally:
+            self._evicting.release()
+
+    def _evict(self) -> None:
+        budget = self.size_budget * 1e9
+        size = get_folder_size(self.source_folder)
+        if size <= budget:
+            return
+        groups = sorted(
+            self.access_folder.iterdir(), key=lambda p: p.stat().st_mtime
+        )
+        for group in groups:
+            # Nested models like MMSplice/pathogenicity keep their
+            # downloads in their own folder
+            for downloads in get_download_folders(
+                self.source_folder / group.name
+            ):
+                freed = get_folder_size(downloads)
+                logger.info(
+                    f"Evicting {freed / 1e9:.1f} GB of {group.name} "
+                    f"downloads from {self.cache_folder}"
+                )
+                shutil.rmtree(downloads, ignore_errors=True)
+                size -= freed
+            group.unlink()
+            if size <= budget:
+                return
+        # The git objects of kipoi model repo are all that is left
+        logger.warning(
+            f"{self.cache_folder} exceeds {self.size_budget} GB. Deleting "
+            "the kipoi model source"
+        )
+        shutil.rmtree(self.source_folder, ignore_errors=True)
+        self.source_folder.mkdir(parents=True, exist_ok=True)
+
+
+_download_cache = None
+_download_cache_lock = threading.Lock()
+
+
+def get_download_cache() -> Optional[KipoiDownloadCache]:
+    """Returns the download cache in the folder of KIPOI_DOWNLOAD_CACHE
+    environment variable or None if it is not specified"""
+    global _download_cache
+    cache_folder = os.environ.get("KIPOI_DOWNLOAD_CACHE")
+    if not cache_folder:
+        return None
+    with _download_cache_lock:
+        if _download_cache is None or _download_cache.cache_folder != (
+            Path(cache_folder).resolve()
+        ):
+            _download_cache = KipoiDownloadCache(cache_folder)
+        return _download_cache
+
+
+def get_kipoi_mounts(models: List[str], home: str = "/root") -> Dict:
+    """
+    Returns a dict mapping host folders to the paths and modes they are
+    mounted with in a test container of <models> whose user has the home
+    folder <home>. If there is a checkout of kipoi model repo, it is
+    mounted read-only with a kipoi config pointing at it and the downloads
+    of each model group are kept in the download cache, if there is one.
+    Otherwise, the download cache is mounted in place of ~/.kipoi/models.
+
+    Raises:
+        ValueError: If the checkout of kipoi model repo can not be prepared
+    """
+    model_checkout = get_model_checkout()
+    download_cache = get_download_cache()
+    if model_checkout is not None:
+        return model_checkout.get_mounts(
+            models,
+            download_cache.source_folder if download_cache else None,
+            config_path=f"{home}/.kipoi/config.yaml",
+        )
+    if download_cache is not None:
+        return {
+            str(download_cache.source_folder): {
+                "bind": f"{home}/.kipoi/models",
+                "mode": "rw",
+            }
+        }
+    return {}
+
+
+@contextmanager
+def using_kipoi_folders(
+    models: List[str], home: str = "/root"
+) -> Iterator[Dict]:
+    """Yields the mounts of get_kipoi_mounts while holding the locks of
+    the download cache for <models>, if there is one"""
+    mounts = get_kipoi_mounts(models, home)
+    download_cache = get_download_cache()
+    if download_cache is None:
+        yield mounts
+        return
+    with download_cache.use(models, cloning=get_model_checkout() is None):
+        yield mounts
+
+
+def add_docker_volumes(run_kwargs: Dict, mounts: Dict) -> Dict:
+    """Returns <run_kwargs> of docker run with <mounts> added to its
+    volumes"""
+    if not mounts:
+        return run_kwargs
+    return run_kwargs | {
+        "volumes": {**run_kwargs.get("volumes", {}), **mounts}
+    }
+
+
+def get_singularity_binds(mounts: Dict) -> List[str]:
+    """Returns the arguments of singularity exec which bind <mounts>"""
+    binds = []
+    for host_path, mount in mounts.items():
+        binds.extend(
+            ["--bind", f"{host_path}:{mount['bind']}:{mount['mode']}"]
+        )
+    return binds
@@ -0,0 +1,290 @@
+import hashlib
+import json
+from pathlib import Path
+import re
+from typing import Dict, List, Optional, Tuple, Union, TYPE_CHECKING
+
+from packaging.requirements import InvalidRequirement, Requirement
+from packaging.specifiers import InvalidSpecifier, SpecifierSet
+from packaging.version import InvalidVersion, Version
+from ruamel.yaml import YAML
+from ruamel.yaml.error import YAMLError
+
+from kipoi_containers.buildmanifest import (
+    ENVFILES_FOLDER,
+    get_model_group,
+    get_model_group_tree,
+)
+from kipoi_containers.dockerhelper import LOCKFILE_FOLDER, get_lockfile_paths
+from kipoi_containers.helper import logger
+
+if TYPE_CHECKING:
+    from github.Repository import Repository
+
+PathType = Union[str, Path]
+DependencySpec = Tuple[str, SpecifierSet]
+
+SHARED_ENVFILES = {
+    "kipoi/kipoi-docker:sharedpy3keras2tf1-slim": "sharedpy3keras2tf1.yml",
+    "kipoi/kipoi-docker:sharedpy3keras2tf2-slim": "sharedpy3keras2tf2.yml",
+    "kipoi/kipoi-docker:sharedpy3keras1.2-slim": "sharedpy3keras12.yml",
+}
+# Files of kipoi model repo which declare the dependencies of a model
+DEPENDENCY_FILES = [
+    "model.yaml",
+    "model-template.yaml",
+    "dataloader.yaml",
+    "dataloader-template.yaml",
+]
+# Packages which models often pin more tightly than they need, whose major
+# version is all that is compared
+MAJOR_VERSION_ONLY = ["python"]
+JINJA_TAG = re.compile(r"{[{%#].*?[}%#]}")
+PACKAGE_NAME = re.compile(r"^([A-Za-z0-9_.\-]+)\s*(.*)$")
+
+
+def normalize_name(name: str) -> str:
+    """Returns the name of a conda or pip package without its channel, in
+    lower case and with underscores replaced by dashes"""
+    return name.split("::")[-1].strip().lower().replace("_", "-")
+
+
+def parse_conda_spec(spec: str) -> Optional[DependencySpec]:
+    """Returns the package name and version specifier of a conda match spec
+    like python=3.7, numpy>=1.16,<1.20 or pysam 0.15.*, or None if it does
+    not constrain the version or can not be parsed"""
+    match = PACKAGE_NAME.match(normalize_name(str(spec)))
+    if not match or not match.group(2) or "|" in match.group(2):
+        return None
+    name, constraint = match.groups()
+    # The remainder of name version build is the build string
+    constraint = re.sub(r",\s+", ",", constraint).split()[0]
+    clauses = []
+    for clause in constraint.split(","):
+        if clause[:1].isdigit():
+            clause = f"={clause}"
+        if clause.startswith("=") and not clause.startswith("=="):
+            # name=1.2 or name=1.2=build matches every 1.2.x release
+            version = clause[1:].split("=")[0].rstrip("*").rstrip(".")
+            clause = f"=={version}.*"
+        clauses.append(clause)
+    try:
+        return name, SpecifierSet(",".join(clauses))
+    except InvalidSpecifier:
+        return None
+
+
+def parse_pip_spec(spec: str) -> Optional[DependencySpec]:
+    """Returns the package name and version specifier of a pip requirement,
+    or None if it does not constrain the version or can not be parsed"""
+    try:
+        requirement = Requirement(str(spec))
+    except InvalidRequirement:
+        return None
+    if requirement.url or not requirement.specifier:
+        return None
+    return normalize_name(requirement.name), requirement.specifier
+
+
+def get_dependency_specs(yaml_content: str) -> List[DependencySpec]:
+    """Returns the conda and pip dependencies with a version constraint in
+    the content of a model.yaml or dataloader.yaml. Jinja tags of
+    templates are left out and unparsable files have no dependencies."""
+    try:
+        yaml_data = YAML(typ="safe").load(JINJA_TAG.sub("", yaml_content))
+    except YAMLError:
+        return []
+    if not isinstance(yaml_data, dict):
+        return []
+    dependencies = yaml_data.get("dependencies") or {}
+    specs = [
+        parse_conda_spec(spec) for spec in dependencies.get("conda") or []
+    ] + [parse_pip_spec(spec) for spec in dependencies.get("pip") or []]
+    return [spec for spec in specs if spec is not None]
+
+
+def get_model_group_dependencies(
+    kipoi_model_repo: "Repository", model_group: str, commit: str
+) -> List[DependencySpec]:
+    """
+    Returns the version constrained dependencies declared by the
+    model.yaml and dataloader.yaml files, or their templates, of
+    <model_group> in kipoi model repo at <commit>.
+
+    Raises
+    ------
+    ValueError
+        If <model_group> does not exist in kipoi model repo at <commit>
+    """
+    specs = []
+    read_blobs = set()
+    for path, blob_sha in get_model_group_tree(
+        kipoi_model_repo, model_group, commit
+    ):
+        if Path(path).name not in DEPENDENCY_FILES or blob_sha in read_blobs:
+            continue
+        read_blobs.add(blob_sha)
+        content = kipoi_model_repo.get_contents(
+            path, ref=commit
+        ).decoded_content.decode()
+        specs.extend(
+            spec for spec in get_dependency_specs(content) if spec not in specs
+        )
+    return specs
+
+
+def get_dependency_fingerprint(
+    kipoi_model_repo: "Repository", models: List[str], commit: str
+) -> str:
+    """
+    Returns a sha256 checksum of the dependencies sections of the
+    model.yaml and dataloader.yaml files, or their templates, of the model
+    groups of <models> in kipoi model repo at <commit>. It changes if and
+    only if a dependency of one of them changes, not if for example only
+    the description of a model does.
+
+    Raises
+    ------
+    ValueError
+        If a model group does not exist in kipoi model repo at <commit>
+    """
+    checksum = hashlib.sha256()
+    for model_group in sorted({get_model_group(m) for m in models}):
+        for path, blob_sha in get_model_group_tree(
+            kipoi_model_repo, model_group, commit
+        ):
+            if Path(path).name not in DEPENDENCY_FILES:
+                continue
+            content = kipoi_model_repo.get_contents(
+                path, ref=commit
+            ).decoded_content.decode()
+            try:
+                yaml_data = YAML(typ="safe").load(JINJA_TAG.sub("", content))
+            except YAMLError:
+                yaml_data = None
+            if isinstance(yaml_data, dict):
+                dependencies = yaml_data.get("dependencies") or {}
+            else:
+                # Unparsable files are compared as a whole
+                dependencies = content
+            checksum.update(
+                f"{path}:{json.dumps(dependencies, sort_keys=True)}".encode(
+                    "utf-8"
+                )
+            )
+    return checksum.hexdigest()
+
+
+def get_pinned_versions(
+    envfile: PathType, lockfile_folder: PathType = LOCKFILE_FOLDER
+) -> Dict[str, Tuple[str, bool]]:
+    """
+    Returns a dict mapping the packages of the conda environment in
+    <envfile> to their version and whether the version is a prefix, like
+    python=3.8, rather than exact. Packages without a version in the
+    envfile are taken from the lockfiles of the environment, if it has
+    been locked, and are left out otherwise.
+    """
+    envfile_data = YAML(typ="safe").load(Path(envfile).read_text())
+    pinned = {}
+    for dependency in envfile_data["dependencies"]:
+        if isinstance(dependency, dict):
+            for spec in dependency.get("pip", []):
+                name, _, version = str(spec).partition("==")
+                if version:
+                    pinned[normalize_name(name)] = (version.strip(), False)
+            continue
+        name, _, version = str(dependency).partition("=")
+        if version.startswith("="):
+            pinned[normalize_name(name)] = (version[1:].strip(), False)
+        elif version:
+            pinned[normalize_name(name)] = (
+                version.split("=")[0].strip(),
+                True,
+            )
+    explicit_lockfile, pip_lockfile = get_lockfile_paths(
+        envfile_data["name"], lockfile_folder
+    )
+    if explicit_lockfile.exists():
+        for line in explicit_lockfile.read_text().splitlines():
+            if not line.startswith("http"):
+                continue
+            package = line.split("#")[0].rsplit("/", 1)[-1]
+            package = re.sub(r"\.(tar\.bz2|conda)$", "", package)
+            name, version, _ = package.rsplit("-", 2)
+            pinned[normalize_name(name)] = (version, False)
+    if pip_lockfile.exists():
+        for line in pip_lockfile.read_text().splitlines():
+            name, _, version = line.partition("==")
+            if version:
+                pinned[normalize_name(name)] = (version.strip(), False)
+    return pinned
+
+
+def allows(specifier: SpecifierSet, version: str, is_prefix: bool) -> bool:
+    """Returns False if no release of <version>, or of any <version>.x if
+    it is a prefix, satisfies <specifier>. Versions which can not be
+    compared are assumed to satisfy it."""
+    try:
+        if not is_prefix:
+            return specifier.contains(version, prereleases=True)
+        pinned = Version(version).release
+        for clause in specifier:
+            required = Version(clause.version.replace(".*", "")).release
+            length = min(len(required), len(pinned))
+            if required[:length] == pinned[:length]:
+                if clause.operator == "<" and len(required) <= len(pinned):
+                    return False
+                continue
+            if clause.operator in ["!=", "~="]:
+                continue
+            if required[:length] < pinned[:length]:
+                if clause.operator not in [">", ">="]:
+                    return False
+            elif clause.operator not in ["<", "<="]:
+                return False
+        return True
+    except InvalidVersion:
+        return True
+
+
+def find_conflicts(
+    specs: List[DependencySpec], pinned: Dict[str, Tuple[str, bool]]
+) -> List[str]:
+    """Returns a description of every spec in <specs> which the pinned
+    versions of an environment do not satisfy"""
+    conflicts = []
+    for name, specifier in specs:
+        if name not in pinned:
+            continue
+        version, is_prefix = pinned[name]
+        if name in MAJOR_VERSION_ONLY:
+            version, is_prefix = version.split(".")[0], True
+        if not allows(specifier, version, is_prefix):
+            conflicts.append(f"{name}{specifier} but {name}={pinned[name][0]}")
+    return conflicts
+
+
+def rule_out_conflicting_images(
+    specs: List[DependencySpec],
+    images: List[str],
+    envfile_folder: PathType = ENVFILES_FOLDER,
+    lockfile_folder: PathType = LOCKFILE_FOLDER,
+) -> List[str]:
+    """Returns those of the shared <images> whose environment in
+    <envfile_folder> does not conflict with <specs>. Images without a
+    known envfile are kept."""
+    compatible_images = []
+    for image in images:
+        envfile = Path(envfile_folder) / SHARED_ENVFILES.get(image, "")
+        if image not in SHARED_ENVFILES or not envfile.exists():
+            compatible_images.append(image)
+            continue
+        conflicts = find_conflicts(
+            specs, get_pinned_versions(envfile, lockfile_folder)
+        )
+        if conflicts:
+            logger.info(f"Ruling out {image}: {', '.join(conflicts)}")
+        else:
+            compatible_images.append(image)
+    return compatible_images
@@ -13,6 +13,8 @@ if TYPE_CHECKING:
 
 FileType = Union[str, Path]
 CONTAINER_PREFIX = "shared/containers"
+TEST_DRIVER = Path(__file__).resolve().parent / "testdriver.py"
+TEST_RESULT_PREFIX = "KIPOI_TEST_RESULT "
 
 logging.config.fileConfig(Path(__file__).resolve().parent / "logging_conf.ini")
 logger = logging.getLogger("kipoi_containers")
@@ -160,3 +162,58 @@ def one_model_per_modelgroup(all_models):
         if not any(model.split("/")[0] in s for s in model_list):
             model_list.append(model)
     return model_list
+
+
+class ModelTestFailure(ValueError):
+    """Raised if any of several models tested at once has not passed. The
+    result of every model is kept in results."""
+
+    def __init__(self, message: str, results: Dict[str, Dict]) -> None:
+        super().__init__(message)
+        self.results = results
+
+
+def get_batch_test_command(models: List[str]) -> List[str]:
+    """Returns the command which tests all <models> one after another in a
+    single python interpreter inside a container with the test driver"""
+    return ["python", "-c", TEST_DRIVER.read_text()] + list(models)
+
+
+def parse_test_results(output: str, models: List[str]) -> Dict[str, Dict]:
+    """
+    Returns a dict mapping each of <models> to its result in the output of
+    the test driver. Models without a result, since the driver has crashed
+    before getting to them, are reported as failed.
+    """
+    results = {}
+    for line in output.splitlines():
+        if line.startswith(TEST_RESULT_PREFIX):
+            result = json.loads(line[len(TEST_RESULT_PREFIX) :])
+            results[result["model"]] = result
+    for model in models:
+        if model not in results:
+            results[model] = {
+                "model": model,
+                "passed": False,
+                "error": "The test driver exited before testing this model",
+                "duration": 0.0,
+            }
+    return results
+
+
+def raise_for_failed_models(results: Dict[str, Dict], image: str) -> None:
+    """
+    Raises a ModelTestFailure listing every model in <results> of the test
+    driver which has not passed with <image>, if any.
+
+    Raises:
+        ModelTestFailure: If at least one model has failed
+    """
+    failures = [r for r in results.values() if not r["passed"]]
+    if failures:
+        summary = "\n".join(f"{r['model']}: {r['error']}" for r in failures)
+        raise ModelTestFailure(
+            f"{len(failures)} of {len(results)} models did not pass their "
+            f"tests with {image}\n{summary}",
+            results,
+        )
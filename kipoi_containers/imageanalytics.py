@@ -0,0 +1,296 @@
+from dataclasses import dataclass, field, asdict
+from datetime import date
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import click
+import docker
+import requests
+
+from kipoi_containers.dockerhelper import get_conda_env_name
+from kipoi_containers.containersession import get_session
+from kipoi_containers.helper import logger, populate_json, write_json
+from kipoi_containers.updateoradd import DOCKER_TO_MODEL_JSON
+
+PathType = Union[str, Path]
+
+IMAGE_SIZE_HISTORY_JSON = (
+    Path.cwd() / "container-info" / "image-size-history.json"
+)
+REGISTRY_AUTH_URL = "https://auth.docker.io/token"
+REGISTRY_URL = "https://registry-1.docker.io/v2"
+MANIFEST_LIST_TYPES = [
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+]
+MANIFEST_TYPES = [
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+]
+
+
+@dataclass
+class ImageStats:
+    """Sizes in bytes of a docker image, its largest layers and the
+    largest directories of its conda environment"""
+
+    name_of_docker_image: str
+    release: str
+    size: int
+    compressed_size: Optional[int]
+    layer_count: int
+    largest_layers: List[Dict] = field(default_factory=list)
+    largest_env_directories: List[Dict] = field(default_factory=list)
+
+
+def get_compressed_size(name_of_docker_image: str) -> Optional[int]:
+    """Returns the size of the compressed layers and the config of the
+    linux/amd64 variant of an image published on dockerhub, which is the
+    amount of data docker pull transfers, or None if the manifest can not
+    be fetched"""
+    repository, tag = name_of_docker_image.split(":")
+    try:
+        token = requests.get(
+            REGISTRY_AUTH_URL,
+            params={
+                "service": "registry.docker.io",
+                "scope": f"repository:{repository}:pull",
+            },
+            timeout=30,
+        ).json()["token"]
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Accept": ", ".join(MANIFEST_LIST_TYPES + MANIFEST_TYPES),
+        }
+        manifest_url = f"{REGISTRY_URL}/{repository}/manifests"
+        response = requests.get(
+            f"{manifest_url}/{tag}", headers=headers, timeout=30
+        )
+        response.raise_for_status()
+        manifest = response.json()
+        if manifest.get("mediaType") in MANIFEST_LIST_TYPES:
+            digest = next(
+                m["digest"]
+                for m in manifest["manifests"]
+                if m.get("platform", {}).get("os") == "linux"
+                and m.get("platform", {}).get("architecture") == "amd64"
+            )
+            response = requests.get(
+                f"{manifest_url}/{digest}", headers=headers, timeout=30
+            )
+            response.raise_for_status()
+            manifest = response.json()
+    except (requests.RequestException, KeyError, StopIteration) as e:
+        logger.info(
+            f"Compressed size of {name_of_docker_image} is not available: {e}"
+        )
+        return None
+    return manifest["config"]["size"] + sum(
+        layer["size"] for layer in manifest["layers"]
+    )
+
+
+def get_largest_layers(history: List[Dict], top: int) -> List[Dict]:
+    """Returns the <top> largest layers from the history of an image
+    together with the instruction which created them"""
+    layers = sorted(
+        (h for h in history if h["Size"] > 0),
+        key=lambda h: h["Size"],
+        reverse=True,
+    )
+    return [
+        {"size": h["Size"], "created_by": h["CreatedBy"][:200]}
+        for h in layers[:top]
+    ]
+
+
+def parse_du_output(du_output: str, top: int) -> List[Dict]:
+    """Returns the <top> largest directories from the output of du -k,
+    leaving out the directory du has been run on"""
+    directories = []
+    for line in du_output.splitlines():
+        size, _, path = line.partition("\t")
+        if path:
+            directories.append({"path": path, "size": int(size) * 1024})
+    directories = sorted(directories, key=lambda d: d["size"], reverse=True)
+    return directories[1 : top + 1]
+
+
+def get_largest_env_directories(
+    name_of_docker_image: str, top: int
+) -> List[Dict]:
+    """Returns the <top> largest directories up to two levels below the
+    conda environment of an image"""
+    env_folder = f"/opt/conda/envs/{get_conda_env_name(name_of_docker_image)}"
+    client = get_session().client
+    du_output = client.containers.run(
+        image=name_of_docker_image,
+        command=["du", "-k", "-d", "2", env_folder],
+        remove=True,
+    )
+    return parse_du_output(du_output.decode("utf-8"), top)
+
+
+def measure_docker_image(
+    name_of_docker_image: str, release: str, top: int = 5
+) -> ImageStats:
+    """
+    Pulls a docker image and returns its uncompressed and compressed size,
+    its number of layers and its <top> largest layers and conda
+    environment directories.
+
+    Raises:
+        docker.errors.APIError: If there is an issue connecting to the docker api
+        docker.errors.ContainerError: If du fails inside the image
+        ValueError: If the image does not activate a conda environment
+    """
+    session = get_session()
+    image = session.client.images.pull(name_of_docker_image)
+    session.invalidate(name_of_docker_image)
+    return ImageStats(
+        name_of_docker_image=name_of_docker_image,
+        release=release,
+        size=image.attrs["Size"],
+        compressed_size=get_compressed_size(name_of_docker_image),
+        layer_count=len(image.attrs["RootFS"]["Layers"]),
+        largest_layers=get_largest_layers(image.history(), top),
+        largest_env_directories=get_largest_env_directories(
+            name_of_docker_image, top
+        ),
+    )
+
+
+def record_image_stats(history: Dict, stats: ImageStats) -> None:
+    """Adds <stats> to the size history of its image, replacing earlier
+    measurements of the same release"""
+    entries = [
+        e
+        for e in history.get(stats.name_of_docker_image, [])
+        if e["release"] != stats.release
+    ]
+    history[stats.name_of_docker_image] = entries + [asdict(stats)]
+
+
+def find_size_regressions(
+    history: Dict, threshold: float, release: str
+) -> List[Dict]:
+    """
+    Returns the images measured in <release> which are more than
+    <threshold> (a fraction) larger than in the previous release. Compressed
+    sizes are compared if both are available and uncompressed sizes
+    otherwise. Images which have not been measured in <release> or
+    without a usable size in the previous release are left out.
+    """
+    regressions = []
+    for name_of_docker_image, entries in sorted(history.items()):
+        if len(entries) < 2 or entries[-1]["release"] != release:
+            continue
+        previous, current = entries[-2], entries[-1]
+        key = (
+            "compressed_size"
+            if previous["compressed_size"] and current["compressed_size"]
+            else "size"
+        )
+        if not previous[key] or current[key] is None:
+            continue
+        growth = current[key] / previous[key] - 1
+        if growth > threshold:
+            regressions.append(
+                {
+                    "name_of_docker_image": name_of_docker_image,
+                    "previous_release": previous["release"],
+                    "release": current["release"],
+                    "measure": key,
+                    "previous": previous[key],
+                    "current": current[key],
+                    "growth": growth,
+                }
+            )
+    return regressions
+
+
+def get_all_images(docker_to_model_json: PathType) -> List[str]:
+    """Returns every full and slim image in <docker_to_model_json>"""
+    return [
+        name
+        for image in sorted(populate_json(docker_to_model_json))
+        for name in [image, f"{image}-slim"]
+    ]
+
+
+@click.command()
+@click.argument("images", nargs=-1, type=str)
+@click.option(
+    "--release",
+    default=date.today().isoformat(),
+    show_default="today",
+    help="Label of this measurement in the history file",
+)
+@click.option(
+    "--threshold",
+    default=0.1,
+    show_default=True,
+    type=float,
+    help="Growth since the previous release, as a fraction, to be flagged",
+)
+@click.option("--top", default=5, show_default=True, type=int)
+@click.option(
+    "--history",
+    "history_json",
+    default=str(IMAGE_SIZE_HISTORY_JSON),
+    show_default=True,
+    type=click.Path(),
+)
+@click.option("--fail-on-regression", is_flag=True, default=False)
+def run_analysis(
+    images: List[str],
+    release: str,
+    threshold: float,
+    top: int,
+    history_json: str,
+    fail_on_regression: bool,
+) -> None:
+    """Measure the given docker images, or all full and slim images in
+    container-info/docker-to-model.json if none is given, record the
+    results in the size history and flag images which grew beyond the
+    threshold since the previous release"""
+    if not images:
+        images = get_all_images(DOCKER_TO_MODEL_JSON)
+    history = (
+        populate_json(history_json) if Path(history_json).exists() else {}
+    )
+    for image in images:
+        logger.info(f"Measuring {image}")
+        try:
+            stats = measure_docker_image(image, release, top)
+        except (docker.errors.DockerException, ValueError) as e:
+            logger.error(f"{image} could not be measured: {e}")
+            continue
+        record_image_stats(history, stats)
+        click.echo(
+            f"{image}: {stats.size / 1e9:.2f} GB, "
+            f"{(stats.compressed_size or 0) / 1e9:.2f} GB compressed, "
+            f"{stats.layer_count} layers"
+        )
+    write_json(history, history_json)
+    regressions = find_size_regressions(
+        {image: history[image] for image in images if image in history},
+        threshold,
+        release,
+    )
+    for regression in regressions:
+        click.echo(
+            f"{regression['name_of_docker_image']} grew by "
+            f"{regression['growth']:.0%} ({regression['measure']}) since "
+            f"{regression['previous_release']}: "
+            f"{regression['previous'] / 1e9:.2f} GB -> "
+            f"{regression['current'] / 1e9:.2f} GB"
+        )
+    if regressions and fail_on_regression:
+        raise click.ClickException(
+            f"{len(regressions)} images grew by more than {threshold:.0%}"
+        )
+
+
+if __name__ == "__main__":
+    run_analysis()
@@ -0,0 +1,79 @@
+from pathlib import Path
+from typing import List, Union
+
+import click
+
+from kipoi_containers.buildscheduler import (
+    DOCKERFILE_FOLDER,
+    get_models_to_test,
+)
+from kipoi_containers.dockerhelper import (
+    LOCKFILE_FOLDER,
+    build_docker_image,
+    cleanup,
+    export_lockfile,
+    get_conda_env_name_from_dockerfile,
+    test_docker_image,
+)
+from kipoi_containers.helper import populate_json
+from kipoi_containers.updateoradd import DOCKER_TO_MODEL_JSON
+
+PathType = Union[str, Path]
+
+
+def relock_docker_image(
+    name_of_docker_image: str,
+    models_to_test: List[str],
+    dockerfile_folder: PathType = DOCKERFILE_FOLDER,
+    lockfile_folder: PathType = LOCKFILE_FOLDER,
+) -> None:
+    """
+    This function solves the conda environment of a full docker image
+    anew by building it without its lockfiles, tests it with
+    <models_to_test> and, if all tests pass, replaces the lockfiles with
+    the ones exported from the new image. The image is not pushed.
+
+    Raises
+    ------
+    ValueError
+        If the dockerfile of the image does not activate a conda environment
+    """
+    dockerfile_path = (
+        Path(dockerfile_folder)
+        / f"Dockerfile.{name_of_docker_image.split(':')[1]}"
+    )
+    env_name = get_conda_env_name_from_dockerfile(dockerfile_path.read_text())
+    if env_name is None:
+        raise ValueError(
+            f"{dockerfile_path} does not activate a conda environment"
+        )
+    build_docker_image(
+        dockerfile_path=dockerfile_path,
+        name_of_docker_image=name_of_docker_image,
+        use_lockfile=False,
+    )
+    for model in models_to_test:
+        test_docker_image(image_name=name_of_docker_image, model_name=model)
+    export_lockfile(name_of_docker_image, env_name, lockfile_folder)
+    cleanup(images=True)
+
+
+@click.command()
+@click.argument("images", nargs=-1, required=True, type=str)
+def run_relock(images: List[str]) -> None:
+    """Solve the conda environments of the given full docker images anew,
+    test the images and replace their lockfiles in dockerfiles/lockfiles.
+    For example - relock_images kipoi/kipoi-docker:deepmel"""
+    docker_to_model_dict = populate_json(DOCKER_TO_MODEL_JSON)
+    for image in images:
+        if image.endswith("-slim"):
+            raise click.BadParameter(
+                f"{image} does not contain conda. Relock the full image instead"
+            )
+        relock_docker_image(
+            image, get_models_to_test(image, docker_to_model_dict)
+        )
+
+
+if __name__ == "__main__":
+    run_relock()
@@ -0,0 +1,317 @@
+import fcntl
+import os
+from pathlib import Path
+from subprocess import PIPE, Popen
+import threading
+from typing import Dict, List, Optional, Union
+
+from ruamel.yaml import YAML
+from ruamel.yaml.error import YAMLError
+
+from kipoi_containers.helper import logger
+
+PathType = Union[str, Path]
+
+KIPOI_MODEL_REPO_URL = "https://github.com/kipoi/models.git"
+MODEL_REPO_HASH_FILE = (
+    Path(__file__).resolve().parent / "kipoi-model-repo-hash"
+)
+# Where the checkout is mounted inside test containers
+CONTAINER_CHECKOUT = "/kipoi-models"
+CONTAINER_KIPOI_CONFIG = "/root/.kipoi/config.yaml"
+
+
+def get_model_repo_commit() -> str:
+    """Returns the commit of kipoi model repo this repository has last been
+    synced to, as recorded in kipoi_containers/kipoi-model-repo-hash"""
+    return MODEL_REPO_HASH_FILE.read_text().strip()
+
+
+def run_git(args: List[str], cwd: Optional[PathType] = None) -> str:
+    """
+    Runs git <args> in <cwd> without fetching git lfs files and returns
+    its stdout.
+
+    Raises:
+        ValueError: If git exits with a non zero status
+    """
+    process = Popen(
+        ["git"] + args,
+        cwd=cwd,
+        stdout=PIPE,
+        stderr=PIPE,
+        env=dict(os.environ, GIT_LFS_SKIP_SMUDGE="1"),
+    )
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise ValueError(
+            f"git {' '.join(args)} failed: {stderr.decode('utf-8')}"
+        )
+    return stdout.decode("utf-8").strip()
+
+
+def get_component_file(
+    component_dir: PathType, which: str = "model"
+) -> Optional[Path]:
+    """Returns <which>.yaml or <which>.yml of a kipoi component in
+    <component_dir>, or None if there is none"""
+    for extension in [".yaml", ".yml"]:
+        component_file = Path(component_dir) / f"{which}{extension}"
+        if component_file.exists():
+            return component_file
+    return None
+
+
+def get_component_download_dir(
+    local_path: PathType, component: str, which: str = "model"
+) -> Optional[str]:
+    """
+    Returns the folder, relative to the kipoi model source in <local_path>,
+    which kipoi downloads the files of <component> into, or None if
+    <component> is not a kipoi component. Like kipoi's LocalSource, this is
+    <component>/downloaded for a component with its own <which>.yaml and
+    <group>/downloaded for a component of a group with a models.tsv and a
+    <which>-template.yaml.
+    """
+    local_path = Path(local_path)
+    component = os.path.normpath(component)
+    if get_component_file(local_path / component, which) is not None:
+        return f"{component}/downloaded"
+    group = Path(component)
+    while str(group) not in ["", "."]:
+        group_dir = local_path / group
+        if (group_dir / "models.tsv").exists() and get_component_file(
+            group_dir, f"{which}-template"
+        ):
+            return f"{group}/downloaded"
+        group = group.parent
+    return None
+
+
+def get_model_download_dirs(local_path: PathType, model: str) -> List[str]:
+    """Returns the folders, relative to the kipoi model source in
+    <local_path>, which kipoi test <model> downloads model and example
+    files into. These are the download folder of the model and, if its
+    default dataloader lives elsewhere, the one of the dataloader. A model
+    which can not be found falls back to the folder of its model group."""
+    model_dir = get_component_download_dir(local_path, model)
+    if model_dir is None:
+        return [f"{model.split('/')[0]}/downloaded"]
+    download_dirs = [model_dir]
+    model_file = get_component_file(Path(local_path) / model)
+    if model_file is None:
+        return download_dirs
+    try:
+        model_yaml = YAML(typ="safe").load(model_file.read_text())
+    except YAMLError:
+        return download_dirs
+    dataloader = (
+        model_yaml.get("default_dataloader")
+        if isinstance(model_yaml, dict)
+        else None
+    )
+    if isinstance(dataloader, str) and dataloader != ".":
+        dataloader = os.path.normpath(os.path.join(model, dataloader))
+        dataloader_dir = get_component_download_dir(
+            local_path, dataloader, "dataloader"
+        )
+        if (
+            dataloader_dir is not None
+            and not dataloader.startswith("..")
+            and dataloader_dir not in download_dirs
+        ):
+            download_dirs.append(dataloader_dir)
+    return download_dirs
+
+
+def get_kipoi_config(local_path: str) -> str:
+    """Returns a kipoi config which makes --source=kipoi read the models
+    from <local_path> without any git operation"""
+    return (
+        "model_sources:\n"
+        "  kipoi:\n"
+        "    type: local\n"
+        f"    local_path: {local_path}\n"
+    )
+
+
+class KipoiModelCheckout:
+    """This class keeps a checkout of kipoi model repo on the host at a
+    fixed commit, which is mounted read-only into test containers together
+    with a kipoi config pointing at it. The tests then neither clone nor
+    pull kipoi model repo and all of them run against the same commit.
+    Only the folders kipoi downloads model and example files into are
+    writable, which are worked out for every model the way kipoi does."""
+
+    def __init__(
+        self,
+        checkout_folder: PathType,
+        commit: Optional[str] = None,
+        remote_url: str = KIPOI_MODEL_REPO_URL,
+    ) -> None:
+        """
+        This function instantiates KipoiModelCheckout with the host folder
+        of the checkout, the commit to check out, which defaults to the
+        one in kipoi_containers/kipoi-model-repo-hash, and the url to clone
+        kipoi model repo from.
+        """
+        self.checkout_folder = Path(checkout_folder).resolve()
+        self.remote_url = remote_url
+        self.config_file = self.checkout_folder.with_name(
+            f"{self.checkout_folder.name}-config.yaml"
+        )
+        self.commit = commit if commit else get_model_repo_commit()
+        self._lock = threading.Lock()
+        self._prepared_commit = None
+        self._pulled_groups = set()
+
+    def prepare(self) -> None:
+        """
+        Clones kipoi model repo into the checkout folder, if it has not
+        been cloned yet, checks out the commit and writes the kipoi config.
+        Other threads and processes wait until the checkout is ready.
+
+        Raises:
+            ValueError: If the commit can not be fetched or checked out
+        """
+        with self._lock:
+            if self._prepared_commit == self.commit:
+                return
+            self.checkout_folder.parent.mkdir(parents=True, exist_ok=True)
+            lock_file_path = self.checkout_folder.with_name(
+                f"{self.checkout_folder.name}.lock"
+            )
+            with open(lock_file_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self._checkout()
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self.config_file.write_text(get_kipoi_config(CONTAINER_CHECKOUT))
+            self._prepared_commit = self.commit
+            self._pulled_groups = set()
+
+    def _checkout(self) -> None:
+        if not (self.checkout_folder / ".git").exists():
+            logger.info(
+                f"Cloning {self.remote_url} into {self.checkout_folder}"
+            )
+            run_git(
+                [
+                    "clone",
+                    self.remote_url,
+                    str(self.checkout_folder),
+                ]
+            )
+        if run_git(["rev-parse", "HEAD"], self.checkout_folder) == (
+            self.commit
+        ):
+            return
+        try:
+            run_git(
+                ["cat-file", "-e", f"{self.commit}^{{commit}}"],
+                self.checkout_folder,
+            )
+        except ValueError:
+            run_git(["fetch", "origin", self.commit], self.checkout_folder)
+        logger.info(f"Checking out {self.commit} in {self.checkout_folder}")
+        run_git(["checkout", "--force", self.commit], self.checkout_folder)
+
+    def prepare_models(self, models: List[str]) -> List[str]:
+        """
+        Prepares the checkout for testing <models>, fetching the git lfs
+        files of their model groups if kipoi model repo uses git lfs, and
+        returns the folders, relative to the checkout, which kipoi
+        downloads their files into.
+
+        Raises:
+            ValueError: If the checkout can not be prepared
+        """
+        self.prepare()
+        groups = sorted({model.split("/")[0] for model in models})
+        uses_lfs = (self.checkout_folder / ".gitattributes").exists()
+        download_dirs = []
+        with self._lock:
+            for group in groups:
+                if uses_lfs and group not in self._pulled_groups:
+                    run_git(
+                        ["lfs", "pull", "--include", f"{group}/**"],
+                        self.checkout_folder,
+                    )
+                self._pulled_groups.add(group)
+            for model in models:
+                for download_dir in get_model_download_dirs(
+                    self.checkout_folder, model
+                ):
+                    if download_dir not in download_dirs:
+                        download_dirs.append(download_dir)
+                    # Mount point of the writable downloads
+                    (self.checkout_folder / download_dir).mkdir(
+                        parents=True, exist_ok=True
+                    )
+        return download_dirs
+
+    def get_mounts(
+        self,
+        models: List[str],
+        downloads_folder: Optional[PathType] = None,
+        config_path: str = CONTAINER_KIPOI_CONFIG,
+    ) -> Dict[str, Dict]:
+        """
+        Returns a dict mapping host paths to the container paths and modes
+        they are mounted with for testing <models>. The downloads of a
+        model, for example MMSplice/pathogenicity/downloaded, are kept at
+        the same path in <downloads_folder>, or in the checkout itself if
+        no downloads folder is given.
+
+        Raises:
+            ValueError: If the checkout can not be prepared
+        """
+        download_dirs = self.prepare_models(models)
+        mounts = {
+            str(self.checkout_folder): {
+                "bind": CONTAINER_CHECKOUT,
+                "mode": "ro",
+            },
+            str(self.config_file): {"bind": config_path, "mode": "ro"},
+        }
+        for download_dir in download_dirs:
+            downloads = (
+                Path(downloads_folder)
+                if downloads_folder
+                else self.checkout_folder
+            ) / download_dir
+            downloads.mkdir(parents=True, exist_ok=True)
+            mounts[str(downloads)] = {
+                "bind": f"{CONTAINER_CHECKOUT}/{download_dir}",
+                "mode": "rw",
+            }
+        return mounts
+
+
+_model_checkout = None
+_model_checkout_lock = threading.Lock()
+
+
+def get_model_checkout() -> Optional[KipoiModelCheckout]:
+    """Returns the checkout of kipoi model repo in the folder of
+    KIPOI_MODELS_CHECKOUT environment variable or None if it is not
+    specified"""
+    global _model_checkout
+    checkout_folder = os.environ.get("KIPOI_MODELS_CHECKOUT")
+    if not checkout_folder:
+        return None
+    with _model_checkout_lock:
+        if _model_checkout is None or _model_checkout.checkout_folder != (
+            Path(checkout_folder).resolve()
+        ):
+            _model_checkout = KipoiModelCheckout(checkout_folder)
+        return _model_checkout
+
+
+def pin_model_checkout(commit: str) -> None:
+    """Makes the tests run against <commit> of kipoi model repo, if they
+    use a checkout"""
+    model_checkout = get_model_checkout()
+    if model_checkout is not None:
+        model_checkout.commit = commit
@@ -0,0 +1,101 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+import time
+from typing import Callable, Dict, List
+
+from kipoi_containers.helper import logger
+
+
+@dataclass
+class Stage:
+    """A step of adding or updating an image, for example building,
+    testing or pushing it, which runs once all stages it depends on have
+    succeeded"""
+
+    name: str
+    run: Callable[[], None]
+    dependencies: List[str] = field(default_factory=list)
+
+
+def run_stages(stages: List[Stage]) -> Dict[str, str]:
+    """
+    Runs every stage as soon as all its dependencies have succeeded, so
+    that independent chains of stages, for example the tests of a full
+    image and the build of its slim image, overlap. A stage whose
+    dependency has failed is skipped. Returns a dict mapping each stage to
+    "success", "failed" or "skipped".
+
+    Raises:
+        ValueError: If a stage depends on a stage which does not exist or
+            the dependencies are cyclic
+    """
+    stages_by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        unknown = set(stage.dependencies) - set(stages_by_name)
+        if unknown:
+            raise ValueError(f"{stage.name} depends on unknown {unknown}")
+    status = {}
+    running = {}
+    started = {}
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+        while len(status) < len(stages):
+            progress = False
+            for stage in stages:
+                if stage.name in status or stage.name in running.values():
+                    continue
+                if any(
+                    status.get(d) in ["failed", "skipped"]
+                    for d in stage.dependencies
+                ):
+                    logger.error(
+                        f"Skipping {stage.name} since a stage it depends on has not succeeded"
+                    )
+                    status[stage.name] = "skipped"
+                    progress = True
+                    continue
+                if all(status.get(d) == "success" for d in stage.dependencies):
+                    logger.info(f"Starting {stage.name}")
+                    started[stage.name] = time.monotonic()
+                    running[executor.submit(stage.run)] = stage.name
+                    progress = True
+            if not running:
+                if not progress:
+                    raise ValueError(
+                        "The dependencies of "
+                        f"{set(stages_by_name) - set(status)} are cyclic"
+                    )
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                duration = time.monotonic() - started[name]
+                if future.exception() is not None:
+                    logger.error(
+                        f"{name} failed after {duration:.0f}s: {future.exception()}"
+                    )
+                    status[name] = "failed"
+                else:
+                    logger.info(f"{name} finished in {duration:.0f}s")
+                    status[name] = "success"
+    return status
+
+
+def raise_for_failed_stages(status: Dict[str, str]) -> None:
+    """
+    Raises a ValueError listing the stages which have not succeeded, if any.
+
+    Raises:
+        ValueError: If at least one stage has failed or has been skipped
+    """
+    unsuccessful = {
+        name: outcome
+        for name, outcome in status.items()
+        if outcome != "success"
+    }
+    if unsuccessful:
+        raise ValueError(
+            "Not all stages succeeded: "
+            + ", ".join(
+                f"{name} {outcome}" for name, outcome in unsuccessful.items()
+            )
+        )
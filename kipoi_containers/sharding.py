@@ -0,0 +1,118 @@
+import heapq
+from pathlib import Path
+from statistics import median
+from typing import Dict, List, Optional, Tuple, Union
+
+from kipoi_containers.helper import one_model_per_modelgroup, populate_json
+from kipoi_containers.testtelemetry import TEST_DURATIONS_JSON
+
+PathType = Union[str, Path]
+
+# Seconds assumed for a model if no test duration has been recorded at all
+DEFAULT_TEST_DURATION = 300
+
+
+def parse_shard(shard: str) -> Tuple[int, int]:
+    """
+    Returns the 1-based index and the number of shards of a shard given as
+    i/N, for example 2/5.
+
+    Raises:
+        ValueError: If <shard> is not of the form i/N with 1 <= i <= N
+    """
+    try:
+        index, num_shards = (int(part) for part in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard {shard} must be given as i/N, e.g. 2/5")
+    if not 1 <= index <= num_shards:
+        raise ValueError(f"Shard {shard} must satisfy 1 <= i <= N")
+    return index, num_shards
+
+
+def load_test_durations(
+    test_durations_json: PathType = TEST_DURATIONS_JSON,
+) -> Dict[str, float]:
+    """Returns a dict mapping models to the seconds their tests have taken
+    so far, which is empty if nothing has been recorded yet"""
+    if not Path(test_durations_json).exists():
+        return {}
+    return populate_json(test_durations_json)
+
+
+def get_models_of_image(
+    name_of_docker_image: str, docker_to_model_dict: Dict[str, List[str]]
+) -> List[str]:
+    """Returns the models tested with <name_of_docker_image>, which are the
+    models of the full image for a slim image and one model per model group
+    for a shared image"""
+    models = docker_to_model_dict.get(
+        name_of_docker_image.replace("-slim", ""), []
+    )
+    if "shared" in name_of_docker_image:
+        models = one_model_per_modelgroup(models)
+    return models
+
+
+def shard_tests(
+    tests: List[Tuple[str, str]],
+    num_shards: int,
+    test_durations: Dict[str, float],
+) -> List[List[Tuple[str, str]]]:
+    """
+    Splits <tests>, pairs of image and model, into <num_shards> shards of
+    about equal total duration. Tests are assigned longest first to the
+    shard with the least work so far, which keeps the slowest shard within
+    4/3 of the optimum. Models without a recorded duration are assumed to
+    take as long as the median recorded test. The order of tests within a
+    shard follows <tests>.
+    """
+    default_duration = (
+        median(test_durations.values())
+        if test_durations
+        else DEFAULT_TEST_DURATION
+    )
+
+    def duration(test: Tuple[str, str]) -> float:
+        return test_durations.get(test[1], default_duration)
+
+    shards = [[] for _ in range(num_shards)]
+    loads = [(0.0, index) for index in range(num_shards)]
+    for test in sorted(tests, key=duration, reverse=True):
+        load, index = heapq.heappop(loads)
+        shards[index].append(test)
+        heapq.heappush(loads, (load + duration(test), index))
+    order = {test: position for position, test in enumerate(tests)}
+    return [sorted(shard, key=order.get) for shard in shards]
+
+
+def get_shard(
+    shard: str,
+    docker_to_model_dict: Dict[str, List[str]],
+    images: Optional[List[str]] = None,
+    test_durations: Optional[Dict[str, float]] = None,
+) -> Dict[str, List[str]]:
+    """
+    Returns a dict mapping each image to its models to test in shard i/N
+    of the tests of <images>, or of every image in <docker_to_model_dict>
+    if no images are given. Durations default to
+    container-info/model-test-durations.json.
+
+    Raises:
+        ValueError: If <shard> is not of the form i/N with 1 <= i <= N
+    """
+    index, num_shards = parse_shard(shard)
+    if not images:
+        images = list(docker_to_model_dict)
+    if test_durations is None:
+        test_durations = load_test_durations()
+    tests = [
+        (image, model)
+        for image in images
+        for model in get_models_of_image(image, docker_to_model_dict)
+    ]
+    image_to_models = {}
+    for image, model in shard_tests(tests, num_shards, test_durations)[
+        index - 1
+    ]:
+        image_to_models.setdefault(image, []).append(model)
+    return image_to_models
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Union, List, Type
+from typing import Dict, Optional, Union, List, Type
 import os
 
 from ruamel.yaml.scalarstring import DoubleQuotedScalarString
@@ -13,6 +13,10 @@ from kipoi_containers.singularityhelper import (
     test_singularity_image,
     cleanup,
 )
+from kipoi_containers.testcache import (
+    ModelTestCache,
+    cached_test_singularity_image,
+)
 from kipoi_containers import zenodoclient
 
 from kipoi_utils.external.torchvision.dataset_utils import check_integrity
@@ -29,16 +33,25 @@ class SingularityHandler:
     workflow_release_data: Dict
     singularity_image_folder: Union[str, Path] = None
     zenodo_client: zenodoclient.Client = zenodoclient.Client()
+    test_cache: Optional[ModelTestCache] = None
+    batch: Optional[bool] = None
 
     def __post_init__(self):
         """If a location has not been specified for saving the downloaded
         singularity containers to, a value is populated from
         SINGULARITY_PULL_FOLDER environment variable. If there is no
-        such variable, the current directory is served as default."""
+        such variable, the current directory is served as default. Unless
+        batch is given, all models are tested in a single python
+        interpreter only if SINGULARITY_TEST_BATCH environment variable is
+        set, and each model in its own singularity exec otherwise."""
         if self.singularity_image_folder is None:
             self.singularity_image_folder = os.environ.get(
                 "SINGULARITY_PULL_FOLDER", Path(__file__).parent.resolve()
             )
+        if self.batch is None:
+            self.batch = os.environ.get(
+                "SINGULARITY_TEST_BATCH", ""
+            ).lower() in ["1", "true", "yes"]
 
     def update_container_info(self, updated_singularity_dict: Dict) -> None:
         """Update url, md5 and name keys of the model group's singularity
@@ -61,6 +74,30 @@ class SingularityHandler:
                 )
             )
 
+    def test(self, models_to_test: List) -> None:
+        """Tests the singularity image with <models_to_test>, all at once
+        with the test driver if batch is set and one after another
+        otherwise. Models which have passed with an image with the same md5
+        checksum before are skipped if a test cache is given.
+
+        Raises:
+            ValueError: If a model does not pass"""
+        batches = [list(models_to_test)] if self.batch else models_to_test
+        for models in batches:
+            if self.test_cache is not None:
+                cached_test_singularity_image(
+                    singularity_image_folder=self.singularity_image_folder,
+                    singularity_image_name=self.singularity_image_name,
+                    model=models,
+                    cache=self.test_cache,
+                )
+            else:
+                test_singularity_image(
+                    singularity_image_folder=self.singularity_image_folder,
+                    singularity_image_name=self.singularity_image_name,
+                    model=models,
+                )
+
     def add(
         self,
         models_to_test: List,
@@ -94,12 +131,7 @@ class SingularityHandler:
             singularity_image_name=self.singularity_image_name,
             singularity_image_folder=self.singularity_image_folder,
         )
-        for model in models_to_test:
-            test_singularity_image(
-                singularity_image_folder=self.singularity_image_folder,
-                singularity_image_name=self.singularity_image_name,
-                model=model,
-            )
+        self.test(models_to_test)
         if "shared" not in self.docker_image_name:
             new_singularity_dict = push_new_singularity_image(
                 zenodo_client=self.zenodo_client,
@@ -130,7 +162,9 @@ class SingularityHandler:
         3. If everything is fine, push the new image to zenodo as a new version
         and return the modified url, name and md5 as a dict
         4. Update <model_group_to_singularity_dict> with the new model
-        group as key and the dictionary with url, md5, key as values"""
+        group as key and the dictionary with url, md5, key as values
+        If a test cache is given, models which have passed with an image
+        with the same md5 checksum before are not tested again."""
         self.singularity_dict = self.model_group_to_singularity_dict[
             self.model_group
         ]
@@ -149,12 +183,7 @@ class SingularityHandler:
             )
             cleanup(singularity_image_path)
         else:
-            for model in models_to_test:
-                test_singularity_image(
-                    singularity_image_folder=self.singularity_image_folder,
-                    singularity_image_name=self.singularity_image_name,
-                    model=model,
-                )
+            self.test(models_to_test)
             updated_singularity_dict = update_existing_singularity_container(
                 zenodo_client=self.zenodo_client,
                 singularity_dict=self.singularity_dict,
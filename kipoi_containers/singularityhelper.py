@@ -2,14 +2,24 @@ from collections import Counter
 from datetime import datetime
 import os
 import requests
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, TimeoutExpired
 from pathlib import Path
 import json
-from typing import Dict, Union, TYPE_CHECKING
+from typing import Dict, List, Optional, Tuple, Union, TYPE_CHECKING
 
 from kipoi_utils.external.torchvision.dataset_utils import download_url
 
-from kipoi_containers.helper import logger
+from kipoi_containers.dockerhelper import get_test_timeout
+from kipoi_containers.downloadcache import (
+    get_singularity_binds,
+    using_kipoi_folders,
+)
+from kipoi_containers.helper import (
+    get_batch_test_command,
+    logger,
+    parse_test_results,
+    raise_for_failed_models,
+)
 
 if TYPE_CHECKING:
     import zenodoclient
@@ -66,14 +76,79 @@ def build_singularity_image(
     return singularity_image_path
 
 
+def communicate_with_timeout(
+    process: Popen, timeout: Optional[float]
+) -> Tuple[bytes, bytes, bool]:
+    """Returns the stdout and stderr of <process> and whether it has been
+    killed for running longer than <timeout> seconds"""
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+        return stdout, stderr, False
+    except TimeoutExpired:
+        process.kill()
+        stdout, stderr = process.communicate()
+        return stdout, stderr, True
+
+
+def test_singularity_image_with_models(
+    singularity_image_folder: PathType,
+    singularity_image_name: str,
+    models: List[str],
+) -> Dict[str, Dict]:
+    """Tests a singularity image residing in singularity_image_folder
+    with all <models> one after another in a single python interpreter
+    using the test driver and returns the result of each model. The test
+    driver is killed after DOCKER_TEST_TIMEOUT seconds, which fails the
+    models it has not finished yet.
+
+    Raises:
+        ValueError: Raise valueerror if any of the models is not successful"""
+    singularity_image_path = (
+        Path(singularity_image_folder) / singularity_image_name
+    )
+    logger.info(f"Testing {len(models)} models with {singularity_image_path}")
+    with using_kipoi_folders(models, str(Path.home())) as mounts:
+        exec_cmd = [
+            "singularity",
+            "exec",
+            *get_singularity_binds(mounts),
+            str(singularity_image_path),
+        ]
+        exec_cmd.extend(get_batch_test_command(models))
+        process = Popen(exec_cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr, timed_out = communicate_with_timeout(
+            process, get_test_timeout()
+        )
+    logger.info(stdout)
+    if timed_out:
+        logger.error(
+            f"The tests of {singularity_image_path} have not finished within "
+            f"{get_test_timeout()}s"
+        )
+    if process.returncode != 0:
+        logger.error(stderr)
+    results = parse_test_results(stdout.decode("utf-8"), models)
+    raise_for_failed_models(results, str(singularity_image_path))
+    return results
+
+
 def test_singularity_image(
-    singularity_image_folder: PathType, singularity_image_name: str, model: str
-) -> None:
+    singularity_image_folder: PathType,
+    singularity_image_name: str,
+    model: Union[str, List[str]],
+) -> Optional[Dict[str, Dict]]:
     """Tests a singularity image residing in singularity_image_folder
-    with kipoi test <model> --source=kipoi
+    with kipoi test <model> --source=kipoi, which is killed after
+    DOCKER_TEST_TIMEOUT seconds. If <model> is a list of models, they are
+    all tested in a single python interpreter and the result of each model
+    is returned.
 
     Raises:
         ValueError: Raise valueerror if the test is not successful"""
+    if isinstance(model, list):
+        return test_singularity_image_with_models(
+            singularity_image_folder, singularity_image_name, model
+        )
     logger.info(
         f"Testing {model} with {singularity_image_folder}/{singularity_image_name}"
     )
@@ -91,14 +166,22 @@ def test_singularity_image(
         singularity_image_folder = Path(singularity_image_folder)
     if isinstance(singularity_image_name, str):
         singularity_image_name = Path(singularity_image_name)
-    exec_cmd = [
-        "singularity",
-        "exec",
-        f"{singularity_image_folder}/{singularity_image_name}",
-    ]
-    exec_cmd.extend(test_cmd)
-    process = Popen(exec_cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
+    with using_kipoi_folders([model], str(Path.home())) as mounts:
+        exec_cmd = [
+            "singularity",
+            "exec",
+            *get_singularity_binds(mounts),
+            f"{singularity_image_folder}/{singularity_image_name}",
+        ]
+        exec_cmd.extend(test_cmd)
+        process = Popen(exec_cmd, stdout=PIPE, stderr=PIPE)
+        stdout, stderr, timed_out = communicate_with_timeout(
+            process, get_test_timeout()
+        )
+    if timed_out:
+        raise ValueError(
+            f"Singularity image {singularity_image_name} for {model} did not finish its tests within {get_test_timeout()}s"
+        )
     if process.returncode != 0:
         logger.info(stdout)
         logger.error(stderr)
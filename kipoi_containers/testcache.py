@@ -0,0 +1,248 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Union
+
+import docker
+
+from kipoi_containers.containersession import ContainerSession, get_session
+from kipoi_containers.dockerhelper import test_docker_image
+from kipoi_containers.helper import ModelTestFailure, logger
+from kipoi_containers.modelcheckout import get_model_repo_commit
+from kipoi_containers.singularityhelper import test_singularity_image
+
+PathType = Union[str, Path]
+
+TEST_RESULT_CACHE_FILE = (
+    Path.home() / ".cache" / "kipoi-containers" / "test-results.jsonl"
+)
+
+
+def get_docker_image_id(
+    name_of_docker_image: str, session: Optional[ContainerSession] = None
+) -> Optional[str]:
+    """Returns the content addressed id of a local docker image or None if
+    the image is not available locally"""
+    session = session if session else get_session()
+    try:
+        return session.inspect_image(name_of_docker_image)["Id"]
+    except docker.errors.ImageNotFound:
+        return None
+
+
+def get_singularity_image_id(singularity_image_path: PathType) -> str:
+    """Returns the md5 checksum of a singularity image"""
+    checksum = hashlib.md5()
+    with open(singularity_image_path, "rb") as file_handle:
+        for chunk in iter(lambda: file_handle.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return f"md5:{checksum.hexdigest()}"
+
+
+def get_log_hash(log: Optional[str]) -> Optional[str]:
+    """Returns the sha256 checksum of a test log, if there is one"""
+    if log is None:
+        return None
+    return hashlib.sha256(log.encode("utf-8")).hexdigest()
+
+
+class ModelTestCache:
+    """This class stores the outcome of every model test in a json lines
+    file, keyed by the id of the tested image, the model and the commit of
+    kipoi model repo the test has been run against. A model which has
+    passed with an image at a commit does not need to be tested again. It
+    is safe to use from multiple threads."""
+
+    def __init__(
+        self,
+        cache_file: Optional[PathType] = None,
+        model_repo_commit: Optional[str] = None,
+        enabled: Optional[bool] = None,
+    ) -> None:
+        """
+        This function instantiates ModelTestCache with the json lines file
+        to read results from and append results to, which defaults to
+        TEST_RESULT_CACHE environment variable or
+        ~/.cache/kipoi-containers/test-results.jsonl, and the commit of
+        kipoi model repo the tests are run against, which defaults to
+        kipoi_containers/kipoi-model-repo-hash. If enabled is False or
+        TEST_RESULT_CACHE_DISABLED environment variable is set, known
+        passes are not skipped, but results are still recorded.
+        """
+        if cache_file is None:
+            cache_file = os.environ.get(
+                "TEST_RESULT_CACHE", TEST_RESULT_CACHE_FILE
+            )
+        self.cache_file = Path(cache_file)
+        self.model_repo_commit = (
+            model_repo_commit if model_repo_commit else get_model_repo_commit()
+        )
+        if enabled is None:
+            enabled = os.environ.get(
+                "TEST_RESULT_CACHE_DISABLED", ""
+            ).lower() not in ["1", "true", "yes"]
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.results = {}
+        if self.cache_file.exists():
+            with open(self.cache_file, "r") as file_handle:
+                for line in file_handle:
+                    if line.strip():
+                        result = json.loads(line)
+                        self.results[
+                            (
+                                result["image_id"],
+                                result["model"],
+                                result["model_repo_commit"],
+                            )
+                        ] = result
+
+    def has_passed(self, image_id: Optional[str], model_name: str) -> bool:
+        """Returns True if <model_name> has passed its test with the image
+        <image_id> at the commit of kipoi model repo of this cache"""
+        if not self.enabled or image_id is None:
+            return False
+        with self._lock:
+            result = self.results.get(
+                (image_id, model_name, self.model_repo_commit)
+            )
+        return result is not None and result["passed"]
+
+    def record(
+        self,
+        image_id: Optional[str],
+        model_name: str,
+        passed: bool,
+        duration: float,
+        log: Optional[str] = None,
+    ) -> None:
+        """Appends the outcome of testing <model_name> with the image
+        <image_id> to the cache file"""
+        if image_id is None:
+            return
+        result = {
+            "image_id": image_id,
+            "model": model_name,
+            "model_repo_commit": self.model_repo_commit,
+            "passed": passed,
+            "duration": duration,
+            "log_hash": get_log_hash(log),
+            "tested_at": time.time(),
+        }
+        with self._lock:
+            self.results[(image_id, model_name, self.model_repo_commit)] = (
+                result
+            )
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.cache_file, "a") as file_handle:
+                file_handle.write(json.dumps(result) + "\n")
+
+    def run(
+        self,
+        get_image_id: Callable[[], Optional[str]],
+        models: List[str],
+        test: Callable[[List[str]], Optional[Dict[str, Dict]]],
+    ) -> None:
+        """
+        Calls <test> with those of <models> which have not passed with the
+        image yet, all at once with a list if there are several, and
+        records their outcome. The image id is looked up again afterwards
+        in case the test has pulled the image.
+
+        Raises:
+            Whatever <test> raises if a model does not pass
+        """
+        image_id = get_image_id()
+        untested = [m for m in models if not self.has_passed(image_id, m)]
+        for model in models:
+            if model not in untested:
+                logger.info(f"{model} has passed with this image before")
+        if not untested:
+            return
+        start = time.monotonic()
+        try:
+            results = test(untested if len(untested) > 1 else untested[0])
+        except ModelTestFailure as e:
+            self.record_all(get_image_id(), e.results)
+            raise
+        except Exception as e:
+            if len(untested) == 1:
+                self.record(
+                    get_image_id(),
+                    untested[0],
+                    False,
+                    time.monotonic() - start,
+                    str(e),
+                )
+            raise
+        if results is None:
+            self.record(
+                get_image_id(), untested[0], True, time.monotonic() - start
+            )
+        else:
+            self.record_all(get_image_id(), results)
+
+    def record_all(
+        self, image_id: Optional[str], results: Dict[str, Dict]
+    ) -> None:
+        """Records the results of the test driver for the image
+        <image_id>"""
+        for model, result in results.items():
+            self.record(
+                image_id,
+                model,
+                result["passed"],
+                result["duration"],
+                result["error"],
+            )
+
+
+def cached_test_docker_image(
+    image_name: str,
+    model_name: Union[str, List[str]],
+    cache: ModelTestCache,
+    session: Optional[ContainerSession] = None,
+    **run_kwargs,
+) -> None:
+    """
+    Tests a docker image like test_docker_image, skipping the models which
+    have passed with the same image before according to <cache>.
+
+    Raises:
+        The errors of test_docker_image
+    """
+    cache.run(
+        lambda: get_docker_image_id(image_name, session),
+        model_name if isinstance(model_name, list) else [model_name],
+        lambda models: test_docker_image(
+            image_name, models, session=session, **run_kwargs
+        ),
+    )
+
+
+def cached_test_singularity_image(
+    singularity_image_folder: PathType,
+    singularity_image_name: str,
+    model: Union[str, List[str]],
+    cache: ModelTestCache,
+) -> None:
+    """
+    Tests a singularity image like test_singularity_image, skipping the
+    models which have passed with an image with the same md5 checksum
+    before according to <cache>.
+
+    Raises:
+        ValueError: If a model does not pass
+    """
+    cache.run(
+        lambda: get_singularity_image_id(
+            Path(singularity_image_folder) / singularity_image_name
+        ),
+        model if isinstance(model, list) else [model],
+        lambda models: test_singularity_image(
+            singularity_image_folder, singularity_image_name, models
+        ),
+    )
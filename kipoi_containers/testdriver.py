@@ -0,0 +1,69 @@
+"""Tests several kipoi models one after another in a single python
+interpreter, so that kipoi and the deep learning frameworks are imported
+only once. This script runs inside the docker and singularity images and
+must therefore only depend on the standard library and kipoi. For every
+model one line starting with RESULT_PREFIX followed by a json object with
+model, passed, duration and error is printed to stdout.
+
+Usage: python testdriver.py <model> [<model> ...]
+"""
+
+import gc
+import json
+import sys
+import time
+import traceback
+
+RESULT_PREFIX = "KIPOI_TEST_RESULT "
+
+
+def get_test_args(model_name):
+    """Returns the arguments of kipoi test for <model_name>"""
+    if model_name == "Basenji":
+        return [model_name, "--source=kipoi", "--batch_size=2"]
+    return [model_name, "--source=kipoi"]
+
+
+def release_framework_state():
+    """Frees the graphs and sessions the previous model has left behind in
+    keras and tensorflow, if they have been imported"""
+    for module_name in ["keras", "tensorflow.keras"]:
+        module = sys.modules.get(module_name)
+        if module is None:
+            continue
+        try:
+            module.backend.clear_session()
+        except Exception:
+            pass
+    gc.collect()
+
+
+def test_model(model_name):
+    """Runs kipoi test <model_name> --source=kipoi in this interpreter and
+    returns its result instead of raising"""
+    from kipoi.cli.main import cli_test
+
+    start = time.monotonic()
+    result = {"model": model_name, "passed": True, "error": None}
+    try:
+        cli_test("test", get_test_args(model_name))
+    except SystemExit as e:
+        if e.code not in [None, 0]:
+            result["passed"] = False
+            result["error"] = f"kipoi test exited with {e.code}"
+    except Exception:
+        result["passed"] = False
+        result["error"] = traceback.format_exc(limit=5)
+    result["duration"] = time.monotonic() - start
+    release_framework_state()
+    return result
+
+
+def main(model_names):
+    for model_name in model_names:
+        result = test_model(model_name)
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,449 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Union
+
+from kipoi_containers.containersession import ContainerSession, get_session
+from kipoi_containers.dockerhelper import (
+    classify_failure,
+    get_test_timeout,
+    test_docker_image,
+)
+from kipoi_containers.helper import logger, populate_json
+from kipoi_containers.testcache import ModelTestCache, get_docker_image_id
+from kipoi_containers.testtelemetry import PEAK_MEMORY_JSON
+from kipoi_containers.warmcontainer import WarmContainer
+
+PathType = Union[str, Path]
+
+# Memory in GB reserved for a model whose peak memory has not been recorded
+DEFAULT_TEST_MEMORY = 4
+# Factor by which a recorded peak memory is scaled to reserve and limit
+MEMORY_HEADROOM = 1.5
+TEST_TIMEOUTS_JSON = Path.cwd() / "container-info" / "model-test-timeouts.json"
+
+
+@dataclass
+class ModelTestResult:
+    """Outcome of testing a model with a docker image"""
+
+    name_of_docker_image: str
+    model_name: str
+    passed: bool
+    duration: float
+    error: Optional[str] = None
+    cached: bool = False
+    failure: Optional[str] = None
+
+
+def get_host_memory() -> float:
+    """Returns the physical memory of this machine in GB"""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1e9
+
+
+def load_peak_memory(peak_memory_json: PathType = PEAK_MEMORY_JSON) -> Dict:
+    """Returns a dict mapping models to the peak memory in GB their tests
+    have needed so far, which is empty if nothing has been recorded yet"""
+    if not Path(peak_memory_json).exists():
+        return {}
+    return populate_json(peak_memory_json)
+
+
+def load_test_timeouts(
+    test_timeouts_json: PathType = TEST_TIMEOUTS_JSON,
+) -> Dict:
+    """Returns a dict mapping models which need longer or shorter than the
+    default to the seconds after which their tests are killed"""
+    if not Path(test_timeouts_json).exists():
+        return {}
+    return populate_json(test_timeouts_json)
+
+
+class ResourceBudget:
+    """This class keeps track of the memory in GB and the number of tests
+    left to the tests of every runner which shares it, for example of the
+    runners testing the full and the slim image of one pipeline at the
+    same time. It is safe to use from multiple threads."""
+
+    def __init__(self, workers: int, memory: float) -> None:
+        """This function instantiates ResourceBudget with the maximum
+        number of concurrent tests and the memory in GB available to all
+        tests combined"""
+        self.workers = max(1, workers)
+        self.memory = memory
+        self.available = memory
+        self.running = 0
+        self._condition = threading.Condition()
+
+    def try_acquire(self, requirement: float) -> bool:
+        """Reserves <requirement> GB of memory and a worker for a test and
+        returns True if both are left. A test which alone exceeds the
+        budget is admitted when no other test is running."""
+        with self._condition:
+            if self.running >= self.workers:
+                return False
+            if requirement > self.available and self.running:
+                return False
+            self.available -= requirement
+            self.running += 1
+            return True
+
+    def release(self, requirement: float) -> None:
+        """Returns what a finished test has reserved to the budget"""
+        with self._condition:
+            self.available += requirement
+            self.running -= 1
+            self._condition.notify_all()
+
+    def wait_for_release(self, timeout: float = 1) -> None:
+        """Blocks until any test of the budget has finished or for
+        <timeout> seconds"""
+        with self._condition:
+            self._condition.wait(timeout)
+
+
+def get_resource_budget(
+    workers: Optional[int] = None,
+    cpus_per_test: Optional[float] = None,
+    memory_budget: Optional[float] = None,
+) -> ResourceBudget:
+    """Returns a ResourceBudget of <workers> concurrent tests and
+    <memory_budget> GB, which unless given here are read from
+    DOCKER_TEST_WORKERS and DOCKER_TEST_MEMORY_BUDGET environment
+    variables. By default, as many tests as there are cpus for
+    <cpus_per_test> or half of the cpus and 80% of the memory of this
+    machine are used."""
+    if workers is None:
+        if os.environ.get("DOCKER_TEST_WORKERS"):
+            workers = int(os.environ["DOCKER_TEST_WORKERS"])
+        elif cpus_per_test:
+            workers = int(os.cpu_count() // cpus_per_test)
+        else:
+            workers = os.cpu_count() // 2
+    if memory_budget is None:
+        memory_budget = float(
+            os.environ.get(
+                "DOCKER_TEST_MEMORY_BUDGET", 0.8 * get_host_memory()
+            )
+        )
+    return ResourceBudget(workers, memory_budget)
+
+
+class ModelTestRunner:
+    """This class tests a docker image with several models concurrently.
+    Tests are only started while the memory they are expected to need fits
+    into a memory budget and every failure is collected instead of
+    aborting the remaining tests. Optionally, all tests of an image are
+    run inside one warm container."""
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        cpus_per_test: Optional[float] = None,
+        memory_budget: Optional[float] = None,
+        peak_memory: Optional[Dict[str, float]] = None,
+        session: Optional[ContainerSession] = None,
+        test: Callable = test_docker_image,
+        warm: Optional[bool] = None,
+        cache: Optional[ModelTestCache] = None,
+        timeout: Optional[float] = None,
+        test_timeouts: Optional[Dict[str, float]] = None,
+        budget: Optional[ResourceBudget] = None,
+    ) -> None:
+        """
+        This function instantiates ModelTestRunner with the maximum number
+        of concurrent tests, the number of cpus each test container is
+        limited to, the memory in GB available to all tests combined and
+        the recorded peak memory in GB of each model. Unless given here,
+        they are read from DOCKER_TEST_WORKERS, DOCKER_TEST_CPUS and
+        DOCKER_TEST_MEMORY_BUDGET environment variables and from
+        container-info/model-peak-memory.json. By default, half of the cpus
+        and 80% of the memory of this machine are used and the cpus of a
+        test container are not limited. If warm or DOCKER_TEST_WARM_CONTAINER
+        environment variable is set, the models are tested with docker exec
+        in one long-lived container per image instead of one container per
+        model. If a cache is given, models which have passed with the same
+        image before are not tested again and all results are recorded.
+        The test of a model is killed after its timeout in seconds in
+        container-info/model-test-timeouts.json or after timeout, which
+        defaults to DOCKER_TEST_TIMEOUT environment variable or an hour.
+        If a budget is given, the workers and memory are the ones of the
+        budget, which is shared with every other runner using it.
+        """
+        if cpus_per_test is None and os.environ.get("DOCKER_TEST_CPUS"):
+            cpus_per_test = float(os.environ["DOCKER_TEST_CPUS"])
+        self.cpus_per_test = cpus_per_test
+        if budget is None:
+            budget = get_resource_budget(workers, cpus_per_test, memory_budget)
+        self.budget = budget
+        self.workers = budget.workers
+        self.memory_budget = budget.memory
+        self.peak_memory = (
+            peak_memory if peak_memory is not None else load_peak_memory()
+        )
+        self.session = session if session else get_session()
+        self.test = test
+        if warm is None:
+            warm = os.environ.get(
+                "DOCKER_TEST_WARM_CONTAINER", ""
+            ).lower() in ["1", "true", "yes"]
+        self.warm = warm
+        self.cache = cache
+        self.timeout = get_test_timeout(timeout)
+        self.test_timeouts = (
+            test_timeouts
+            if test_timeouts is not None
+            else load_test_timeouts()
+        )
+
+    def get_memory_requirement(self, model_name: str) -> float:
+        """Returns the memory in GB reserved for testing <model_name>"""
+        if model_name in self.peak_memory:
+            return self.peak_memory[model_name] * MEMORY_HEADROOM
+        return DEFAULT_TEST_MEMORY
+
+    def get_timeout(self, model_name: str) -> float:
+        """Returns the seconds after which the test of <model_name> is
+        killed"""
+        return self.test_timeouts.get(model_name, self.timeout)
+
+    def get_run_kwargs(self, model_name: str) -> Dict:
+        """Returns the resource limits of the container testing
+        <model_name>. Memory is only limited for models with a recorded
+        peak memory, so that an unknown model is not killed for exceeding
+        a guess."""
+        run_kwargs = {}
+        if self.cpus_per_test:
+            run_kwargs["nano_cpus"] = int(self.cpus_per_test * 1e9)
+        if model_name in self.peak_memory:
+            run_kwargs["mem_limit"] = (
+                f"{int(self.get_memory_requirement(model_name) * 1024)}m"
+            )
+        return run_kwargs
+
+    def get_warm_run_kwargs(self) -> Dict:
+        """Returns the resource limits of a warm container, which runs as
+        many tests at once as there are workers. Its memory is not limited
+        since the memory budget already bounds the concurrent tests."""
+        if self.cpus_per_test:
+            return {"nano_cpus": int(self.cpus_per_test * self.workers * 1e9)}
+        return {}
+
+    def run_test(
+        self,
+        name_of_docker_image: str,
+        model_name: str,
+        warm_container: Optional[WarmContainer] = None,
+    ) -> ModelTestResult:
+        """Tests <model_name> with <name_of_docker_image>, inside
+        <warm_container> if given, and returns the outcome instead of
+        raising. A test which times out is killed, so that its worker
+        moves on to the next model."""
+        logger.info(f"Testing {model_name} with {name_of_docker_image}")
+        start = time.monotonic()
+        try:
+            if warm_container is not None:
+                warm_container.test(
+                    model_name, timeout=self.get_timeout(model_name)
+                )
+            else:
+                self.test(
+                    image_name=name_of_docker_image,
+                    model_name=model_name,
+                    session=self.session,
+                    timeout=self.get_timeout(model_name),
+                    **self.get_run_kwargs(model_name),
+                )
+        except Exception as e:
+            return ModelTestResult(
+                name_of_docker_image=name_of_docker_image,
+                model_name=model_name,
+                passed=False,
+                duration=time.monotonic() - start,
+                error=str(e),
+                failure=classify_failure(e),
+            )
+        return ModelTestResult(
+            name_of_docker_image=name_of_docker_image,
+            model_name=model_name,
+            passed=True,
+            duration=time.monotonic() - start,
+        )
+
+    def run(
+        self, name_of_docker_image: str, models: List[str]
+    ) -> List[ModelTestResult]:
+        """
+        Tests <name_of_docker_image> with all <models>, leaving out those
+        which have passed with the same image before according to the
+        cache, and returns their results in the order of <models>.
+
+        Raises:
+            docker.errors.ImageNotFound: If a warm container of an image
+                which cannot be found is to be started
+            docker.errors.APIError: If there is an issue connecting to the docker api
+        """
+        if self.cache is None:
+            return self.run_in_containers(name_of_docker_image, models)
+        image_id = get_docker_image_id(name_of_docker_image, self.session)
+        results = {
+            model: ModelTestResult(
+                name_of_docker_image=name_of_docker_image,
+                model_name=model,
+                passed=True,
+                duration=0.0,
+                cached=True,
+            )
+            for model in models
+            if self.cache.has_passed(image_id, model)
+        }
+        if results:
+            logger.info(
+                f"{len(results)} models have passed with "
+                f"{name_of_docker_image} before"
+            )
+        untested = [model for model in models if model not in results]
+        tested = self.run_in_containers(name_of_docker_image, untested)
+        # The image may have been pulled by the first test
+        image_id = get_docker_image_id(name_of_docker_image, self.session)
+        for result in tested:
+            self.cache.record(
+                image_id,
+                result.model_name,
+                result.passed,
+                result.duration,
+                result.error,
+            )
+            results[result.model_name] = result
+        return [results[model] for model in models]
+
+    def run_in_containers(
+        self, name_of_docker_image: str, models: List[str]
+    ) -> List[ModelTestResult]:
+        """
+        Tests <name_of_docker_image> with all <models>, inside one warm
+        container if enabled, and returns their results in the order of
+        <models>.
+
+        Raises:
+            docker.errors.ImageNotFound: If a warm container of an image
+                which cannot be found is to be started
+            docker.errors.APIError: If there is an issue connecting to the docker api
+        """
+        if not self.warm or not models:
+            return self.schedule(name_of_docker_image, models)
+        with WarmContainer(
+            name_of_docker_image,
+            session=self.session,
+            models=models,
+            **self.get_warm_run_kwargs(),
+        ) as warm_container:
+            # The first test clones the kipoi model repository into the
+            # container, which concurrent clones would corrupt
+            results = self.schedule(
+                name_of_docker_image, models[:1], warm_container
+            )
+            return results + self.schedule(
+                name_of_docker_image, models[1:], warm_container
+            )
+
+    def schedule(
+        self,
+        name_of_docker_image: str,
+        models: List[str],
+        warm_container: Optional[WarmContainer] = None,
+    ) -> List[ModelTestResult]:
+        """
+        Tests <name_of_docker_image> with all <models>, inside
+        <warm_container> if given, and returns their results in the order
+        of <models>. A test starts as soon as a worker is free and the
+        memory reserved for it fits into what is left of the budget, which
+        may be shared with other runners. A test which alone exceeds the
+        budget runs when no other test is running.
+        """
+        results = {}
+        pending = list(models)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                for model in list(pending):
+                    if self.budget.try_acquire(
+                        self.get_memory_requirement(model)
+                    ):
+                        pending.remove(model)
+                        running[
+                            executor.submit(
+                                self.run_test,
+                                name_of_docker_image,
+                                model,
+                                warm_container,
+                            )
+                        ] = model
+                if not running:
+                    # Every worker or the memory is taken by another runner
+                    self.budget.wait_for_release()
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    model = running.pop(future)
+                    self.budget.release(self.get_memory_requirement(model))
+                    result = future.result()
+                    if result.passed:
+                        logger.info(
+                            f"{model} passed with {name_of_docker_image} in "
+                            f"{result.duration:.0f}s"
+                        )
+                    else:
+                        logger.error(
+                            f"{model} failed with {name_of_docker_image} "
+                            f"({result.failure}): {result.error}"
+                        )
+                    results[model] = result
+        return [results[model] for model in models]
+
+
+def raise_for_failures(results: List[ModelTestResult]) -> None:
+    """
+    Raises a ValueError listing every failed test in <results>, if any.
+
+    Raises:
+        ValueError: If at least one test has failed
+    """
+    failures = [result for result in results if not result.passed]
+    if failures:
+        summary = "\n".join(
+            f"{result.model_name} with {result.name_of_docker_image} "
+            f"({result.failure}): {result.error}"
+            for result in failures
+        )
+        raise ValueError(
+            f"{len(failures)} of {len(results)} tests failed\n{summary}"
+        )
+
+
+def run_model_tests(
+    name_of_docker_image: str,
+    models: List[str],
+    session: Optional[ContainerSession] = None,
+    cache: Optional[ModelTestCache] = None,
+    budget: Optional[ResourceBudget] = None,
+) -> List[ModelTestResult]:
+    """
+    Tests <name_of_docker_image> with all <models> concurrently and returns
+    their results. Models which have passed with the same image before
+    according to <cache> are skipped. Tests which run at the same time as
+    those of other images, for example of the full and the slim image of
+    one pipeline, share a <budget> so that they fit into the machine
+    together.
+
+    Raises:
+        ValueError: If at least one test has failed
+    """
+    results = ModelTestRunner(session=session, cache=cache, budget=budget).run(
+        name_of_docker_image, models
+    )
+    raise_for_failures(results)
+    return results
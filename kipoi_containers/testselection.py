@@ -0,0 +1,103 @@
+import os
+from typing import Dict, List, Optional, Set
+
+from kipoi_containers.helper import logger, one_model_per_modelgroup
+
+# Number of models tested besides the changed ones to check that the rest
+# of an image still works
+DEFAULT_SAMPLE_SIZE = 2
+# Files of a model group which list its models with one row per model
+MODEL_TABLES = ["models.tsv"]
+
+
+def get_changed_table_rows(patch: str) -> Set[str]:
+    """Returns the first column of every row added or removed by the
+    unified diff <patch> of a table of models, except the header"""
+    rows = set()
+    for line in patch.splitlines():
+        if line.startswith(("+++", "---")) or line[:1] not in ["+", "-"]:
+            continue
+        first_column = line[1:].split("\t")[0].strip()
+        if first_column and first_column != "model":
+            rows.add(first_column)
+    return rows
+
+
+def get_changed_models(
+    models: List[str], changed_files: Dict[str, Optional[str]]
+) -> List[str]:
+    """
+    Returns those of <models> which are affected by <changed_files>, a dict
+    mapping the paths changed in kipoi model repo to their patch, if
+    available. A model is affected if a file inside its directory has
+    changed, or if a table of models has changed in its row. Any other
+    change inside a model group, for example to its model.yaml template or
+    dataloader, affects all of its models.
+    """
+    changed_models = set()
+    for path, patch in changed_files.items():
+        owners = [model for model in models if path.startswith(f"{model}/")]
+        if owners:
+            # The innermost directory, e.g. DeepMEL/Fly rather than DeepMEL
+            changed_models.add(max(owners, key=len))
+            continue
+        group_models = [
+            model
+            for model in models
+            if model.split("/")[0] == path.split("/")[0]
+        ]
+        if path.split("/")[-1] in MODEL_TABLES and patch:
+            rows = get_changed_table_rows(patch)
+            changed_models.update(
+                model
+                for model in group_models
+                if model.split("/", 1)[-1] in rows
+            )
+        else:
+            changed_models.update(group_models)
+    return [model for model in models if model in changed_models]
+
+
+def select_models_to_test(
+    models: List[str],
+    changed_files: Optional[Dict[str, Optional[str]]],
+    sample_size: Optional[int] = None,
+    test_all: Optional[bool] = None,
+) -> List[str]:
+    """
+    Returns the models of an image to test after <changed_files> in kipoi
+    model repo, which are those of <models> affected by the changes and a
+    sample of <sample_size> unaffected models from different model groups.
+    The sample size defaults to DOCKER_TEST_SAMPLE_SIZE environment
+    variable or 2. All models are returned if test_all or
+    DOCKER_TEST_ALL_MODELS environment variable is set, if the changed
+    files are unknown or if no model can be attributed to them.
+    """
+    if test_all is None:
+        test_all = os.environ.get("DOCKER_TEST_ALL_MODELS", "").lower() in [
+            "1",
+            "true",
+            "yes",
+        ]
+    if test_all or not changed_files:
+        return models
+    changed_models = get_changed_models(models, changed_files)
+    if not changed_models:
+        logger.info("No model is affected by the changes. Testing all models")
+        return models
+    if sample_size is None:
+        sample_size = int(
+            os.environ.get("DOCKER_TEST_SAMPLE_SIZE", DEFAULT_SAMPLE_SIZE)
+        )
+    unchanged_models = [m for m in models if m not in changed_models]
+    sample = one_model_per_modelgroup(unchanged_models)[:sample_size]
+    if len(sample) < sample_size:
+        sample += [m for m in unchanged_models if m not in sample][
+            : sample_size - len(sample)
+        ]
+    selected = set(changed_models + sample)
+    logger.info(
+        f"Testing {len(changed_models)} changed and {len(sample)} unchanged "
+        f"of {len(models)} models"
+    )
+    return [model for model in models if model in selected]
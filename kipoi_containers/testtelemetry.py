@@ -0,0 +1,298 @@
+from dataclasses import dataclass, asdict
+from datetime import datetime
+import json
+from pathlib import Path
+import threading
+from typing import Dict, List, Optional, Union
+
+import click
+
+from kipoi_containers.helper import logger, populate_json, write_json
+
+PathType = Union[str, Path]
+
+TELEMETRY_FILE_NAME = "test-telemetry.jsonl"
+PEAK_MEMORY_JSON = Path.cwd() / "container-info" / "model-peak-memory.json"
+TEST_DURATIONS_JSON = (
+    Path.cwd() / "container-info" / "model-test-durations.json"
+)
+
+
+@dataclass
+class ContainerTelemetry:
+    """Resource usage of the container which has tested a model with a
+    docker image. Memory, block I/O and network traffic are in bytes."""
+
+    name_of_docker_image: str
+    model_name: str
+    started: str
+    duration: float = 0.0
+    exit_code: Optional[int] = None
+    failure: Optional[str] = None
+    peak_memory: int = 0
+    peak_cpu_percent: float = 0.0
+    block_read: int = 0
+    block_write: int = 0
+    network_received: int = 0
+    network_sent: int = 0
+
+
+def get_memory_usage(stats: Dict) -> int:
+    """Returns the memory used by a container according to a sample of
+    docker stats, leaving out the page cache like docker stats does"""
+    memory_stats = stats.get("memory_stats", {})
+    usage = memory_stats.get("usage", 0)
+    cache_stats = memory_stats.get("stats", {})
+    # cgroup v1 reports total_inactive_file and cgroup v2 inactive_file
+    inactive_file = cache_stats.get(
+        "total_inactive_file", cache_stats.get("inactive_file", 0)
+    )
+    return max(usage - inactive_file, 0)
+
+
+def get_cpu_percent(stats: Dict) -> float:
+    """Returns the cpu usage of a container in percent of one cpu since
+    the previous sample of docker stats"""
+    cpu_stats = stats.get("cpu_stats", {})
+    precpu_stats = stats.get("precpu_stats", {})
+    cpu_delta = cpu_stats.get("cpu_usage", {}).get(
+        "total_usage", 0
+    ) - precpu_stats.get("cpu_usage", {}).get("total_usage", 0)
+    system_delta = cpu_stats.get("system_cpu_usage", 0) - precpu_stats.get(
+        "system_cpu_usage", 0
+    )
+    if cpu_delta <= 0 or system_delta <= 0:
+        return 0.0
+    online_cpus = cpu_stats.get("online_cpus") or len(
+        cpu_stats.get("cpu_usage", {}).get("percpu_usage") or [1]
+    )
+    return cpu_delta / system_delta * online_cpus * 100
+
+
+def get_block_io(stats: Dict) -> Dict[str, int]:
+    """Returns the bytes a container has read from and written to block
+    devices so far according to a sample of docker stats"""
+    block_io = {"read": 0, "write": 0}
+    for entry in (
+        stats.get("blkio_stats", {}).get("io_service_bytes_recursive") or []
+    ):
+        operation = entry.get("op", "").lower()
+        if operation in block_io:
+            block_io[operation] += entry.get("value", 0)
+    return block_io
+
+
+def get_network_io(stats: Dict) -> Dict[str, int]:
+    """Returns the bytes a container has received and sent over all its
+    networks so far according to a sample of docker stats"""
+    networks = (stats.get("networks") or {}).values()
+    return {
+        "received": sum(n.get("rx_bytes", 0) for n in networks),
+        "sent": sum(n.get("tx_bytes", 0) for n in networks),
+    }
+
+
+class StatsSampler:
+    """This class follows the docker stats of a running container in a
+    background thread and keeps the peaks and totals of its resource
+    usage in a ContainerTelemetry"""
+
+    def __init__(self, container, telemetry: ContainerTelemetry) -> None:
+        """This function instantiates StatsSampler with a running docker
+        container and the telemetry to fill in"""
+        self.container = container
+        self.telemetry = telemetry
+        self._thread = threading.Thread(target=self.sample, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def update(self, stats: Dict) -> None:
+        """Updates the telemetry with a sample of docker stats. Counters
+        of a container which has already stopped are reported as zero and
+        are ignored."""
+        telemetry = self.telemetry
+        telemetry.peak_memory = max(
+            telemetry.peak_memory,
+            get_memory_usage(stats),
+            stats.get("memory_stats", {}).get("max_usage", 0),
+        )
+        telemetry.peak_cpu_percent = max(
+            telemetry.peak_cpu_percent, get_cpu_percent(stats)
+        )
+        block_io = get_block_io(stats)
+        telemetry.block_read = max(telemetry.block_read, block_io["read"])
+        telemetry.block_write = max(telemetry.block_write, block_io["write"])
+        network_io = get_network_io(stats)
+        telemetry.network_received = max(
+            telemetry.network_received, network_io["received"]
+        )
+        telemetry.network_sent = max(
+            telemetry.network_sent, network_io["sent"]
+        )
+
+    def sample(self) -> None:
+        """Consumes the stats stream until the container stops"""
+        try:
+            for stats in self.container.stats(stream=True, decode=True):
+                self.update(stats)
+        except Exception as e:
+            logger.debug(f"Stats of {self.container.short_id} ended: {e}")
+
+    def stop(self, timeout: float = 5) -> ContainerTelemetry:
+        """Waits for the stats stream of the stopped container to end and
+        returns the telemetry"""
+        self._thread.join(timeout)
+        return self.telemetry
+
+
+_telemetry_lock = threading.Lock()
+
+
+def record_telemetry(
+    telemetry: ContainerTelemetry, telemetry_folder: PathType
+) -> None:
+    """Appends <telemetry> to test-telemetry.jsonl in <telemetry_folder>"""
+    telemetry_folder = Path(telemetry_folder)
+    telemetry_folder.mkdir(parents=True, exist_ok=True)
+    with _telemetry_lock:
+        with open(telemetry_folder / TELEMETRY_FILE_NAME, "a") as file_handle:
+            file_handle.write(json.dumps(asdict(telemetry)) + "\n")
+
+
+def new_telemetry(
+    name_of_docker_image: str, model_name: str
+) -> ContainerTelemetry:
+    """Returns empty telemetry of a test which starts now"""
+    return ContainerTelemetry(
+        name_of_docker_image=name_of_docker_image,
+        model_name=model_name,
+        started=datetime.now().isoformat(timespec="seconds"),
+    )
+
+
+def load_telemetry(telemetry_folder: PathType) -> List[Dict]:
+    """Returns every record in test-telemetry.jsonl in <telemetry_folder>"""
+    telemetry_file = Path(telemetry_folder) / TELEMETRY_FILE_NAME
+    if not telemetry_file.exists():
+        return []
+    with open(telemetry_file, "r") as file_handle:
+        return [json.loads(line) for line in file_handle if line.strip()]
+
+
+def get_peak_memory_by_model(records: List[Dict]) -> Dict[str, float]:
+    """Returns the highest peak memory in GB of each model across the
+    records of successful tests"""
+    peak_memory = {}
+    for record in records:
+        if record["exit_code"] != 0 or not record["peak_memory"]:
+            continue
+        peak_memory[record["model_name"]] = round(
+            max(
+                peak_memory.get(record["model_name"], 0),
+                record["peak_memory"] / 1e9,
+            ),
+            3,
+        )
+    return peak_memory
+
+
+def update_peak_memory(
+    records: List[Dict], peak_memory_json: PathType = PEAK_MEMORY_JSON
+) -> Dict[str, float]:
+    """Merges the peak memory of each model in <records> into
+    <peak_memory_json>, which the test runner uses to admit tests, and
+    returns the merged peaks. The higher of the recorded and the new peak
+    is kept, so that a light run does not lower what is reserved."""
+    peak_memory = (
+        populate_json(peak_memory_json)
+        if Path(peak_memory_json).exists()
+        else {}
+    )
+    for model, peak in get_peak_memory_by_model(records).items():
+        peak_memory[model] = max(peak_memory.get(model, 0), peak)
+    write_json(dict(sorted(peak_memory.items())), peak_memory_json)
+    return peak_memory
+
+
+def get_duration_by_model(records: List[Dict]) -> Dict[str, float]:
+    """Returns the duration in seconds of the latest successful test of
+    each model in the records"""
+    return {
+        record["model_name"]: round(record["duration"], 1)
+        for record in records
+        if record["exit_code"] == 0
+    }
+
+
+def update_test_durations(
+    records: List[Dict], test_durations_json: PathType = TEST_DURATIONS_JSON
+) -> Dict[str, float]:
+    """Merges the test duration of each model in <records> into
+    <test_durations_json>, which is used to shard the tests, and returns
+    the merged durations. The longer of the recorded and the new duration
+    is kept, so that a single fast run does not unbalance the shards."""
+    test_durations = (
+        populate_json(test_durations_json)
+        if Path(test_durations_json).exists()
+        else {}
+    )
+    for model, duration in get_duration_by_model(records).items():
+        test_durations[model] = max(test_durations.get(model, 0), duration)
+    write_json(dict(sorted(test_durations.items())), test_durations_json)
+    return test_durations
+
+
+@click.command()
+@click.argument(
+    "telemetry_folder", required=True, type=click.Path(exists=True)
+)
+@click.option("--top", default=10, show_default=True, type=int)
+@click.option(
+    "--update-peak-memory",
+    "update_peak_memory_json",
+    is_flag=True,
+    default=False,
+    help="Merge the peak memory of every model into "
+    "container-info/model-peak-memory.json",
+)
+@click.option(
+    "--update-test-durations",
+    "update_test_durations_json",
+    is_flag=True,
+    default=False,
+    help="Merge the test duration of every model into "
+    "container-info/model-test-durations.json",
+)
+def run_summary(
+    telemetry_folder: str,
+    top: int,
+    update_peak_memory_json: bool,
+    update_test_durations_json: bool,
+) -> None:
+    """Print the models whose tests in TELEMETRY_FOLDER needed the most
+    memory, took the longest and downloaded the most"""
+    records = load_telemetry(telemetry_folder)
+    for title, key, unit, scale in [
+        ("Peak memory", "peak_memory", "GB", 1e9),
+        ("Duration", "duration", "s", 1),
+        ("Downloaded", "network_received", "MB", 1e6),
+    ]:
+        click.echo(title)
+        for record in sorted(records, key=lambda r: r[key], reverse=True)[
+            :top
+        ]:
+            click.echo(
+                f"{record[key] / scale:>10.1f}{unit:<3}"
+                f"{record['model_name']} with "
+                f"{record['name_of_docker_image']} "
+                f"(exit code {record['exit_code']})"
+            )
+    if update_peak_memory_json:
+        update_peak_memory(records)
+    if update_test_durations_json:
+        update_test_durations(records)
+
+
+if __name__ == "__main__":
+    run_summary()
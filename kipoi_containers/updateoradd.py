@@ -6,9 +6,18 @@ import logging.config
 
 from github import Github
 
+from kipoi_containers.buildmanifest import BuildManifest
+from kipoi_containers.compatibilitymatrix import CompatibilityMatrix
+from kipoi_containers.containersession import ContainerSession
 from kipoi_containers.dockeradder import DockerAdder
-from kipoi_containers.dockerupdater import DockerUpdater
+from kipoi_containers.dockerupdater import (
+    DockerUpdater,
+    update_full_and_slim,
+)
+from kipoi_containers.modelcheckout import pin_model_checkout
 from kipoi_containers.singularityhandler import SingularityHandler
+from kipoi_containers.testcache import ModelTestCache
+from kipoi_containers.testselection import select_models_to_test
 from kipoi_containers.helper import (
     populate_json,
     populate_json_from_kipoi,
@@ -61,7 +70,16 @@ class ModelSyncer:
         )
         self.workflow_test_data = populate_yaml(TEST_IMAGES_WORKFLOW)
         self.workflow_release_data = populate_yaml(RELEASE_WORKFLOW)
+        self.build_manifest = BuildManifest()
+        self.compatibility_matrix = CompatibilityMatrix()
+        self.container_session = ContainerSession()
+        self.test_cache = ModelTestCache(
+            model_repo_commit=self.target_commit_hash
+        )
+        # Models are tested against the commit being synced to
+        pin_model_checkout(self.target_commit_hash)
         self.list_of_updated_model_groups = []
+        self.changed_files = {}
 
     def get_list_of_updated_model_groups(self) -> None:
         """
@@ -72,6 +90,9 @@ class ModelSyncer:
         comparison_obj = self.kipoi_model_repo.compare(
             base=self.source_commit_hash, head=self.target_commit_hash
         )
+        self.changed_files = {
+            f.filename: f.patch for f in comparison_obj.files
+        }
 
         self.list_of_updated_model_groups = list(
             dict.fromkeys(
@@ -122,30 +143,54 @@ class ModelSyncer:
     def update_or_add_model_container(self, model_group: str) -> None:
         """
         Calls appropariate functions based on whether a model group has
-        been updated or added.
+        been updated or added. An updated image is only tested with the
+        models affected by the changes in kipoi model repo and a sample of
+        the others, unless DOCKER_TEST_ALL_MODELS is set.
         """
         if model_group in self.model_group_to_docker_dict:
             name_of_docker_image = self.model_group_to_docker_dict[model_group]
             slim_docker_image = f"{name_of_docker_image}-slim"
-            models_to_test = self.docker_to_model_dict[name_of_docker_image]
+            all_models = self.docker_to_model_dict[name_of_docker_image]
+            models_to_test = select_models_to_test(
+                all_models, self.changed_files
+            )
             singularity_handler = SingularityHandler(
                 model_group=model_group,
                 docker_image_name=slim_docker_image,
                 model_group_to_singularity_dict=self.model_group_to_singularity_dict,
                 workflow_release_data=self.workflow_release_data,
+                test_cache=self.test_cache,
             )
             if "shared" not in name_of_docker_image:
                 docker_updater = DockerUpdater(
                     model_group=model_group,
                     name_of_docker_image=name_of_docker_image,
+                    kipoi_model_repo=self.kipoi_model_repo,
+                    model_repo_commit=self.target_commit_hash,
+                    build_manifest=self.build_manifest,
+                    session=self.container_session,
+                    test_cache=self.test_cache,
                 )
-                docker_updater.update(models_to_test)
                 slim_docker_updater = DockerUpdater(
                     model_group=model_group,
                     name_of_docker_image=slim_docker_image,
+                    kipoi_model_repo=self.kipoi_model_repo,
+                    model_repo_commit=self.target_commit_hash,
+                    build_manifest=self.build_manifest,
+                    session=self.container_session,
+                    test_cache=self.test_cache,
+                )
+                # Singularity image is converted from the slim docker image
+                # as soon as it has been pushed
+                update_full_and_slim(
+                    docker_updater,
+                    slim_docker_updater,
+                    models_to_test,
+                    all_models=all_models,
+                    on_slim_image_published=lambda: singularity_handler.update(
+                        models_to_test
+                    ),
                 )
-                slim_docker_updater.update(models_to_test)
-                singularity_handler.update(models_to_test)
             else:
                 logger.info(
                     f"We will not be updating {name_of_docker_image} and {slim_docker_image}"
@@ -155,24 +200,33 @@ class ModelSyncer:
                 model_group=model_group,
                 kipoi_model_repo=self.kipoi_model_repo,
                 kipoi_container_repo=self.kipoi_container_repo,
+                session=self.container_session,
+                model_repo_commit=self.target_commit_hash,
+                compatibility_matrix=self.compatibility_matrix,
             )
+
+            def add_singularity_image() -> None:
+                # The image name is only known once the model group has
+                # been checked against the existing images
+                singularity_handler = SingularityHandler(
+                    model_group=model_group,
+                    docker_image_name=f"{model_adder.image_name}-slim",
+                    model_group_to_singularity_dict=self.model_group_to_singularity_dict,
+                    workflow_release_data=self.workflow_release_data,
+                )
+                singularity_handler.add(
+                    model_adder.list_of_models
+                    if model_adder.list_of_models
+                    else [model_adder.model_group],
+                    self.docker_to_model_dict,
+                )
+
             model_adder.add(
                 model_group_to_docker_dict=self.model_group_to_docker_dict,
                 docker_to_model_dict=self.docker_to_model_dict,
                 workflow_test_data=self.workflow_test_data,
                 workflow_release_data=self.workflow_release_data,
-            )
-            singularity_handler = SingularityHandler(
-                model_group=model_group,
-                docker_image_name=f"{model_adder.image_name}-slim",
-                model_group_to_singularity_dict=self.model_group_to_singularity_dict,
-                workflow_release_data=self.workflow_release_data,
-            )
-            singularity_handler.add(
-                model_adder.list_of_models
-                if model_adder.list_of_models
-                else [model_adder.model_group],
-                self.docker_to_model_dict,
+                on_slim_image_published=add_singularity_image,
             )
 
     def sync(self) -> None:
@@ -0,0 +1,152 @@
+import time
+from typing import List, Optional
+
+from docker.errors import APIError
+
+from kipoi_containers.containersession import ContainerSession, get_session
+from kipoi_containers.downloadcache import (
+    add_docker_volumes,
+    get_download_cache,
+    get_kipoi_mounts,
+)
+from kipoi_containers.modelcheckout import get_model_checkout
+from kipoi_containers.dockerhelper import (
+    FAILURE_EXIT,
+    FAILURE_OOM_KILLED,
+    FAILURE_TIMEOUT,
+    ModelTestError,
+    get_test_command,
+)
+from kipoi_containers.helper import logger
+
+
+class WarmContainer:
+    """This class keeps one container of a docker image running in which
+    any number of models are tested with docker exec. Container creation
+    and teardown as well as the clone of the kipoi model repository are
+    paid once per image instead of once per model. It can be used as a
+    context manager and from multiple threads."""
+
+    def __init__(
+        self,
+        image_name: str,
+        session: Optional[ContainerSession] = None,
+        models: Optional[List[str]] = None,
+        **run_kwargs,
+    ) -> None:
+        """
+        This function instantiates WarmContainer with the docker image to
+        run and the models to be tested in it, whose kipoi folders are
+        mounted into the container. run_kwargs, for example mem_limit or
+        nano_cpus, are passed on to docker run. The container is started on
+        start(), labelled with the run of <session> and removed by the
+        daemon once it stops.
+        """
+        self.image_name = image_name
+        self.session = session if session else get_session()
+        self.models = models if models else []
+        self.run_kwargs = run_kwargs
+        self.container = None
+        self.download_cache = get_download_cache()
+
+    def start(self) -> None:
+        """
+        Starts the container of the image, which idles until it is stopped.
+
+        Raises:
+            docker.errors.ImageNotFound: if the image cannot be found
+            docker.errors.APIError: If there is an issue connecting to the docker api
+        """
+        run_kwargs = add_docker_volumes(
+            self.run_kwargs, get_kipoi_mounts(self.models)
+        )
+        self.container = self.session.client.containers.run(
+            image=self.image_name,
+            command=["sleep", "infinity"],
+            detach=True,
+            auto_remove=True,
+            labels=self.session.labels,
+            **run_kwargs,
+        )
+        logger.info(
+            f"Started {self.container.short_id} of {self.image_name} for testing"
+        )
+
+    def test(self, model_name: str, timeout: Optional[float] = None) -> None:
+        """
+        Runs kipoi test <model_name> --source=kipoi inside the running
+        container. The test is killed by coreutils timeout inside the
+        container once it has run for <timeout> seconds.
+
+        Raises:
+            ValueError: If the container has not been started
+            ModelTestError: If the test has timed out, has been killed for
+                running out of memory or has exited with a non zero status
+            docker.errors.APIError: If there is an issue connecting to the docker api
+        """
+        if self.container is None:
+            raise ValueError(
+                f"The container of {self.image_name} is not running"
+            )
+        test_cmd = get_test_command(model_name)
+        if timeout:
+            test_cmd = f"timeout --kill-after=30 {int(timeout)} {test_cmd}"
+        start = time.monotonic()
+        if self.download_cache is not None:
+            with self.download_cache.use(
+                [model_name], cloning=get_model_checkout() is None
+            ):
+                exit_code, output = self.container.exec_run(test_cmd)
+        else:
+            exit_code, output = self.container.exec_run(test_cmd)
+        if exit_code != 0:
+            # timeout exits with 124 if the test has stopped on SIGTERM and
+            # with 137 if it had to be killed
+            if exit_code == 124 or (
+                exit_code == 137
+                and timeout
+                and time.monotonic() - start >= timeout
+            ):
+                reason = FAILURE_TIMEOUT
+            elif exit_code == 137 and self.was_oom_killed():
+                reason = FAILURE_OOM_KILLED
+            else:
+                reason = FAILURE_EXIT
+            raise ModelTestError(
+                self.container,
+                exit_code,
+                test_cmd,
+                self.image_name,
+                output,
+                reason,
+            )
+        logger.info(output.decode("utf-8"))
+
+    def was_oom_killed(self) -> bool:
+        """Returns True if docker has recorded that the kernel killed a
+        process of the container for running out of memory. A test killed
+        with SIGKILL for any other reason, for example by docker kill, has
+        not run out of memory."""
+        try:
+            self.container.reload()
+        except APIError:
+            # The container has died and been removed
+            return False
+        return self.container.attrs["State"].get("OOMKilled", False)
+
+    def stop(self) -> None:
+        """Kills the container, if it is running, which makes the daemon
+        remove it"""
+        if self.container is not None:
+            try:
+                self.container.kill()
+            except APIError as e:
+                logger.debug(f"{self.container.short_id} has stopped: {e}")
+            self.container = None
+
+    def __enter__(self) -> "WarmContainer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
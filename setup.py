@@ -15,6 +15,7 @@ requirements = [
     "pre-commit",
     "click",
     "kipoi",
+    "packaging",
 ]
 setup_requirements = []
 
@@ -36,6 +37,12 @@ setup(
     entry_points={
         "console_scripts": [
             "update_all_singularity=kipoi_containers.update_all_singularity_images:run_update",
+            "build_images=kipoi_containers.buildscheduler:run_build",
+            "summarize_builds=kipoi_containers.buildreport:run_summary",
+            "summarize_tests=kipoi_containers.testtelemetry:run_summary",
+            "prefetch_conda_channel=kipoi_containers.condachannel:run_prefetch",
+            "relock_images=kipoi_containers.lockfile:run_relock",
+            "analyze_images=kipoi_containers.imageanalytics:run_analysis",
         ],
     },
     install_requires=requirements,
@@ -1,21 +1,47 @@
+from functools import partial
 from pathlib import Path
 import json
 
 import pytest
 
 
+@pytest.fixture(scope="session")
+def container_session():
+    from kipoi_containers.containersession import ContainerSession
+    from kipoi_containers.dockerhelper import cleanup
+
+    session = ContainerSession()
+    yield session
+    if session.connected:
+        cleanup(session=session)
+    session.close()
+
+
+@pytest.fixture(scope="session")
+def test_result_cache(request):
+    from kipoi_containers.testcache import ModelTestCache
+
+    return ModelTestCache(
+        enabled=False if request.config.getoption("no_cache") else None
+    )
+
+
 @pytest.fixture
-def test_docker_image():
-    from kipoi_containers.dockerhelper import test_docker_image
+def test_docker_image(container_session, test_result_cache):
+    from kipoi_containers.testcache import cached_test_docker_image
 
-    return test_docker_image
+    return partial(
+        cached_test_docker_image,
+        cache=test_result_cache,
+        session=container_session,
+    )
 
 
 @pytest.fixture
-def test_singularity_image():
-    from kipoi_containers.singularityhelper import test_singularity_image
+def test_singularity_image(test_result_cache):
+    from kipoi_containers.testcache import cached_test_singularity_image
 
-    return test_singularity_image
+    return partial(cached_test_singularity_image, cache=test_result_cache)
 
 
 def pytest_addoption(parser):
@@ -27,9 +53,23 @@ def pytest_addoption(parser):
         "--modelgroup", action="append", default=[], help="Model group name(s)"
     )
     parser.addoption("--image", action="append", default=[], help="Image name")
+    parser.addoption(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Rerun tests which have passed with the same image before",
+    )
+    parser.addoption(
+        "--shard",
+        default=None,
+        help="Test only shard i/N of the models of the image(s), or of "
+        "every image if no image is given, balanced by test duration",
+    )
 
 
 def pytest_generate_tests(metafunc):
+    if metafunc.config.getoption("shard") and hasattr(metafunc.cls, "shard"):
+        metafunc.cls.shard = metafunc.config.getoption("shard")
     if metafunc.config.getoption("image"):
         image_from_cmd_line = metafunc.config.getoption("image")
         if image_from_cmd_line and hasattr(metafunc.cls, "image_name"):
@@ -1,6 +1,8 @@
 import os
 from pathlib import Path
 
+from kipoi_containers.sharding import get_shard
+from kipoi_containers.testrunner import run_model_tests
 from kipoi_containers.updateoradd import DOCKER_TO_MODEL_JSON
 from kipoi_containers.helper import (
     populate_json,
@@ -12,18 +14,40 @@ from kipoi_containers.helper import (
 class TestContainers:
     image_name = None
     modelgroup_name = None
+    shard = None
     docker_to_model_dict = populate_json(DOCKER_TO_MODEL_JSON)
 
     def test_parameters(self):
-        assert self.image_name not in [None, "kipoi-base-env"]
+        assert self.image_name not in [None, "kipoi-base-env"] or (
+            self.shard and not self.modelgroup_name
+        )
         assert not self.modelgroup_name or (
             self.modelgroup_name
             and self.image_name not in [None, "kipoi-base-env"]
         )
         assert self.docker_to_model_dict != {}
 
-    def test_images(self, test_docker_image):
-        if self.modelgroup_name and self.image_name not in [
+    def test_images(
+        self, test_docker_image, container_session, test_result_cache
+    ):
+        if self.shard and not self.modelgroup_name:
+            images = (
+                [self.image_name]
+                if self.image_name not in [None, "kipoi-base-env"]
+                else None
+            )
+            image_to_models = get_shard(
+                self.shard, self.docker_to_model_dict, images
+            )
+            logger.info(f"Testing shard {self.shard}: {image_to_models}")
+            for image_name, models in image_to_models.items():
+                run_model_tests(
+                    image_name,
+                    models,
+                    session=container_session,
+                    cache=test_result_cache,
+                )
+        elif self.modelgroup_name and self.image_name not in [
             None,
             "kipoi-base-env",
         ]:
@@ -52,6 +76,9 @@ class TestContainers:
                 models = self.docker_to_model_dict.get(self.image_name)
             if "shared" in self.image_name:
                 models = one_model_per_modelgroup(models)
-            for model in models:
-                logger.info(f"Testing {model} with {self.image_name}")
-                test_docker_image(model_name=model, image_name=self.image_name)
+            run_model_tests(
+                self.image_name,
+                models,
+                session=container_session,
+                cache=test_result_cache,
+            )
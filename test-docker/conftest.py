@@ -0,0 +1,161 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+STATS = {
+    "memory_stats": {
+        "usage": 3_000_000_000,
+        "stats": {"inactive_file": 1_000_000_000},
+    },
+    "cpu_stats": {
+        "cpu_usage": {"total_usage": 3_000},
+        "system_cpu_usage": 20_000,
+        "online_cpus": 4,
+    },
+    "precpu_stats": {
+        "cpu_usage": {"total_usage": 1_000},
+        "system_cpu_usage": 10_000,
+    },
+    "blkio_stats": {
+        "io_service_bytes_recursive": [
+            {"op": "read", "value": 100},
+            {"op": "write", "value": 50},
+        ]
+    },
+    "networks": {"eth0": {"rx_bytes": 500_000_000, "tx_bytes": 1_000}},
+}
+
+
+class MockRepository:
+    """Kipoi model repo with the given files, keyed by their path. The
+    content of a file doubles as its git blob sha."""
+
+    def __init__(self, files):
+        self.files = files
+
+    def get_contents(self, path, ref=None):
+        if path in self.files:
+            return SimpleNamespace(
+                decoded_content=self.files[path].encode("utf-8")
+            )
+        prefix = f"{path}/" if path else ""
+        children = {
+            prefix + file_path[len(prefix) :].split("/", 1)[0]
+            for file_path in self.files
+            if file_path.startswith(prefix)
+        }
+        return [
+            SimpleNamespace(
+                path=child,
+                type="file" if child in self.files else "dir",
+                sha=child,
+            )
+            for child in sorted(children)
+        ]
+
+    def get_git_tree(self, sha, recursive):
+        # The sha of a directory is its path
+        return SimpleNamespace(
+            tree=[
+                SimpleNamespace(
+                    path=file_path[len(sha) + 1 :], type="blob", sha=content
+                )
+                for file_path, content in self.files.items()
+                if file_path.startswith(f"{sha}/")
+            ]
+        )
+
+
+class MockContainer:
+    """Container which exits with <exit_code>. Commands run in it exit with
+    the code in <exec_exit_codes> of the first model they mention, and 0
+    otherwise. A hanging container only exits once it has been killed."""
+
+    short_id = "0123456789ab"
+
+    def __init__(self, command, exit_code=0, exec_exit_codes=None, hang=False):
+        self.command = command
+        self.exit_code = exit_code
+        self.exec_exit_codes = exec_exit_codes or {}
+        self.hang = hang
+        self.commands = []
+        self.removed = False
+        self.killed = threading.Event()
+        # docker reports 137 for a container the kernel has killed for
+        # running out of memory as well as for one killed on timeout
+        self.attrs = {"State": {"OOMKilled": exit_code == 137}}
+
+    def exec_run(self, cmd):
+        self.commands.append(cmd)
+        for model, exit_code in self.exec_exit_codes.items():
+            if model in cmd:
+                return exit_code, b"Test failed"
+        return 0, b"Test passed"
+
+    def stats(self, stream, decode):
+        # A stopped container reports zeros
+        return iter([STATS, {"memory_stats": {}, "networks": {}}])
+
+    def logs(self, stream=False, follow=False, stdout=True, stderr=True):
+        if self.hang:
+            if stream:
+                self.killed.wait(5)
+                return iter([])
+            return b""
+        if stream:
+            return iter([b"Successfully ran test_predict\n"])
+        return b"Test failed"
+
+    def wait(self, timeout=None):
+        if self.hang and not self.killed.wait(timeout):
+            raise requests.exceptions.ReadTimeout()
+        return {"StatusCode": self.exit_code}
+
+    def reload(self):
+        pass
+
+    def kill(self):
+        self.attrs = {"State": {"OOMKilled": False}}
+        self.killed.set()
+
+    def remove(self, force):
+        self.removed = True
+
+
+class MockContainers:
+    def __init__(self, labels, **container_kwargs):
+        self.labels = labels
+        self.container_kwargs = container_kwargs
+        self.started = []
+
+    def run(self, image, command, detach, labels, **run_kwargs):
+        assert detach and labels == self.labels
+        assert "remove" not in run_kwargs
+        self.started.append(MockContainer(command, **self.container_kwargs))
+        return self.started[-1]
+
+
+class MockSession:
+    """Container session whose containers are all started with
+    <container_kwargs> and whose images all have the digest sha256:1"""
+
+    def __init__(self, **container_kwargs):
+        self.labels = {"org.kipoi.containers.run": "0123"}
+        self.client = SimpleNamespace(
+            containers=MockContainers(self.labels, **container_kwargs)
+        )
+
+    def inspect_image(self, name_of_docker_image):
+        return {"Id": "sha256:1"}
+
+
+@pytest.fixture
+def mock_repository():
+    return MockRepository
+
+
+@pytest.fixture
+def mock_session():
+    return MockSession
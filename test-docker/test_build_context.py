@@ -0,0 +1,93 @@
+from concurrent.futures import ThreadPoolExecutor
+import tarfile
+
+import pytest
+
+from kipoi_containers.buildcontext import (
+    CONTEXT_DOCKERFILE,
+    create_build_context,
+    get_context_files,
+    get_context_sources,
+)
+
+DOCKERFILE = """FROM kipoi/kipoi-docker:kipoi-base-env AS build
+COPY ./envfiles/env.yml /app/
+ADD scripts /app/scripts
+ADD https://example.com/file.txt /app/
+COPY --chown=root ["data/*.txt", "/app/data/"]
+FROM kipoi/kipoi-docker:kipoi-base-env
+COPY --from=build /opt/conda/envs/kipoi /opt/conda/envs/kipoi
+"""
+
+
+@pytest.fixture
+def context_root(tmp_path):
+    root = tmp_path / "repo"
+    (root / "envfiles").mkdir(parents=True)
+    (root / "envfiles" / "env.yml").write_text("name: kipoi\n")
+    (root / "envfiles" / "unused.yml").write_text("name: unused\n")
+    (root / "scripts" / "nested").mkdir(parents=True)
+    (root / "scripts" / "nested" / "run.sh").write_text("echo\n")
+    (root / "data").mkdir()
+    (root / "data" / "a.txt").write_text("a")
+    (root / "data" / "b.csv").write_text("b")
+    return root
+
+
+def test_get_context_sources():
+    assert get_context_sources(DOCKERFILE) == [
+        "./envfiles/env.yml",
+        "scripts",
+        "data/*.txt",
+    ]
+
+
+def test_get_context_files(context_root):
+    assert [
+        path.as_posix() for path in get_context_files(DOCKERFILE, context_root)
+    ] == ["data/a.txt", "envfiles/env.yml", "scripts/nested/run.sh"]
+
+
+def test_get_context_files_missing_source(context_root):
+    with pytest.raises(ValueError):
+        get_context_files("FROM x\nCOPY missing.yml /app/\n", context_root)
+
+
+def test_create_build_context_is_reproducible(context_root, tmp_path):
+    first = create_build_context(DOCKERFILE, context_root, tmp_path / "a")
+    (context_root / "envfiles" / "unused.yml").write_text("changed")
+    second = create_build_context(DOCKERFILE, context_root, tmp_path / "b")
+    assert first.name == second.name
+    assert first.read_bytes() == second.read_bytes()
+    with tarfile.open(first, "r:gz") as tar:
+        assert tar.getnames() == [
+            CONTEXT_DOCKERFILE,
+            "data/a.txt",
+            "envfiles/env.yml",
+            "scripts/nested/run.sh",
+        ]
+        assert all(member.mtime == 0 for member in tar.getmembers())
+
+
+def test_create_build_context_changes_with_content(context_root, tmp_path):
+    first = create_build_context(DOCKERFILE, context_root, tmp_path)
+    (context_root / "envfiles" / "env.yml").write_text("name: other\n")
+    second = create_build_context(DOCKERFILE, context_root, tmp_path)
+    assert first != second
+    assert sorted(tmp_path.glob("*.tar.gz")) == sorted([first, second])
+
+
+def test_create_build_context_from_several_threads(context_root, tmp_path):
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        paths = list(
+            executor.map(
+                lambda _: create_build_context(
+                    DOCKERFILE, context_root, tmp_path / "cache"
+                ),
+                range(8),
+            )
+        )
+    assert len(set(paths)) == 1
+    assert list((tmp_path / "cache").iterdir()) == [paths[0]]
+    with tarfile.open(paths[0], "r:gz") as tar:
+        assert CONTEXT_DOCKERFILE in tar.getnames()
@@ -0,0 +1,174 @@
+from pathlib import Path
+import threading
+
+import pytest
+
+from kipoi_containers import buildmanifest, dockerupdater
+
+
+@pytest.fixture
+def dockerfile_path():
+    return (
+        Path(__file__).resolve().parent / "../dockerfiles/Dockerfile.deepmel"
+    )
+
+
+@pytest.fixture(autouse=True)
+def mock_digest(monkeypatch):
+    monkeypatch.setattr(
+        buildmanifest,
+        "get_base_image_digest",
+        lambda name_of_docker_image: "sha256:1234",
+    )
+
+
+def test_get_model_group():
+    assert buildmanifest.get_model_group("CpGenie/merged") == "CpGenie"
+    assert (
+        buildmanifest.get_model_group("MMSplice/mtsplice")
+        == "MMSplice/mtsplice"
+    )
+    assert buildmanifest.get_model_group("Basset") == "Basset"
+
+
+def test_fingerprint_ignores_documentation(dockerfile_path, mock_repository):
+    fingerprint = buildmanifest.compute_fingerprint(
+        dockerfile_path,
+        ["DeepMEL/DeepMEL"],
+        mock_repository({"DeepMEL/model.yaml": "a", "DeepMEL/README.md": "b"}),
+        "commit",
+    )
+    assert fingerprint == buildmanifest.compute_fingerprint(
+        dockerfile_path,
+        ["DeepMEL/DeepMEL"],
+        mock_repository({"DeepMEL/model.yaml": "a", "DeepMEL/README.md": "c"}),
+        "commit",
+    )
+    assert fingerprint != buildmanifest.compute_fingerprint(
+        dockerfile_path,
+        ["DeepMEL/DeepMEL"],
+        mock_repository({"DeepMEL/model.yaml": "d", "DeepMEL/README.md": "b"}),
+        "commit",
+    )
+
+
+def test_build_manifest(tmp_path):
+    manifest_json = tmp_path / "build-manifest.json"
+    manifest = buildmanifest.BuildManifest(manifest_json)
+    assert not manifest.is_up_to_date("kipoi/kipoi-docker:deepmel", "abc")
+    manifest.record("kipoi/kipoi-docker:deepmel", "abc", "commit")
+    manifest = buildmanifest.BuildManifest(manifest_json)
+    assert manifest.is_up_to_date("kipoi/kipoi-docker:deepmel", "abc")
+    assert not manifest.is_up_to_date("kipoi/kipoi-docker:deepmel", None)
+
+
+def test_concurrent_records(tmp_path):
+    manifest_json = tmp_path / "build-manifest.json"
+    manifest = buildmanifest.BuildManifest(manifest_json)
+    images = [f"kipoi/kipoi-docker:image{i}" for i in range(20)]
+    threads = [
+        threading.Thread(target=manifest.record, args=(image, "abc", "c"))
+        for image in images
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manifest = buildmanifest.BuildManifest(manifest_json)
+    assert all(manifest.is_up_to_date(image, "abc") for image in images)
+    assert list(tmp_path.iterdir()) == [manifest_json]
+
+
+def test_fingerprint_is_recorded_after_locking(
+    monkeypatch, tmp_path, dockerfile_path, mock_repository
+):
+    lockfile = {"content": "old"}
+    monkeypatch.setattr(
+        dockerupdater,
+        "export_lockfile",
+        lambda *args, **kwargs: lockfile.update(content="new"),
+    )
+    monkeypatch.setattr(
+        dockerupdater, "push_docker_image", lambda tag, session: None
+    )
+    monkeypatch.setattr(
+        dockerupdater,
+        "compute_fingerprint",
+        lambda **kwargs: f"fingerprint-{lockfile['content']}",
+    )
+    manifest = buildmanifest.BuildManifest(tmp_path / "build-manifest.json")
+    updater = dockerupdater.DockerUpdater(
+        "DeepMEL",
+        "kipoi/kipoi-docker:deepmel",
+        kipoi_model_repo=mock_repository({}),
+        model_repo_commit="commit",
+        build_manifest=manifest,
+        session=object(),
+    )
+    updater.publish(dockerfile_path, ["DeepMEL/DeepMEL"])
+    # The next sync sees the lockfile written by this one
+    assert manifest.is_up_to_date(
+        "kipoi/kipoi-docker:deepmel", "fingerprint-new"
+    )
+
+
+def test_slim_from_full_has_fingerprint_of_full_image(
+    monkeypatch, dockerfile_path, mock_repository
+):
+    monkeypatch.setattr(
+        dockerupdater,
+        "compute_fingerprint",
+        lambda dockerfile_path, **kwargs: Path(dockerfile_path).name,
+    )
+    updaters = [
+        dockerupdater.DockerUpdater(
+            "DeepMEL",
+            name_of_docker_image,
+            kipoi_model_repo=mock_repository({}),
+            model_repo_commit="commit",
+            build_manifest=buildmanifest.BuildManifest(),
+            slim_from_full=slim_from_full,
+            session=object(),
+        )
+        for name_of_docker_image, slim_from_full in [
+            ("kipoi/kipoi-docker:deepmel", False),
+            ("kipoi/kipoi-docker:deepmel-slim", True),
+            ("kipoi/kipoi-docker:deepmel-slim", False),
+        ]
+    ]
+    slim_dockerfile_path = Path(f"{dockerfile_path}-slim")
+    assert [
+        updater.get_fingerprint(
+            (
+                slim_dockerfile_path
+                if "slim" in updater.name_of_docker_image
+                else dockerfile_path
+            ),
+            ["DeepMEL/DeepMEL"],
+        )
+        for updater in updaters
+    ] == [
+        "Dockerfile.deepmel",
+        "Dockerfile.deepmel",
+        "Dockerfile.deepmel-slim",
+    ]
+
+
+def test_changed_dependencies_are_solved_anew(
+    monkeypatch, tmp_path, dockerfile_path
+):
+    monkeypatch.setattr(
+        dockerupdater,
+        "get_dependency_hash_path",
+        lambda env_name: tmp_path / f"{env_name}.dependencies.sha256",
+    )
+    updater = dockerupdater.DockerUpdater(
+        "DeepMEL", "kipoi/kipoi-docker:deepmel", session=object()
+    )
+    # Lockfiles without a recorded checksum are solved anew once
+    assert not updater.is_lockfile_current(dockerfile_path, "abc")
+    (tmp_path / "kipoi-DeepMEL.dependencies.sha256").write_text("abc\n")
+    assert updater.is_lockfile_current(dockerfile_path, "abc")
+    assert not updater.is_lockfile_current(dockerfile_path, "def")
+    # Without kipoi model repo the lockfiles are used as they are
+    assert updater.is_lockfile_current(dockerfile_path, None)
@@ -0,0 +1,68 @@
+from kipoi_containers.buildreport import (
+    BuildKitProgressRecorder,
+    BuildReport,
+    LegacyBuildRecorder,
+    summarize_build_reports,
+)
+
+
+def test_legacy_build_recorder():
+    image_sizes = {"aaaaaaaaaaaa": 100, "bbbbbbbbbbbb": 150}
+    recorder = LegacyBuildRecorder(
+        BuildReport("kipoi/kipoi-docker:deepmel", "Dockerfile.deepmel"),
+        get_image_size=lambda image_id: image_sizes[image_id],
+    )
+    for chunk in [
+        {"stream": "Step 1/2 : FROM continuumio/miniconda3:latest"},
+        {"stream": "\n"},
+        {"stream": " ---> aaaaaaaaaaaa\n"},
+        {"stream": "Step 2/2 : RUN conda update conda"},
+        {"stream": "\n"},
+        {"stream": " ---> Using cache\n"},
+        {"stream": " ---> bbbbbbbbbbbb\n"},
+        {"stream": "Successfully built bbbbbbbbbbbb\n"},
+    ]:
+        recorder.process_chunk(chunk)
+    report = recorder.close()
+    assert [s.step for s in report.steps] == [1, 2]
+    assert report.steps[1].instruction == "RUN conda update conda"
+    assert report.steps[1].cached
+    assert not report.steps[0].cached
+    assert report.steps[1].layer_size == 50
+
+
+def test_buildkit_progress_recorder():
+    recorder = BuildKitProgressRecorder(
+        BuildReport("kipoi/kipoi-docker:deepmel", "Dockerfile.deepmel")
+    )
+    for line in [
+        "#1 [internal] load build definition from Dockerfile",
+        "#1 DONE 0.0s",
+        "#5 [build 2/4] RUN apt-get update",
+        "#5 CACHED",
+        "#6 [build 3/4] RUN kipoi env create DeepMEL",
+        "#6 0.512 Collecting package metadata",
+        "#6 DONE 312.4s",
+    ]:
+        recorder.process_line(line)
+    report = recorder.close()
+    assert len(report.steps) == 2
+    assert report.steps[0].cached
+    assert report.steps[1].step == 3
+    assert report.steps[1].duration == 312.4
+
+
+def test_summarize_build_reports(tmp_path):
+    for image, durations in [
+        ("kipoi/kipoi-docker:deepmel", [1.0, 30.0]),
+        ("kipoi/kipoi-docker:framepool", [20.0, 2.0]),
+    ]:
+        report = BuildReport(image, "Dockerfile")
+        recorder = BuildKitProgressRecorder(report)
+        for step, duration in enumerate(durations, start=1):
+            recorder.process_line(f"#{step} [{step}/2] RUN step{step}")
+            recorder.process_line(f"#{step} DONE {duration}s")
+        recorder.close().write(tmp_path)
+    slowest = summarize_build_reports(tmp_path, top=2)
+    assert [s["duration"] for s in slowest] == [30.0, 20.0]
+    assert slowest[1]["name_of_docker_image"] == "kipoi/kipoi-docker:framepool"
@@ -0,0 +1,93 @@
+from pathlib import Path
+import threading
+
+import pytest
+
+from kipoi_containers.buildscheduler import (
+    BuildScheduler,
+    BuildResources,
+    get_build_graph,
+)
+from kipoi_containers.dockerhelper import get_base_images
+
+
+@pytest.fixture
+def dockerfile_folder():
+    return Path(__file__).resolve().parent / "../dockerfiles"
+
+
+def test_get_base_images(dockerfile_folder):
+    assert get_base_images(
+        dockerfile_folder / "Dockerfile.sharedpy3keras2tf2-slim"
+    ) == ["continuumio/miniconda3:latest"]
+    assert get_base_images(dockerfile_folder / "Dockerfile.deepmel-slim") == [
+        "continuumio/miniconda3:latest",
+        "debian:bullseye-slim",
+    ]
+
+
+def test_get_base_images_with_build_args(dockerfile_folder):
+    assert get_base_images(
+        dockerfile_folder / "Dockerfile-slim-from-full.template"
+    ) == ["kipoi/kipoi-docker:imagename", "debian:bullseye-slim"]
+
+
+def test_get_build_graph(dockerfile_folder):
+    build_graph = get_build_graph(dockerfile_folder)
+    assert build_graph["kipoi/kipoi-docker:kipoi-base-env"] == []
+    assert build_graph["kipoi/kipoi-docker:sharedpy3keras2tf2"] == [
+        "kipoi/kipoi-docker:kipoi-base-env"
+    ]
+    assert build_graph["kipoi/kipoi-docker:deepmel-slim"] == []
+    assert not any("template" in image for image in build_graph)
+
+
+def test_scheduler_builds_base_once(dockerfile_folder):
+    built, tested, pushed = [], [], []
+    lock = threading.Lock()
+
+    def mock_build(dockerfile_path, name_of_docker_image):
+        with lock:
+            assert "kipoi/kipoi-docker:kipoi-base-env" in built or (
+                name_of_docker_image.endswith("-slim")
+                or name_of_docker_image.endswith("kipoi-base-env")
+            )
+            built.append(name_of_docker_image)
+
+    scheduler = BuildScheduler(
+        budget=BuildResources(cpus=4, memory=8, disk=30),
+        dockerfile_folder=dockerfile_folder,
+        build=mock_build,
+        test=lambda image_name, model_name: tested.append(model_name),
+        push=lambda tag: pushed.append(tag),
+    )
+    images = [
+        "kipoi/kipoi-docker:deepmel",
+        "kipoi/kipoi-docker:deepmel-slim",
+        "kipoi/kipoi-docker:sharedpy3keras2tf2",
+    ]
+    status = scheduler.run(
+        images, {"kipoi/kipoi-docker:deepmel": ["DeepMEL"]}, push=True
+    )
+    assert built.count("kipoi/kipoi-docker:kipoi-base-env") == 1
+    assert all(s == "success" for s in status.values())
+    assert tested == ["DeepMEL"]
+    assert sorted(pushed) == ["deepmel", "deepmel-slim", "sharedpy3keras2tf2"]
+
+
+def test_scheduler_skips_dependents_of_failed_build(dockerfile_folder):
+    def mock_build(dockerfile_path, name_of_docker_image):
+        if name_of_docker_image.endswith("kipoi-base-env"):
+            raise ValueError("Build failed")
+
+    scheduler = BuildScheduler(
+        budget=BuildResources(cpus=1, memory=1, disk=1),
+        dockerfile_folder=dockerfile_folder,
+        build=mock_build,
+    )
+    status = scheduler.run(
+        ["kipoi/kipoi-docker:deepmel", "kipoi/kipoi-docker:deepmel-slim"]
+    )
+    assert status["kipoi/kipoi-docker:kipoi-base-env"] == "failed"
+    assert status["kipoi/kipoi-docker:deepmel"] == "skipped"
+    assert status["kipoi/kipoi-docker:deepmel-slim"] == "success"
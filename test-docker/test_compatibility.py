@@ -0,0 +1,141 @@
+import json
+import threading
+
+import docker
+import pytest
+
+from kipoi_containers import compatibility
+from kipoi_containers.dockerhelper import ModelTestError
+
+TF1 = "kipoi/kipoi-docker:sharedpy3keras2tf1-slim"
+TF2 = "kipoi/kipoi-docker:sharedpy3keras2tf2-slim"
+KERAS12 = "kipoi/kipoi-docker:sharedpy3keras1.2-slim"
+
+
+def fail(image_name, reason="non-zero-exit"):
+    raise ModelTestError(None, 1, "kipoi test", image_name, None, reason)
+
+
+def mock_probes(monkeypatch, outcomes):
+    """Replaces the container tests with <outcomes>, a dict mapping images
+    to whether they pass and the seconds they take unless cancelled"""
+    started, cancelled_images = [], []
+    lock = threading.Lock()
+
+    def mock_test(image_name, model_name, session, cancelled):
+        passes, duration = outcomes[image_name]
+        with lock:
+            started.append((image_name, model_name))
+        if cancelled.wait(duration):
+            with lock:
+                cancelled_images.append(image_name)
+            fail(image_name, "cancelled")
+        if not passes:
+            fail(image_name)
+
+    monkeypatch.setattr(
+        compatibility, "test_docker_image_cancellable", mock_test
+    )
+    return started, cancelled_images
+
+
+def test_rank_images(tmp_path):
+    assert compatibility.rank_images(
+        [TF1, TF2, KERAS12], image_sizes={TF2: 2, KERAS12: 3}
+    ) == [TF2, KERAS12, TF1]
+    assert compatibility.rank_images(
+        [TF1, TF2, KERAS12], "duration", image_sizes={TF2: 2}
+    ) == [TF1, TF2, KERAS12]
+    with pytest.raises(ValueError):
+        compatibility.rank_images([TF1], "name")
+    history_json = tmp_path / "image-size-history.json"
+    history_json.write_text(
+        json.dumps(
+            {
+                TF1: [
+                    {"size": 10, "compressed_size": 5},
+                    {"size": 12, "compressed_size": None},
+                ]
+            }
+        )
+    )
+    assert compatibility.get_image_sizes([TF1, TF2], history_json) == {TF1: 12}
+
+
+def test_fastest_passing_image_wins(monkeypatch):
+    started, cancelled = mock_probes(
+        monkeypatch,
+        {TF1: (False, 0.1), TF2: (True, 0.2), KERAS12: (True, 5)},
+    )
+    assert (
+        compatibility.find_compatible_image(
+            ["DeepMEL/DeepMEL"], rank_by="duration"
+        )
+        == TF2
+    )
+    assert len(started) == 3
+    assert cancelled == [KERAS12]
+
+
+def test_smallest_passing_image_wins(monkeypatch):
+    monkeypatch.setattr(
+        compatibility,
+        "get_image_sizes",
+        lambda images: {TF1: 3, TF2: 1, KERAS12: 2},
+    )
+    started, cancelled = mock_probes(
+        monkeypatch,
+        {TF1: (True, 5), TF2: (False, 0.1), KERAS12: (True, 0.3)},
+    )
+    # TF1 passes too, but is larger than KERAS12
+    assert (
+        compatibility.find_compatible_image(["Basset"], rank_by="size")
+        == KERAS12
+    )
+    assert cancelled == [TF1]
+
+
+def test_no_compatible_image(monkeypatch):
+    started, cancelled = mock_probes(
+        monkeypatch,
+        {TF1: (False, 0), TF2: (False, 0), KERAS12: (False, 0)},
+    )
+    assert (
+        compatibility.find_compatible_image(
+            ["Model/a", "Model/b"], rank_by="duration"
+        )
+        is None
+    )
+    # Every model is tried before an image is ruled out
+    assert len(started) == 6
+    assert not cancelled
+
+
+def test_missing_image_is_an_error(monkeypatch):
+    started = []
+
+    def mock_test(image_name, model_name, session, cancelled):
+        started.append(model_name)
+        if image_name == TF1:
+            raise docker.errors.ImageNotFound(image_name)
+        fail(image_name)
+
+    monkeypatch.setattr(
+        compatibility, "test_docker_image_cancellable", mock_test
+    )
+    recorded = []
+    assert (
+        compatibility.find_compatible_image(
+            ["Model/a", "Model/b"],
+            images=[TF1, TF2],
+            rank_by="duration",
+            on_result=recorded.append,
+        )
+        is None
+    )
+    # The missing image is given up on after its first model
+    assert len(started) == 3
+    results = {result.name_of_docker_image: result for result in recorded}
+    assert results[TF1].error == "image-missing"
+    assert not results[TF1].cancelled
+    assert results[TF2].error is None and not results[TF2].passed
@@ -0,0 +1,94 @@
+from kipoi_containers import compatibility
+from kipoi_containers.compatibility import ProbeResult
+from kipoi_containers.compatibilitymatrix import (
+    CompatibilityMatrix,
+    get_model_group_fingerprint,
+)
+
+TF1 = "kipoi/kipoi-docker:sharedpy3keras2tf1-slim"
+TF2 = "kipoi/kipoi-docker:sharedpy3keras2tf2-slim"
+KERAS12 = "kipoi/kipoi-docker:sharedpy3keras1.2-slim"
+
+
+def test_model_group_fingerprint(mock_repository):
+    fingerprint = get_model_group_fingerprint(
+        mock_repository({"DeepMEL/model.yaml": "a"}), "DeepMEL", "commit"
+    )
+    assert fingerprint == get_model_group_fingerprint(
+        mock_repository({"DeepMEL/model.yaml": "a"}), "DeepMEL", "other-commit"
+    )
+    assert fingerprint != get_model_group_fingerprint(
+        mock_repository({"DeepMEL/model.yaml": "b"}), "DeepMEL", "commit"
+    )
+
+
+def test_record_and_lookup(tmp_path):
+    matrix_json = tmp_path / "compatibility-matrix.json"
+    matrix = CompatibilityMatrix(matrix_json)
+    matrix.record(
+        "DeepMEL", ProbeResult(TF1, False, 12.5), "sha256:1", "files", "abc"
+    )
+    matrix.record(
+        "DeepMEL",
+        ProbeResult(TF2, False, 3, cancelled=True),
+        "sha256:2",
+        "files",
+        "abc",
+    )
+    matrix.record("DeepMEL", ProbeResult(TF2, True, 3), None, "files", "abc")
+    # Reloaded from the json file
+    matrix = CompatibilityMatrix(matrix_json)
+    assert matrix.lookup("DeepMEL", TF1, "sha256:1", "files") == ProbeResult(
+        TF1, False, 12.5
+    )
+    assert matrix.matrix["DeepMEL"][TF1]["kipoi_model_repo_commit"] == "abc"
+    matrix.record(
+        "DeepMEL",
+        ProbeResult(KERAS12, False, 1, error="image-missing"),
+        "sha256:4",
+        "files",
+        "abc",
+    )
+    # Cancelled probes, probes which could not test the image and images
+    # without a digest are not recorded
+    assert TF2 not in matrix.matrix["DeepMEL"]
+    assert KERAS12 not in matrix.matrix["DeepMEL"]
+    # A new image or changed files of the model group invalidate the entry
+    assert matrix.lookup("DeepMEL", TF1, "sha256:3", "files") is None
+    assert matrix.lookup("DeepMEL", TF1, "sha256:1", "new-files") is None
+    assert matrix.lookup("DeepMEL", TF1, None, "files") is None
+
+
+def test_known_results_are_not_probed(monkeypatch):
+    probed, recorded = [], []
+
+    def mock_test(image_name, model_name, session, cancelled):
+        probed.append(image_name)
+
+    monkeypatch.setattr(
+        compatibility, "test_docker_image_cancellable", mock_test
+    )
+    known_results = {TF1: ProbeResult(TF1, False, 10)}
+    assert (
+        compatibility.find_compatible_image(
+            ["DeepMEL"],
+            images=[TF1, TF2],
+            rank_by="duration",
+            known_results=known_results,
+            on_result=recorded.append,
+        )
+        == TF2
+    )
+    assert probed == [TF2]
+    assert [result.name_of_docker_image for result in recorded] == [TF2]
+    known_results[TF2] = ProbeResult(TF2, True, 10)
+    assert (
+        compatibility.find_compatible_image(
+            ["DeepMEL"],
+            images=[TF1, TF2],
+            rank_by="duration",
+            known_results=known_results,
+        )
+        == TF2
+    )
+    assert probed == [TF2]
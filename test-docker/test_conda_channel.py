@@ -0,0 +1,14 @@
+from kipoi_containers.condachannel import get_prefetch_script
+
+
+def test_get_prefetch_script():
+    script = get_prefetch_script(
+        ["DeepSEA/predict", "MMSplice/mtsplice"], ["sharedpy3keras2tf2.yml"]
+    ).splitlines()
+    assert script[:2] == ["set -e", "export CONDA_PKGS_DIRS=/channel/.pkgs"]
+    assert (
+        "conda run -n kipoi-env kipoi env create DeepSEA/predict "
+        "--source=kipoi" in script
+    )
+    assert any("-f /envfiles/sharedpy3keras2tf2.yml" in c for c in script)
+    assert script[-1] == "python -m conda_index /channel"
@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import docker
+import pytest
+
+from kipoi_containers.containersession import ContainerSession
+
+
+class MockClient:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.inspections = []
+        self.closed = False
+        self.api = SimpleNamespace(
+            api_version="1.41", inspect_image=self.inspect_image
+        )
+
+    def inspect_image(self, name_of_docker_image):
+        self.inspections.append(name_of_docker_image)
+        return {"Id": f"sha256:{len(self.inspections)}"}
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    clients = []
+
+    def from_env(**kwargs):
+        clients.append(MockClient(**kwargs))
+        return clients[-1]
+
+    monkeypatch.setattr(docker, "from_env", from_env)
+    return clients
+
+
+def test_client_is_created_once(clients):
+    session = ContainerSession(max_pool_size=4)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        used_clients = list(executor.map(lambda _: session.client, range(32)))
+    assert len(clients) == 1
+    assert all(client is clients[0] for client in used_clients)
+    assert clients[0].kwargs["max_pool_size"] == 4
+
+
+def test_inspect_image_is_cached(clients):
+    session = ContainerSession()
+    image = "kipoi/kipoi-docker:deepmel"
+    assert session.inspect_image(image) == session.inspect_image(image)
+    assert clients[0].inspections == [image]
+    session.invalidate(image)
+    assert session.inspect_image(image)["Id"] == "sha256:2"
+
+
+def test_close(clients):
+    session = ContainerSession()
+    session.inspect_image("kipoi/kipoi-docker:deepmel")
+    session.close()
+    assert clients[0].closed
+    session.inspect_image("kipoi/kipoi-docker:deepmel")
+    assert len(clients) == 2
+
+
+def test_cleanup_is_scoped_to_the_run(clients):
+    from kipoi_containers.dockerhelper import cleanup
+
+    removed, pruned = [], []
+    session = ContainerSession()
+    other_session = ContainerSession()
+    assert session.labels != other_session.labels
+    containers = [
+        SimpleNamespace(
+            labels=labels,
+            remove=lambda labels=labels, **kwargs: removed.append(labels),
+        )
+        for labels in [session.labels, other_session.labels]
+    ]
+
+    def list_containers(all, filters):
+        return [
+            c
+            for c in containers
+            if "=".join(next(iter(c.labels.items()))) == filters["label"]
+        ]
+
+    client = session.client
+    client.containers = SimpleNamespace(list=list_containers)
+    client.networks = SimpleNamespace(
+        prune=lambda filters: pruned.append(filters)
+    )
+    client.volumes = SimpleNamespace(
+        prune=lambda filters: pruned.append(filters)
+    )
+    cleanup(session=session)
+    assert removed == [session.labels]
+    assert pruned == [{"label": session.label_filter}] * 2
@@ -0,0 +1,131 @@
+import pytest
+
+from kipoi_containers.dockerhelper import (
+    CACHE_BUST_ARG,
+    CONDA_PKGS_CACHE_MOUNT,
+    add_conda_cache_mounts,
+    apply_lockfile,
+    get_conda_env_name_from_dockerfile,
+    get_lockfile_paths,
+    get_pip_requirements,
+    insert_cache_bust,
+    split_dockerfile_instructions,
+)
+
+
+@pytest.fixture
+def dockerfile_content():
+    return """FROM continuumio/miniconda3:latest
+
+# Install system dependencies
+RUN apt-get update && \\
+    apt-get install -y gcc
+
+ADD dockerfiles/environment.kipoi.yml /app/environment.kipoi.yml
+
+RUN conda env create -f /app/environment.kipoi.yml
+ENV PATH /opt/conda/envs/kipoi-env/bin:$PATH
+"""
+
+
+def test_split_dockerfile_instructions(dockerfile_content):
+    instructions = split_dockerfile_instructions(dockerfile_content)
+    assert len(instructions) == 5
+    assert instructions[0] == "FROM continuumio/miniconda3:latest"
+    assert instructions[1] == "RUN apt-get update && apt-get install -y gcc"
+
+
+def test_insert_cache_bust(dockerfile_content):
+    instructions = split_dockerfile_instructions(
+        insert_cache_bust(dockerfile_content, 4)
+    )
+    assert instructions[3] == f"ARG {CACHE_BUST_ARG}=0"
+    assert instructions[5].startswith("RUN conda env create")
+
+
+def test_insert_cache_bust_from(dockerfile_content):
+    instructions = split_dockerfile_instructions(
+        insert_cache_bust(dockerfile_content, 1)
+    )
+    assert instructions[0].startswith("FROM")
+    assert instructions[1] == f"ARG {CACHE_BUST_ARG}=0"
+
+
+def test_insert_cache_bust_invalid_step(dockerfile_content):
+    with pytest.raises(ValueError):
+        insert_cache_bust(dockerfile_content, 6)
+
+
+def test_add_conda_cache_mounts():
+    instructions = split_dockerfile_instructions(
+        add_conda_cache_mounts("""FROM continuumio/miniconda3:latest
+RUN apt-get update
+RUN conda install pip && \\
+    kipoi env create deepTarget --source=kipoi && \\
+    conda clean -afy
+RUN echo "source activate kipoi-deepTarget" > ~/.bashrc
+""")
+    )
+    assert len(instructions) == 4
+    assert instructions[1] == "RUN apt-get update"
+    assert instructions[2] == (
+        f"RUN {CONDA_PKGS_CACHE_MOUNT} conda install pip && "
+        "kipoi env create deepTarget --source=kipoi"
+    )
+    assert instructions[3].startswith("RUN echo")
+
+
+def test_add_conda_cache_mounts_with_channel(dockerfile_content):
+    instructions = split_dockerfile_instructions(
+        add_conda_cache_mounts(
+            dockerfile_content, conda_channel=True, conda_offline=True
+        )
+    )
+    assert "--mount=type=bind,from=kipoi-conda-channel" in instructions[3]
+    assert "CONDA_OFFLINE=true" in instructions[3]
+    assert instructions[3].endswith(
+        "&& conda env create -f /app/environment.kipoi.yml"
+    )
+
+
+def test_get_conda_env_name_from_dockerfile(dockerfile_content):
+    assert (
+        get_conda_env_name_from_dockerfile(dockerfile_content) == "kipoi-env"
+    )
+    assert get_conda_env_name_from_dockerfile("FROM debian") is None
+
+
+def test_apply_lockfile(dockerfile_content, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lockfile_folder = tmp_path / "dockerfiles" / "lockfiles"
+    assert (
+        apply_lockfile(dockerfile_content, lockfile_folder)
+        == dockerfile_content
+    )
+    lockfile_folder.mkdir(parents=True)
+    for lockfile in get_lockfile_paths("kipoi-env", lockfile_folder):
+        lockfile.write_text("")
+    instructions = split_dockerfile_instructions(
+        apply_lockfile(dockerfile_content, lockfile_folder)
+    )
+    assert len(instructions) == 6
+    assert instructions[3] == (
+        "COPY dockerfiles/lockfiles/kipoi-env.explicit.txt "
+        "dockerfiles/lockfiles/kipoi-env.pip.txt /app/lockfiles/"
+    )
+    assert instructions[4] == (
+        "RUN conda create -y -p /opt/conda/envs/kipoi-env "
+        "--file /app/lockfiles/kipoi-env.explicit.txt && "
+        "/opt/conda/envs/kipoi-env/bin/pip install --no-deps "
+        "-r /app/lockfiles/kipoi-env.pip.txt"
+    )
+
+
+def test_get_pip_requirements():
+    assert get_pip_requirements(
+        [
+            {"name": "numpy", "version": "1.21.1", "channel": "conda-forge"},
+            {"name": "kipoi", "version": "0.8.6", "channel": "pypi"},
+            {"name": "keras", "version": "2.9.0", "channel": "pypi"},
+        ]
+    ) == ["keras==2.9.0", "kipoi==0.8.6"]
@@ -0,0 +1,81 @@
+import os
+import threading
+import time
+
+from kipoi_containers.downloadcache import (
+    KipoiDownloadCache,
+    add_docker_volumes,
+    using_kipoi_folders,
+)
+
+
+def add_download(cache, model, size, used):
+    downloads = cache.source_folder / model / "downloaded" / "model_files"
+    downloads.mkdir(parents=True)
+    (downloads / "weights.h5").write_bytes(b"0" * size)
+    access = cache.access_folder / model.split("/")[0]
+    access.touch()
+    os.utime(access, (used, used))
+
+
+def test_least_recently_used_downloads_are_evicted(tmp_path):
+    cache = KipoiDownloadCache(tmp_path, size_budget=2.5e-6)
+    (cache.source_folder / ".git").mkdir()
+    add_download(cache, "MMSplice/pathogenicity", 1000, used=100)
+    add_download(cache, "Basset", 1000, used=300)
+    add_download(cache, "DeepMEL", 1000, used=200)
+    cache.evict()
+    assert not (
+        cache.source_folder / "MMSplice" / "pathogenicity" / "downloaded"
+    ).exists()
+    assert (cache.source_folder / "DeepMEL" / "downloaded").exists()
+    assert (cache.source_folder / "Basset" / "downloaded").exists()
+    assert (cache.source_folder / ".git").exists()
+
+
+def test_first_test_populates_the_cache_alone(tmp_path):
+    cache = KipoiDownloadCache(tmp_path)
+    lock = threading.Lock()
+    running, peak = [], []
+
+    def run_test(model):
+        with cache.use([model]):
+            with lock:
+                running.append(model)
+                peak.append(len(running))
+            time.sleep(0.05)
+            # The first test clones the kipoi model source
+            (cache.source_folder / ".git").mkdir(exist_ok=True)
+            with lock:
+                running.remove(model)
+
+    threads = [
+        threading.Thread(target=run_test, args=(model,))
+        for model in ["Basset", "DeepMEL", "DeepMEL/Fly", "HAL"]
+    ]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 1 and max(peak) > 1
+    assert sorted(p.name for p in cache.access_folder.iterdir()) == [
+        "Basset",
+        "DeepMEL",
+        "HAL",
+    ]
+
+
+def test_download_cache_is_mounted(monkeypatch, tmp_path):
+    monkeypatch.delenv("KIPOI_DOWNLOAD_CACHE", raising=False)
+    monkeypatch.delenv("KIPOI_MODELS_CHECKOUT", raising=False)
+    with using_kipoi_folders(["Basset"]) as mounts:
+        assert add_docker_volumes({"remove": True}, mounts) == {"remove": True}
+    monkeypatch.setenv("KIPOI_DOWNLOAD_CACHE", str(tmp_path))
+    with using_kipoi_folders(["Basset"]) as mounts:
+        assert add_docker_volumes({"remove": True}, mounts)["volumes"] == {
+            str(tmp_path / "models"): {
+                "bind": "/root/.kipoi/models",
+                "mode": "rw",
+            }
+        }
@@ -0,0 +1,143 @@
+from pathlib import Path
+
+import pytest
+
+from kipoi_containers import envresolver
+
+ENVFILES_FOLDER = Path(__file__).resolve().parent / "../envfiles"
+TF1 = "kipoi/kipoi-docker:sharedpy3keras2tf1-slim"
+TF2 = "kipoi/kipoi-docker:sharedpy3keras2tf2-slim"
+KERAS12 = "kipoi/kipoi-docker:sharedpy3keras1.2-slim"
+
+MODEL_TEMPLATE = """
+defined_as: kipoi.model.KerasModel
+args:
+  weights: {{ args_weights }}
+dependencies:
+  conda:
+    - python=3.6
+    - bioconda::pysam=0.15.3
+    - h5py
+  pip:
+    - tensorflow>=1.4,<2
+    - keras>=2.0.4
+"""
+
+
+@pytest.mark.parametrize(
+    "spec, expected",
+    [
+        ("python=3.5", ("python", "==3.5.*")),
+        ("bioconda::pysam=0.15.3=py37_0", ("pysam", "==0.15.3.*")),
+        ("numpy >=1.16, <1.20", ("numpy", "<1.20,>=1.16")),
+        ("pysam 0.15.* py37_0", ("pysam", "==0.15.*")),
+        ("h5py", None),
+        ("python 2.7|3.5", None),
+    ],
+)
+def test_parse_conda_spec(spec, expected):
+    parsed = envresolver.parse_conda_spec(spec)
+    assert (
+        parsed if parsed is None else (parsed[0], str(parsed[1]))
+    ) == expected
+
+
+def test_get_model_group_dependencies(mock_repository):
+    repo = mock_repository(
+        {
+            "Group/model-template.yaml": MODEL_TEMPLATE,
+            "Group/models.tsv": "model\nA\n",
+            "Group/dataloader.yaml": "dependencies:\n  pip:\n    - kipoi_seq>=0.3\n",
+        }
+    )
+    specs = envresolver.get_model_group_dependencies(repo, "Group", "master")
+    assert [(name, str(specifier)) for name, specifier in specs] == [
+        ("kipoi-seq", ">=0.3"),
+        ("python", "==3.6.*"),
+        ("pysam", "==0.15.3.*"),
+        ("tensorflow", "<2,>=1.4"),
+        ("keras", ">=2.0.4"),
+    ]
+
+
+def test_get_pinned_versions(tmp_path):
+    pinned = envresolver.get_pinned_versions(
+        ENVFILES_FOLDER / "sharedpy3keras2tf2.yml", tmp_path
+    )
+    assert pinned["python"] == ("3.8", True)
+    assert pinned["pyfaidx"] == ("0.6.4", False)
+    assert "tensorflow" not in pinned
+    (tmp_path / "kipoi-shared__envs__kipoi-py3-keras2-tf2.pip.txt").write_text(
+        "tensorflow==2.3.0\n"
+    )
+    (
+        tmp_path / "kipoi-shared__envs__kipoi-py3-keras2-tf2.explicit.txt"
+    ).write_text(
+        "@EXPLICIT\n"
+        "https://conda.anaconda.org/conda-forge/linux-64/"
+        "python-3.8.13-h582c2e5_0_cpython.tar.bz2#0123\n"
+    )
+    pinned = envresolver.get_pinned_versions(
+        ENVFILES_FOLDER / "sharedpy3keras2tf2.yml", tmp_path
+    )
+    assert pinned["tensorflow"] == ("2.3.0", False)
+    assert pinned["python"] == ("3.8.13", False)
+
+
+def test_rule_out_conflicting_images(tmp_path):
+    specs = envresolver.get_dependency_specs(MODEL_TEMPLATE)
+    # pysam 0.16 of sharedpy3keras2tf2 and keras 1.2 conflict
+    assert envresolver.rule_out_conflicting_images(
+        specs, [TF1, TF2, KERAS12], ENVFILES_FOLDER, tmp_path
+    ) == [TF1]
+    python2 = [envresolver.parse_conda_spec("python=2.7")]
+    assert (
+        envresolver.rule_out_conflicting_images(
+            python2, [TF1, TF2, KERAS12], ENVFILES_FOLDER, tmp_path
+        )
+        == []
+    )
+    assert envresolver.rule_out_conflicting_images(
+        python2, ["kipoi/kipoi-docker:unknown-slim"], ENVFILES_FOLDER, tmp_path
+    ) == ["kipoi/kipoi-docker:unknown-slim"]
+
+
+@pytest.mark.parametrize(
+    "specifier, version, is_prefix, expected",
+    [
+        (">=3.6", "3.8", True, True),
+        ("<3.8", "3.8", True, False),
+        ("==3.8.5", "3.8", True, True),
+        ("<2,>=1.4", "1.15.0", False, True),
+        ("<2", "2.3.0", False, False),
+    ],
+)
+def test_allows(specifier, version, is_prefix, expected):
+    assert (
+        envresolver.allows(
+            envresolver.SpecifierSet(specifier), version, is_prefix
+        )
+        is expected
+    )
+
+
+def test_dependency_fingerprint(mock_repository):
+    files = {
+        "Group/model-template.yaml": MODEL_TEMPLATE,
+        "Group/models.tsv": "model\nA\n",
+    }
+    fingerprint = envresolver.get_dependency_fingerprint(
+        mock_repository(files), ["Group/A"], "master"
+    )
+    described = MODEL_TEMPLATE.replace("args:", "info:\n  doc: A model\nargs:")
+    assert fingerprint == envresolver.get_dependency_fingerprint(
+        mock_repository(files | {"Group/model-template.yaml": described}),
+        ["Group/A"],
+        "master",
+    )
+    upgraded = MODEL_TEMPLATE.replace("pysam=0.15.3", "pysam=0.16")
+    assert fingerprint != envresolver.get_dependency_fingerprint(
+        mock_repository(files | {"Group/model-template.yaml": upgraded}),
+        ["Group/A"],
+        "master",
+    )
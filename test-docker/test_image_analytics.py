@@ -0,0 +1,85 @@
+from kipoi_containers.imageanalytics import (
+    ImageStats,
+    find_size_regressions,
+    get_largest_layers,
+    parse_du_output,
+    record_image_stats,
+)
+
+
+def get_stats(release, size, compressed_size=None):
+    return ImageStats(
+        name_of_docker_image="kipoi/kipoi-docker:deepmel-slim",
+        release=release,
+        size=size,
+        compressed_size=compressed_size,
+        layer_count=5,
+    )
+
+
+def test_parse_du_output():
+    du_output = (
+        "100\t/opt/conda/envs/kipoi-DeepMEL/lib/python3.7\n"
+        "300\t/opt/conda/envs/kipoi-DeepMEL/lib\n"
+        "20\t/opt/conda/envs/kipoi-DeepMEL/bin\n"
+        "400\t/opt/conda/envs/kipoi-DeepMEL\n"
+    )
+    assert parse_du_output(du_output, 2) == [
+        {"path": "/opt/conda/envs/kipoi-DeepMEL/lib", "size": 300 * 1024},
+        {
+            "path": "/opt/conda/envs/kipoi-DeepMEL/lib/python3.7",
+            "size": 100 * 1024,
+        },
+    ]
+
+
+def test_get_largest_layers():
+    history = [
+        {"Size": 0, "CreatedBy": "ENV PATH"},
+        {"Size": 10, "CreatedBy": "RUN mkdir -p /app"},
+        {"Size": 500, "CreatedBy": "COPY /opt/conda/envs"},
+    ]
+    assert get_largest_layers(history, 1) == [
+        {"size": 500, "created_by": "COPY /opt/conda/envs"}
+    ]
+
+
+def test_record_image_stats_replaces_release():
+    history = {}
+    record_image_stats(history, get_stats("v1", 100))
+    record_image_stats(history, get_stats("v2", 120))
+    record_image_stats(history, get_stats("v2", 130))
+    entries = history["kipoi/kipoi-docker:deepmel-slim"]
+    assert [(e["release"], e["size"]) for e in entries] == [
+        ("v1", 100),
+        ("v2", 130),
+    ]
+
+
+def test_find_size_regressions():
+    history = {}
+    record_image_stats(history, get_stats("v1", 100, 50))
+    record_image_stats(history, get_stats("v2", 105, 60))
+    regressions = find_size_regressions(history, 0.1, "v2")
+    assert len(regressions) == 1
+    assert regressions[0]["measure"] == "compressed_size"
+    assert regressions[0]["previous_release"] == "v1"
+    assert find_size_regressions(history, 0.25, "v2") == []
+    # An image which has not been measured in this release is not compared
+    assert find_size_regressions(history, 0.1, "v3") == []
+
+
+def test_find_size_regressions_without_compressed_size():
+    history = {}
+    record_image_stats(history, get_stats("v1", 100, 50))
+    record_image_stats(history, get_stats("v2", 200))
+    regressions = find_size_regressions(history, 0.5, "v2")
+    assert regressions[0]["measure"] == "size"
+    assert regressions[0]["growth"] == 1.0
+
+
+def test_find_size_regressions_without_previous_size():
+    history = {}
+    record_image_stats(history, get_stats("v1", 0))
+    record_image_stats(history, get_stats("v2", 200))
+    assert find_size_regressions(history, 0.5, "v2") == []
@@ -0,0 +1,100 @@
+from subprocess import run
+
+from kipoi_containers.modelcheckout import KipoiModelCheckout, run_git
+
+
+def commit_model(repo, model, content, file_name="model.yaml"):
+    model_yaml = repo / model / file_name
+    model_yaml.parent.mkdir(parents=True, exist_ok=True)
+    model_yaml.write_text(content)
+    run_git(["add", "."], repo)
+    run_git(
+        [
+            "-c",
+            "user.name=kipoi",
+            "-c",
+            "user.email=kipoi@example.com",
+            "commit",
+            "-q",
+            "-m",
+            f"Update {model}",
+        ],
+        repo,
+    )
+    return run_git(["rev-parse", "HEAD"], repo)
+
+
+def test_checkout_is_pinned_and_mounted(tmp_path):
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    run(["git", "init", "-q", str(remote)], check=True)
+    first = commit_model(remote, "DeepMEL", "type: keras\n")
+    second = commit_model(remote, "DeepMEL", "type: tensorflow\n")
+    checkout = KipoiModelCheckout(
+        tmp_path / "models", commit=first, remote_url=str(remote)
+    )
+    mounts = checkout.get_mounts(
+        ["DeepMEL", "DeepMEL/Fly"], downloads_folder=tmp_path / "downloads"
+    )
+    assert (tmp_path / "models" / "DeepMEL" / "model.yaml").read_text() == (
+        "type: keras\n"
+    )
+    assert mounts == {
+        str(tmp_path / "models"): {"bind": "/kipoi-models", "mode": "ro"},
+        str(tmp_path / "models-config.yaml"): {
+            "bind": "/root/.kipoi/config.yaml",
+            "mode": "ro",
+        },
+        str(tmp_path / "downloads" / "DeepMEL" / "downloaded"): {
+            "bind": "/kipoi-models/DeepMEL/downloaded",
+            "mode": "rw",
+        },
+    }
+    assert "type: local" in (tmp_path / "models-config.yaml").read_text()
+    checkout.commit = second
+    checkout.prepare()
+    assert run_git(["rev-parse", "HEAD"], tmp_path / "models") == second
+    assert (tmp_path / "models" / "DeepMEL" / "model.yaml").read_text() == (
+        "type: tensorflow\n"
+    )
+
+
+def test_nested_and_template_models_are_mounted(tmp_path):
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    run(["git", "init", "-q", str(remote)], check=True)
+    commit_model(
+        remote, "MMSplice/pathogenicity", "default_dataloader: ../dataloader\n"
+    )
+    commit_model(
+        remote, "MMSplice/dataloader", "type: Dataset\n", "dataloader.yaml"
+    )
+    commit_model(remote, "CpGenie", "model\nA549\n", "models.tsv")
+    commit = commit_model(
+        remote, "CpGenie", "type: keras\n", "model-template.yaml"
+    )
+    checkout = KipoiModelCheckout(
+        tmp_path / "models", commit=commit, remote_url=str(remote)
+    )
+    mounts = checkout.get_mounts(
+        ["MMSplice/pathogenicity", "CpGenie/A549"],
+        downloads_folder=tmp_path / "downloads",
+    )
+    writable = {
+        mount["bind"]: host_path
+        for host_path, mount in mounts.items()
+        if mount["mode"] == "rw"
+    }
+    assert writable == {
+        "/kipoi-models/MMSplice/pathogenicity/downloaded": str(
+            tmp_path / "downloads/MMSplice/pathogenicity/downloaded"
+        ),
+        "/kipoi-models/MMSplice/dataloader/downloaded": str(
+            tmp_path / "downloads/MMSplice/dataloader/downloaded"
+        ),
+        "/kipoi-models/CpGenie/downloaded": str(
+            tmp_path / "downloads/CpGenie/downloaded"
+        ),
+    }
+    # The mount points exist in the read-only checkout
+    assert (tmp_path / "models/MMSplice/pathogenicity/downloaded").is_dir()
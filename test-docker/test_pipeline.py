@@ -0,0 +1,124 @@
+import threading
+
+import pytest
+
+from kipoi_containers import dockerupdater
+from kipoi_containers.pipeline import (
+    Stage,
+    raise_for_failed_stages,
+    run_stages,
+)
+
+
+def test_slim_build_overlaps_full_tests():
+    full_tests_running = threading.Event()
+    slim_built = threading.Event()
+    finished = []
+    lock = threading.Lock()
+
+    def record(name):
+        with lock:
+            finished.append(name)
+
+    def test_full():
+        full_tests_running.set()
+        # Only returns once the slim image has been built meanwhile
+        assert slim_built.wait(timeout=5)
+        record("test full")
+
+    def build_slim():
+        assert full_tests_running.wait(timeout=5)
+        slim_built.set()
+        record("build slim")
+
+    stages = [
+        Stage("build full", lambda: record("build full")),
+        Stage("test full", test_full, ["build full"]),
+        Stage("build slim", build_slim, ["build full"]),
+        Stage("test slim", lambda: record("test slim"), ["build slim"]),
+        Stage("push full", lambda: record("push full"), ["test full"]),
+        Stage(
+            "push slim",
+            lambda: record("push slim"),
+            ["test slim", "test full"],
+        ),
+        Stage("publish slim", lambda: record("publish slim"), ["push slim"]),
+    ]
+    status = run_stages(stages)
+    assert set(status.values()) == {"success"}
+    assert finished.index("build slim") < finished.index("test full")
+    assert finished.index("push slim") > finished.index("test full")
+    raise_for_failed_stages(status)
+
+
+def test_failed_stage_skips_dependents():
+    def fail():
+        raise ValueError("Model test failed")
+
+    stages = [
+        Stage("build full", lambda: None),
+        Stage("test full", fail, ["build full"]),
+        Stage("build slim", lambda: None),
+        Stage("push full", lambda: None, ["test full"]),
+        Stage("push slim", lambda: None, ["build slim", "test full"]),
+    ]
+    status = run_stages(stages)
+    assert status == {
+        "build full": "success",
+        "test full": "failed",
+        "build slim": "success",
+        "push full": "skipped",
+        "push slim": "skipped",
+    }
+    with pytest.raises(ValueError, match="test full failed"):
+        raise_for_failed_stages(status)
+
+
+def test_invalid_dependencies():
+    with pytest.raises(ValueError, match="unknown"):
+        run_stages([Stage("push", lambda: None, ["test"])])
+    with pytest.raises(ValueError, match="cyclic"):
+        run_stages(
+            [
+                Stage("build", lambda: None, ["push"]),
+                Stage("push", lambda: None, ["build"]),
+            ]
+        )
+
+
+class MockUpdater:
+    slim_from_full = False
+    session = None
+
+    def __init__(self, tag, pushed, fail_tests=False):
+        self.tag = tag
+        self.pushed = pushed
+        self.fail_tests = fail_tests
+
+    def test(self):
+        if self.fail_tests:
+            raise ValueError(f"{self.tag} failed its tests")
+
+    def get_stages(self, models_to_test, all_models, budget):
+        return [
+            Stage(f"build {self.tag}", lambda: None),
+            Stage(f"test {self.tag}", self.test, [f"build {self.tag}"]),
+            Stage(
+                f"push {self.tag}",
+                lambda: self.pushed.append(self.tag),
+                [f"test {self.tag}"],
+            ),
+        ]
+
+
+def test_slim_is_not_published_if_full_fails(monkeypatch):
+    monkeypatch.setattr(dockerupdater, "cleanup", lambda images, session: None)
+    pushed, published = [], []
+    with pytest.raises(ValueError, match="test deepmel failed"):
+        dockerupdater.update_full_and_slim(
+            MockUpdater("deepmel", pushed, fail_tests=True),
+            MockUpdater("deepmel-slim", pushed),
+            ["DeepMEL/DeepMEL"],
+            on_slim_image_published=lambda: published.append("deepmel-slim"),
+        )
+    assert pushed == [] and published == []
@@ -0,0 +1,59 @@
+import pytest
+
+from kipoi_containers.sharding import get_shard, parse_shard, shard_tests
+
+
+def test_parse_shard():
+    assert parse_shard("2/5") == (2, 5)
+    for shard in ["0/5", "6/5", "2", "a/b"]:
+        with pytest.raises(ValueError):
+            parse_shard(shard)
+
+
+def test_shards_are_balanced():
+    test_durations = {"Basenji": 900, "DeepMEL": 100, "Basset": 300}
+    tests = [("kipoi/kipoi-docker:deepmel", "DeepMEL")] * 6 + [
+        ("kipoi/kipoi-docker:basenji", "Basenji"),
+        ("kipoi/kipoi-docker:sharedpy3keras2tf2", "Basset"),
+        ("kipoi/kipoi-docker:sharedpy3keras2tf2", "HAL"),
+    ]
+    shards = shard_tests(tests, 2, test_durations)
+    assert sorted(tests) == sorted(shards[0] + shards[1])
+    loads = [
+        sum(test_durations.get(model, 300) for _, model in shard)
+        for shard in shards
+    ]
+    # HAL takes as long as the median recorded test
+    assert sorted(loads) == [1000, 1100]
+
+
+def test_get_shard_of_every_image():
+    docker_to_model_dict = {
+        "kipoi/kipoi-docker:sharedpy3keras2tf2": [
+            "Basset",
+            "DeepSEA/variantEffects",
+            "DeepSEA/predict",
+        ],
+        "kipoi/kipoi-docker:deepmel": ["DeepMEL", "DeepMEL/Fly"],
+    }
+    test_durations = {"Basset": 50, "DeepSEA/variantEffects": 400}
+    image_to_models = {}
+    for index in [1, 2, 3]:
+        for image, models in get_shard(
+            f"{index}/3", docker_to_model_dict, test_durations=test_durations
+        ).items():
+            image_to_models.setdefault(image, set()).update(models)
+    # One model per model group is tested with a shared image
+    assert image_to_models == {
+        "kipoi/kipoi-docker:sharedpy3keras2tf2": {
+            "Basset",
+            "DeepSEA/variantEffects",
+        },
+        "kipoi/kipoi-docker:deepmel": {"DeepMEL", "DeepMEL/Fly"},
+    }
+    assert get_shard(
+        "1/3",
+        docker_to_model_dict,
+        ["kipoi/kipoi-docker:deepmel-slim"],
+        test_durations,
+    ) == {"kipoi/kipoi-docker:deepmel-slim": ["DeepMEL"]}
@@ -0,0 +1,69 @@
+import pytest
+
+from kipoi_containers.helper import ModelTestFailure
+from kipoi_containers.testcache import ModelTestCache
+from kipoi_containers.testrunner import ModelTestRunner
+
+
+def test_cache_is_keyed_by_image_model_and_commit(tmp_path):
+    cache_file = tmp_path / "test-results.jsonl"
+    cache = ModelTestCache(cache_file, model_repo_commit="abc")
+    cache.record("sha256:1", "DeepMEL", True, 10.0)
+    cache.record("sha256:1", "DeepMEL/Fly", False, 5.0, "Test failed")
+    reloaded = ModelTestCache(cache_file, model_repo_commit="abc")
+    assert reloaded.has_passed("sha256:1", "DeepMEL")
+    assert not reloaded.has_passed("sha256:1", "DeepMEL/Fly")
+    assert not reloaded.has_passed("sha256:2", "DeepMEL")
+    assert not ModelTestCache(cache_file, "def").has_passed(
+        "sha256:1", "DeepMEL"
+    )
+    assert not ModelTestCache(cache_file, "abc", enabled=False).has_passed(
+        "sha256:1", "DeepMEL"
+    )
+
+
+def test_cache_run_records_batch_results(tmp_path):
+    cache = ModelTestCache(tmp_path / "test-results.jsonl", "abc")
+    cache.record("sha256:1", "DeepMEL", True, 10.0)
+    tested = []
+
+    def mock_test(models):
+        tested.append(models)
+        results = {
+            model: {
+                "model": model,
+                "passed": model != "Basset",
+                "duration": 1.0,
+                "error": None if model != "Basset" else "Test failed",
+            }
+            for model in models
+        }
+        raise ModelTestFailure("1 of 2 models did not pass", results)
+
+    with pytest.raises(ValueError):
+        cache.run(
+            lambda: "sha256:1", ["DeepMEL", "DeepMEL/Fly", "Basset"], mock_test
+        )
+    assert tested == [["DeepMEL/Fly", "Basset"]]
+    assert cache.has_passed("sha256:1", "DeepMEL/Fly")
+    assert not cache.has_passed("sha256:1", "Basset")
+
+
+def test_runner_skips_known_passes(tmp_path, mock_session):
+    cache = ModelTestCache(tmp_path / "test-results.jsonl", "abc")
+    cache.record("sha256:1", "DeepMEL", True, 10.0)
+    tested = []
+    runner = ModelTestRunner(
+        workers=2,
+        memory_budget=8,
+        peak_memory={},
+        session=mock_session(),
+        test=lambda image_name, model_name, session, **kwargs: tested.append(
+            model_name
+        ),
+        cache=cache,
+    )
+    results = runner.run("kipoi/kipoi-docker:deepmel", ["DeepMEL", "Basset"])
+    assert tested == ["Basset"]
+    assert [r.cached for r in results] == [True, False]
+    assert cache.has_passed("sha256:1", "Basset")
@@ -0,0 +1,75 @@
+import json
+from subprocess import PIPE, Popen
+
+import pytest
+
+from kipoi_containers import testdriver
+from kipoi_containers.helper import (
+    TEST_RESULT_PREFIX,
+    get_batch_test_command,
+    parse_test_results,
+    raise_for_failed_models,
+)
+from kipoi_containers.singularityhelper import communicate_with_timeout
+
+
+def test_driver_isolates_failures(monkeypatch, capsys):
+    tested = []
+
+    def mock_cli_test(command, raw_args):
+        tested.append(raw_args)
+        if raw_args[0] == "DeepMEL/Fly":
+            raise ValueError("Prediction failed")
+        if raw_args[0] == "Basset":
+            raise SystemExit(1)
+
+    monkeypatch.setattr("kipoi.cli.main.cli_test", mock_cli_test)
+    testdriver.main(["DeepMEL", "DeepMEL/Fly", "Basset", "Basenji"])
+    assert tested[-1] == ["Basenji", "--source=kipoi", "--batch_size=2"]
+    results = parse_test_results(
+        capsys.readouterr().out,
+        ["DeepMEL", "DeepMEL/Fly", "Basset", "Basenji"],
+    )
+    assert [r["passed"] for r in results.values()] == [
+        True,
+        False,
+        False,
+        True,
+    ]
+    assert "Prediction failed" in results["DeepMEL/Fly"]["error"]
+    with pytest.raises(ValueError, match="2 of 4 models"):
+        raise_for_failed_models(results, "kipoi/kipoi-docker:deepmel")
+
+
+def test_parse_test_results_of_crashed_driver():
+    output = (
+        "Using TensorFlow backend.\n"
+        + TEST_RESULT_PREFIX
+        + json.dumps(
+            {
+                "model": "DeepMEL",
+                "passed": True,
+                "error": None,
+                "duration": 1.0,
+            }
+        )
+    )
+    results = parse_test_results(output, ["DeepMEL", "DeepMEL/Fly"])
+    assert results["DeepMEL"]["passed"]
+    assert not results["DeepMEL/Fly"]["passed"]
+
+
+def test_get_batch_test_command():
+    command = get_batch_test_command(["DeepMEL", "DeepMEL/Fly"])
+    assert command[:2] == ["python", "-c"]
+    assert "def test_model" in command[2]
+    assert command[3:] == ["DeepMEL", "DeepMEL/Fly"]
+    assert testdriver.RESULT_PREFIX == TEST_RESULT_PREFIX
+
+
+def test_hanging_process_is_killed():
+    process = Popen(["sleep", "10"], stdout=PIPE, stderr=PIPE)
+    stdout, stderr, timed_out = communicate_with_timeout(process, 0.1)
+    assert timed_out and process.returncode != 0
+    process = Popen(["echo", "passed"], stdout=PIPE, stderr=PIPE)
+    assert communicate_with_timeout(process, 5) == (b"passed\n", b"", False)
@@ -0,0 +1,173 @@
+import threading
+import time
+
+import pytest
+
+from kipoi_containers.dockerhelper import ModelTestError
+from kipoi_containers.testrunner import (
+    ModelTestRunner,
+    ResourceBudget,
+    raise_for_failures,
+)
+from kipoi_containers.warmcontainer import WarmContainer
+
+
+def test_runner_respects_memory_budget():
+    lock = threading.Lock()
+    running, peak = [], []
+
+    def mock_test(image_name, model_name, session, **run_kwargs):
+        with lock:
+            running.append(model_name)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(model_name)
+
+    runner = ModelTestRunner(
+        workers=4,
+        memory_budget=6,
+        peak_memory={"Basset": 2, "DeepSEA/variantEffects": 2},
+        session=object(),
+        test=mock_test,
+    )
+    results = runner.run(
+        "kipoi/kipoi-docker:sharedpy3keras2tf2",
+        ["Basset", "DeepSEA/variantEffects", "DeepMEL"],
+    )
+    # 3 GB are reserved for each known model and 4 GB for DeepMEL
+    assert max(peak) == 2
+    assert [r.model_name for r in results] == [
+        "Basset",
+        "DeepSEA/variantEffects",
+        "DeepMEL",
+    ]
+    assert all(r.passed for r in results)
+
+
+def test_runners_share_budget():
+    lock = threading.Lock()
+    running, peak = [], []
+
+    def mock_test(image_name, model_name, session, **run_kwargs):
+        with lock:
+            running.append(model_name)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(model_name)
+
+    budget = ResourceBudget(workers=4, memory=8)
+    runners = [
+        ModelTestRunner(
+            peak_memory={}, session=object(), test=mock_test, budget=budget
+        )
+        for _ in range(2)
+    ]
+    images = ["kipoi/kipoi-docker:deepmel", "kipoi/kipoi-docker:deepmel-slim"]
+    threads = [
+        threading.Thread(
+            target=runner.run, args=(image, ["DeepMEL", "DeepMEL/Fly"])
+        )
+        for runner, image in zip(runners, images)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 4 GB are reserved for each unknown model, so that the full and the
+    # slim image are never tested with more than 2 models together
+    assert len(peak) == 4 and max(peak) == 2
+    assert budget.available == 8 and budget.running == 0
+
+
+def test_runner_collects_failures():
+    def mock_test(image_name, model_name, session, **run_kwargs):
+        if model_name == "DeepMEL":
+            raise ValueError("Test failed")
+
+    runner = ModelTestRunner(
+        workers=2,
+        memory_budget=1,
+        peak_memory={},
+        session=object(),
+        test=mock_test,
+    )
+    results = runner.run(
+        "kipoi/kipoi-docker:deepmel", ["DeepMEL", "DeepMEL/Fly"]
+    )
+    assert [r.passed for r in results] == [False, True]
+    assert results[0].failure == "ValueError"
+    with pytest.raises(ValueError, match="1 of 2 tests failed"):
+        raise_for_failures(results)
+
+
+def test_run_kwargs():
+    runner = ModelTestRunner(
+        workers=1,
+        cpus_per_test=2,
+        memory_budget=8,
+        peak_memory={"Basset": 2},
+        session=object(),
+    )
+    assert runner.get_run_kwargs("Basset") == {
+        "nano_cpus": 2000000000,
+        "mem_limit": "3072m",
+    }
+    assert "mem_limit" not in runner.get_run_kwargs("DeepMEL")
+
+
+def test_runner_with_warm_container(mock_session):
+    session = mock_session(
+        exec_exit_codes={"DeepMEL/Fly": 1, "Basset": 124, "DeepSEA": 137}
+    )
+    runner = ModelTestRunner(
+        workers=2,
+        memory_budget=8,
+        peak_memory={},
+        session=session,
+        warm=True,
+        timeout=600,
+        test_timeouts={"Basenji": 1800},
+    )
+    results = runner.run(
+        "kipoi/kipoi-docker:deepmel",
+        [
+            "DeepMEL",
+            "DeepMEL/Fly",
+            "Basenji",
+            "Basset",
+            "DeepSEA/variantEffects",
+        ],
+    )
+    assert [r.passed for r in results] == [True, False, True, False, False]
+    # A killed test has only run out of memory if docker says so
+    assert [r.failure for r in results] == [
+        None,
+        "non-zero-exit",
+        None,
+        "timeout",
+        "non-zero-exit",
+    ]
+    assert len(session.client.containers.started) == 1
+    container = session.client.containers.started[0]
+    assert container.command == ["sleep", "infinity"]
+    assert (
+        container.commands[0]
+        == "timeout --kill-after=30 600 kipoi test DeepMEL --source=kipoi"
+    )
+    assert (
+        "timeout --kill-after=30 1800 "
+        "kipoi test Basenji --source=kipoi --batch_size=2"
+        in container.commands
+    )
+    assert container.killed.is_set()
+
+
+def test_warm_container_reports_oom_kills(mock_session):
+    session = mock_session(exec_exit_codes={"DeepSEA": 137})
+    with WarmContainer("kipoi/kipoi-docker:deepsea", session) as container:
+        container.container.attrs = {"State": {"OOMKilled": True}}
+        with pytest.raises(ModelTestError) as error:
+            container.test("DeepSEA/variantEffects")
+    assert error.value.reason == "oom-killed"
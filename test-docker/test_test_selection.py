@@ -0,0 +1,59 @@
+from kipoi_containers.testselection import (
+    get_changed_models,
+    select_models_to_test,
+)
+
+MODELS = [
+    "CpGenie/A549_ENCSR000DDI",
+    "CpGenie/GM12878_ENCSR000DEY",
+    "CpGenie/HepG2_ENCSR000DFH",
+    "DeepMEL",
+    "DeepMEL/Fly",
+    "Basset",
+]
+
+PATCH = """@@ -1,3 +1,3 @@
+ model\targs
+-GM12878_ENCSR000DEY\tsha256:abc
++GM12878_ENCSR000DEY\tsha256:def
+ HepG2_ENCSR000DFH\tsha256:ghi"""
+
+
+def test_changed_models():
+    assert get_changed_models(
+        MODELS,
+        {
+            "CpGenie/models.tsv": PATCH,
+            "DeepMEL/Fly/model.yaml": None,
+            "shared/containers/model-to-docker.json": None,
+        },
+    ) == ["CpGenie/GM12878_ENCSR000DEY", "DeepMEL/Fly"]
+    # A template or a table without a patch affects the whole group
+    assert (
+        get_changed_models(
+            MODELS, {"CpGenie/template/model-template.yaml": None}
+        )
+        == MODELS[:3]
+    )
+    assert get_changed_models(MODELS, {"CpGenie/models.tsv": None}) == (
+        MODELS[:3]
+    )
+
+
+def test_select_models_to_test(monkeypatch):
+    monkeypatch.delenv("DOCKER_TEST_ALL_MODELS", raising=False)
+    changed_files = {"CpGenie/models.tsv": PATCH}
+    assert select_models_to_test(MODELS, changed_files, sample_size=2) == [
+        "CpGenie/A549_ENCSR000DDI",
+        "CpGenie/GM12878_ENCSR000DEY",
+        "DeepMEL",
+    ]
+    assert select_models_to_test(MODELS, changed_files, sample_size=0) == [
+        "CpGenie/GM12878_ENCSR000DEY"
+    ]
+    assert (
+        select_models_to_test(MODELS, changed_files, test_all=True) == MODELS
+    )
+    assert select_models_to_test(MODELS, {"README.md": None}) == MODELS
+    monkeypatch.setenv("DOCKER_TEST_ALL_MODELS", "true")
+    assert select_models_to_test(MODELS, changed_files) == MODELS
@@ -0,0 +1,143 @@
+import json
+import threading
+
+import docker
+import pytest
+
+from kipoi_containers import dockerhelper
+from kipoi_containers.testtelemetry import (
+    load_telemetry,
+    update_peak_memory,
+    update_test_durations,
+)
+
+
+@pytest.mark.parametrize("exit_code", [0, 137])
+def test_telemetry_is_recorded(monkeypatch, tmp_path, mock_session, exit_code):
+    monkeypatch.setenv("DOCKER_TEST_TELEMETRY_FOLDER", str(tmp_path))
+    session = mock_session(exit_code=exit_code)
+    if exit_code:
+        with pytest.raises(docker.errors.ContainerError):
+            dockerhelper.test_docker_image(
+                "kipoi/kipoi-docker:deepmel", "DeepMEL", session
+            )
+    else:
+        dockerhelper.test_docker_image(
+            "kipoi/kipoi-docker:deepmel", "DeepMEL", session
+        )
+    assert session.client.containers.started[0].removed
+    [record] = load_telemetry(tmp_path)
+    assert record["model_name"] == "DeepMEL"
+    assert record["exit_code"] == exit_code
+    assert record["peak_memory"] == 2_000_000_000
+    assert record["peak_cpu_percent"] == 80.0
+    assert record["block_read"] == 100 and record["block_write"] == 50
+    assert record["network_received"] == 500_000_000
+    assert record["failure"] == ("oom-killed" if exit_code else None)
+
+
+def test_test_is_killed_on_timeout(monkeypatch, tmp_path, mock_session):
+    monkeypatch.setenv("DOCKER_TEST_TELEMETRY_FOLDER", str(tmp_path))
+    session = mock_session(exit_code=137, hang=True)
+    with pytest.raises(dockerhelper.ModelTestError) as error:
+        dockerhelper.test_docker_image(
+            "kipoi/kipoi-docker:deepmel", "DeepMEL", session, timeout=0.1
+        )
+    assert error.value.reason == "timeout"
+    assert dockerhelper.classify_failure(error.value) == "timeout"
+    assert session.client.containers.started[0].killed.is_set()
+    assert session.client.containers.started[0].removed
+    [record] = load_telemetry(tmp_path)
+    assert record["failure"] == "timeout"
+
+
+def test_probe_is_killed_on_cancel(mock_session):
+    session = mock_session(exit_code=137, hang=True)
+    cancelled = threading.Event()
+    threading.Timer(0.1, cancelled.set).start()
+    assert not dockerhelper.test_docker_image_without_exception(
+        "kipoi/kipoi-docker:sharedpy3keras2tf2-slim",
+        "DeepMEL",
+        session,
+        cancelled=cancelled,
+    )
+    assert session.client.containers.started[0].killed.is_set()
+    assert session.client.containers.started[0].removed
+
+
+def test_default_timeout(monkeypatch):
+    monkeypatch.delenv("DOCKER_TEST_TIMEOUT", raising=False)
+    assert dockerhelper.get_test_timeout() == 3600
+    assert dockerhelper.get_test_timeout(60) == 60
+    monkeypatch.setenv("DOCKER_TEST_TIMEOUT", "600")
+    assert dockerhelper.get_test_timeout() == 600
+
+
+def test_memory_limit_from_environment(monkeypatch):
+    monkeypatch.setenv("DOCKER_TEST_MEMORY_LIMIT", "1.5")
+    assert dockerhelper.get_test_limits({}) == {"mem_limit": "1536m"}
+    assert dockerhelper.get_test_limits({"mem_limit": "3072m"}) == {
+        "mem_limit": "3072m"
+    }
+    assert (
+        dockerhelper.classify_failure(
+            docker.errors.ImageNotFound("kipoi/kipoi-docker:deepmel")
+        )
+        == "image-missing"
+    )
+
+
+def test_update_peak_memory(tmp_path):
+    peak_memory_json = tmp_path / "model-peak-memory.json"
+    peak_memory_json.write_text(json.dumps({"Basset": 1.5, "Basenji": 4}))
+    records = [
+        {"model_name": "DeepMEL", "exit_code": 0, "peak_memory": 2e9},
+        {"model_name": "DeepMEL", "exit_code": 0, "peak_memory": 3e9},
+        {"model_name": "DeepMEL/Fly", "exit_code": 137, "peak_memory": 9e9},
+        # A lighter run does not lower the recorded peak
+        {"model_name": "Basenji", "exit_code": 0, "peak_memory": 1e9},
+    ]
+    assert update_peak_memory(records, peak_memory_json) == {
+        "Basenji": 4,
+        "Basset": 1.5,
+        "DeepMEL": 3.0,
+    }
+
+
+def test_update_test_durations(tmp_path):
+    test_durations_json = tmp_path / "model-test-durations.json"
+    test_durations_json.write_text(json.dumps({"Basenji": 600}))
+    records = [
+        {"model_name": "Basenji", "exit_code": 0, "duration": 60},
+        {"model_name": "DeepMEL", "exit_code": 0, "duration": 30},
+    ]
+    assert update_test_durations(records, test_durations_json) == {
+        "Basenji": 600,
+        "DeepMEL": 30,
+    }
+
+
+def test_batch_is_killed_on_timeout(monkeypatch, tmp_path, mock_session):
+    monkeypatch.setenv("DOCKER_TEST_TELEMETRY_FOLDER", str(tmp_path))
+    monkeypatch.setenv("DOCKER_TEST_TIMEOUT", "0.1")
+    session = mock_session(exit_code=137, hang=True)
+    with pytest.raises(dockerhelper.ModelTestError) as error:
+        dockerhelper.test_docker_image(
+            "kipoi/kipoi-docker:deepmel", ["DeepMEL", "Basset"], session
+        )
+    assert error.value.reason == "timeout"
+    assert session.client.containers.started[0].killed.is_set()
+    assert session.client.containers.started[0].removed
+    [record] = load_telemetry(tmp_path)
+    assert record["model_name"] == "DeepMEL,Basset"
+    assert record["failure"] == "timeout"
+
+
+def test_oom_killed_batch_is_classified(mock_session):
+    session = mock_session(exit_code=137)
+    with pytest.raises(dockerhelper.ModelTestError) as error:
+        dockerhelper.test_docker_image(
+            "kipoi/kipoi-docker:deepmel", ["DeepMEL", "Basset"], session
+        )
+    assert error.value.reason == "oom-killed"
+    assert dockerhelper.classify_failure(error.value) == "oom-killed"